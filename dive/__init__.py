@@ -1,13 +1,61 @@
 """
 dive is a Python package for Bayesian analysis of DEER data.
+
+The lightweight modules constants, deer and deerload are imported directly. The other
+modules depend on pymc, arviz, deerlab and matplotlib, and are only imported when one
+of their functions is first accessed.
 """
+import importlib
 
 from .constants import *
-from .utils import *
-from .deerload import deerload
-from .models import *
+from .deerload import deerload, read_description_file
 from .deer import *
-from .plotting import *
-from .samplers import *
-from .test_data import *
-from .saving import *
\ No newline at end of file
+
+# Public functions of the modules that are imported on first use
+_lazy = {
+    "utils": ["addnoise", "FWHM2sigma", "sigma2FWHM", "dipolarkernel", "regoperator", "interpret", "get_rhats", "prune_chains", "fnnls"],
+    "models": ["model", "clearcache", "gausstable", "gausstable_error", "multigaussmodel", "regularizationmodel", "sample"],
+    "plotting": ["printsummary", "plotmarginals", "plotcorrelations", "summary", "plotresult", "drawPosteriorSamples", "posteriorPredictive", "plotMCMC", "pairplot_chain", "pairplot_divergence", "pairplot_condition", "plot_hist"],
+    "samplers": ["randPnorm_posterior", "randPiterative_posterior", "randPtmvn_posterior", "randDelta_posterior", "randTau_posterior", "randAmp_posterior", "randBkgd_posterior"],
+    "test_data": ["generateSingleGauss", "generateMultiGauss", "generateBiModalGauss"],
+    "saving": ["saveTrace", "loadTrace"],
+    "encoding": ["encodeP", "decodeP", "restoreDeterministics"],
+    "selection": ["select_ngauss"],
+    "reports": ["makeReports"],
+    "tempering": ["paralleltempering"],
+    "smc": ["sample_smc"],
+    "benchmark": ["runBenchmark", "loadBenchmark", "compareBenchmark"],
+}
+_origin = {name: module for module, names in _lazy.items() for name in names}
+
+# Imports of the modules that leaked into the package namespace through the former
+# star imports; still resolved on access, but not exported by "from dive import *"
+_leaked = {
+    "pm": ("pymc", None), "pt": ("pytensor", None), "az": ("arviz", None), "dl": ("deerlab", None),
+    "plt": ("matplotlib.pyplot", None), "indexers": ("pandas.core.indexers", None),
+    "os": ("os", None), "re": ("re", None), "random": ("random", None),
+    "BlockedStep": ("pymc.step_methods.arraystep", "BlockedStep"), "display": ("IPython.display", "display"),
+    "fresnel": ("scipy.special", "fresnel"), "loadmat": ("scipy.io", "loadmat"), "sqrtm": ("scipy.linalg", "sqrtm"),
+    "key_press_handler": ("matplotlib.backend_bases", "key_press_handler"),
+    "date": ("datetime", "date"), "replace": ("dataclasses", "replace"), "warn": ("warnings", "warn"),
+}
+
+__all__ = [name for name in globals() if not name.startswith("_") and name != "importlib"] + list(_origin)
+
+def __getattr__(name):
+    if name in _origin:
+        value = getattr(importlib.import_module("." + _origin[name], __name__), name)
+    elif name in _lazy:
+        value = importlib.import_module("." + name, __name__)
+    elif name in _leaked:
+        module, attribute = _leaked[name]
+        value = importlib.import_module(module)
+        if attribute is not None:
+            value = getattr(value, attribute)
+    else:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_origin))
@@ -0,0 +1,300 @@
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+import multiprocessing
+import numpy as np
+import pandas as pd
+import arviz as az
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+# Test problems: synthetic data from test_data (with ground truth) and the bundled
+# measurements in data/, each with the number of Gaussians of the Gaussian model
+_problems = {
+    "single": {"generator": "generateSingleGauss", "nGauss": 1},
+    "multi": {"generator": "generateMultiGauss", "nGauss": 2},
+    "bimodal": {"generator": "generateBiModalGauss", "nGauss": 2},
+    "3992_good": {"file": "3992_good.dat", "nGauss": 2},
+    "3992_bad": {"file": "3992_bad.dat", "nGauss": 2},
+}
+
+# Configurations: model parameters (for model), options for sample, or options for
+# sample_smc (with "smc"). The step order of the regularization model is [tau, delta,
+# P, NUTS].
+_configs = {
+    "gaussian": {"pars": {"method": "gaussian"}},
+    "gaussian_table": {"pars": {"method": "gaussian", "likelihood": "table"}},
+    "gaussian_float32": {"pars": {"method": "gaussian", "dtype": "float32"}},
+    "gaussian_target95": {"pars": {"method": "gaussian"}, "sample": {"NUTSpars": {"target_accept": 0.95}}},
+    "gaussian_warmstart": {"pars": {"method": "gaussian"}, "sample": {"warmstart": True}},
+    "gaussian_tempering": {"pars": {"method": "gaussian"}, "sample": {"tempering": {}}},
+    "gaussian_smc": {"pars": {"method": "gaussian"}, "smc": {}},
+    "regularization": {"pars": {"method": "regularization"}},
+    "regularization_NUTSfirst": {"pars": {"method": "regularization"}, "sample": {"steporder": [3, 0, 1, 2]}},
+    "regularization_gibbs": {"pars": {"method": "regularization", "amp_sampler": "gibbs", "bkgd_sampler": "slice"}},
+    "regularization_iterative": {"pars": {"method": "regularization", "P_sampler": "iterative"}},
+    "regularization_hmc": {"pars": {"method": "regularization", "P_sampler": "hmc"}},
+    "regularizationP": {"pars": {"method": "regularizationP"}},
+    "regularization_NUTS": {"pars": {"method": "regularization_NUTS"}},
+}
+
+# Scalar parameters whose ESS is reported, if present in the trace
+_keyvars = ["r0", "w", "a", "lamb", "V0", "sigma", "Bend", "k", "lg_alpha"]
+
+# Quantiles of the distance distributions whose ESS is reported
+_Pquantiles = [0.1, 0.5, 0.9]
+
+_datadir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+
+def runBenchmark(problems=None, configs=None, MCMCparameters={"draws": 1000, "tune": 1000, "chains": 4, "cores": 4}, outfile="benchmark.jsonl", r=np.linspace(2, 8, 100), seed=0, label=None):
+    """
+    Fits every problem in problems (names in _problems, default all) with every
+    configuration in configs (names in _configs, default all) and appends one JSON
+    line per fit to outfile, so that runs of different versions can be compared with
+    compareBenchmark.
+
+    Every fit runs in a fresh process, so that compile times and peak memory are not
+    shared between configurations. Recorded are the wall time of model and sample,
+    the time spent compiling PyTensor functions, the peak resident memory of the
+    process and its sampling processes, the bulk ESS and ESS per second (of the
+    sampling wall time) of the key parameters and of the 10, 50 and 90% quantiles of
+    P, the maximum R-hat, the number of divergences, and for the synthetic problems
+    the errors of the posterior means with respect to the ground truth.
+
+    label identifies the run in outfile (default: the current git commit).
+    Returns the results as a table.
+    """
+    problems = list(_problems) if problems is None else problems
+    configs = list(_configs) if configs is None else configs
+    for name in problems:
+        if name not in _problems:
+            raise ValueError(f"Unknown benchmark problem '{name}'.")
+    for name in configs:
+        if name not in _configs:
+            raise ValueError(f"Unknown benchmark configuration '{name}'.")
+
+    if label is None:
+        label = _gitcommit()
+    info = {"label": label, "python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count()}
+
+    records = []
+    for problem in problems:
+        for config in configs:
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                result = pool.submit(_run, problem, config, MCMCparameters, r, seed).result()
+            record = {**info, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "problem": problem, "config": config, "MCMCparameters": MCMCparameters, **result}
+            with open(outfile, "a") as f:
+                f.write(json.dumps(record) + "\n")
+            records.append(record)
+
+            if record["error"] is None:
+                print(f"{problem:12s} {config:26s} wall {record['wall_time']:7.1f} s   compile {record['compile_time']:6.1f} s   min. ESS/s {_format(record['min_ess_per_s'], '8.2f')}   peak RSS {_format(record['peak_rss_mb'], '6.0f')} MB")
+            else:
+                print(f"{problem:12s} {config:26s} failed: {record['error']}")
+
+    return _table(records)
+
+def loadBenchmark(path="benchmark.jsonl"):
+    """
+    Returns the results in a benchmark file as a table indexed by label, problem and
+    configuration, with one column per recorded number.
+    """
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    return _table(records)
+
+def compareBenchmark(path="benchmark.jsonl", baseline=None, candidate=None, columns=["wall_time", "compile_time", "peak_rss_mb", "min_ess_per_s"]):
+    """
+    Returns, for every problem and configuration run under both labels, the ratios
+    candidate/baseline of the given columns of a benchmark file (default: the first
+    and the last label in the file). Ratios above 1 are improvements for ESS per
+    second and regressions for times and memory.
+    """
+    table = loadBenchmark(path)
+    labels = list(dict.fromkeys(table.index.get_level_values("label")))
+    baseline = labels[0] if baseline is None else baseline
+    candidate = labels[-1] if candidate is None else candidate
+
+    # the last run of every problem and configuration under each label
+    base = table.xs(baseline, level="label").reindex(columns=columns).groupby(level=[0, 1]).last()
+    cand = table.xs(candidate, level="label").reindex(columns=columns).groupby(level=[0, 1]).last()
+    ratios = (cand/base).dropna(how="all")
+    ratios.attrs.update({"baseline": baseline, "candidate": candidate})
+    return ratios
+
+def _table(records):
+    rows = []
+    for record in records:
+        row = {key: value for key, value in record.items() if not isinstance(value, dict)}
+        for group in ["ess", "ess_per_s", "accuracy"]:
+            row.update({f"{group}:{key}": value for key, value in (record.get(group) or {}).items()})
+        rows.append(row)
+    return pd.DataFrame(rows).set_index(["label", "problem", "config"])
+
+def _run(problem, config, MCMCparameters, r, seed):
+    """
+    Worker: fits one problem with one configuration and returns the measurements.
+    """
+    from . import models, smc
+
+    result = {"error": None}
+    try:
+        compiletime = _countcompiletime()
+        t, V, truth = _loadproblem(problem)
+        options = _configs[config]
+        pars = {"r": r, "nGauss": _problems[problem]["nGauss"], "reuse": False, **options["pars"]}
+
+        start = time.perf_counter()
+        model_dic = models.model(t, V, pars)
+        model_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        if "smc" in options:
+            trace = smc.sample_smc(model_dic, **{"draws": MCMCparameters["draws"], "chains": MCMCparameters["chains"], "cores": MCMCparameters.get("cores"), "seed": seed, **options["smc"]})
+        else:
+            trace = models.sample(model_dic, {**MCMCparameters, "progressbar": False}, seed=seed, **options.get("sample", {}))
+        sampling_time = time.perf_counter() - start
+
+        ess = _ess(trace, model_dic["pars"]["r"])
+        result.update({
+            "wall_time": model_time + sampling_time,
+            "model_time": model_time,
+            "sampling_time": sampling_time,
+            "compile_time": compiletime[0],
+            "peak_rss_mb": _peakrss(),
+            "ess": ess,
+            "ess_per_s": {key: value/sampling_time for key, value in ess.items()},
+            "min_ess_per_s": min(ess.values())/sampling_time if ess else None,
+            "max_rhat": _maxrhat(trace),
+            "divergences": int(trace.sample_stats["diverging"].sum()) if "sample_stats" in trace and "diverging" in trace.sample_stats else None,
+            "accuracy": None if truth is None else _accuracy(trace, model_dic, truth),
+        })
+    except Exception as exception:
+        result["error"] = f"{type(exception).__name__}: {exception}"
+    return result
+
+def _loadproblem(problem):
+    """
+    Returns time vector, signal and ground truth (None for measured data) of a problem.
+    """
+    source = _problems[problem]
+    if "file" in source:
+        data = np.loadtxt(os.path.join(_datadir, source["file"]), delimiter=",", skiprows=1)
+        return data[:, 0], data[:, 1], None
+
+    from . import test_data
+    data, pars = getattr(test_data, source["generator"])()
+    truth = {"r": data["r"], "P": data["P"], "lamb": pars["lamb"], "k": pars["k"], "V0": pars["V0"], "sigma": pars["sigma"]}
+    return data["t"], data["V"], truth
+
+def _countcompiletime():
+    """
+    Wraps the compilation of PyTensor functions to accumulate its duration, and
+    returns the (one-element) list that holds the total.
+    """
+    import pytensor
+    pfunc = sys.modules["pytensor.compile.function.pfunc"]
+
+    total = [0.0]
+    compile = pfunc.orig_function
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return compile(*args, **kwargs)
+        finally:
+            total[0] += time.perf_counter() - start
+    pfunc.orig_function = timed
+    return total
+
+def _peakrss():
+    """
+    Returns the peak resident memory (MB) of this process and its child processes.
+    """
+    if resource is None:
+        return None
+    scale = 2**20 if sys.platform == "darwin" else 2**10
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)/scale
+
+def _ess(trace, r):
+    """
+    Returns the bulk ESS of the key parameters (one entry per element) and of the
+    quantiles of P.
+    """
+    posterior = trace.posterior
+    ess = {}
+    for var in [var for var in _keyvars if var in posterior]:
+        values = az.ess(trace, var_names=[var], method="bulk")[var].values
+        if values.ndim == 0:
+            ess[var] = float(values)
+        else:
+            ess.update({f"{var}[{i}]": float(value) for i, value in enumerate(values)})
+    if "P" in posterior:
+        quantiles = _Pquantile(posterior["P"].values, r, _Pquantiles)
+        for q, values in zip(_Pquantiles, quantiles):
+            ess[f"P_q{100*q:.0f}"] = float(az.ess(values, method="bulk"))
+    return ess
+
+def _Pquantile(P, r, quantiles):
+    """
+    Returns the distances at which the cumulative distributions of the draws of P
+    reach the given quantiles (linearly interpolated), one array per quantile.
+    """
+    cdf = np.cumsum(P, axis=-1)
+    cdf /= cdf[..., -1:]
+    results = []
+    for q in quantiles:
+        i = np.clip(np.argmax(cdf >= q, axis=-1), 1, len(r)-1)[..., None]
+        lower, upper = np.take_along_axis(cdf, i-1, axis=-1), np.take_along_axis(cdf, i, axis=-1)
+        fraction = np.clip((q - lower)/np.where(upper > lower, upper - lower, 1), 0, 1)
+        results.append((r[i-1] + fraction*(r[1]-r[0]))[..., 0])
+    return results
+
+def _maxrhat(trace):
+    Vars = [var for var in _keyvars if var in trace.posterior]
+    if not Vars:
+        return None
+    return float(max(az.rhat(trace, var_names=[var])[var].max() for var in Vars))
+
+def _accuracy(trace, model_dic, truth):
+    """
+    Returns errors of the posterior means with respect to the ground truth: the RMS
+    error of P (both normalized, relative to the maximum of the true P), the fraction
+    of distances at which the true P lies within the 95% interval of the draws, and
+    the absolute errors of lamb, k, V0 and sigma (in the units of the data).
+    """
+    pars = model_dic["pars"]
+    posterior = trace.posterior
+    accuracy = {}
+
+    if "P" in posterior:
+        r = pars["r"]
+        Ptrue = np.interp(r, truth["r"], truth["P"], left=0, right=0)
+        Ptrue /= np.sum(Ptrue)*(r[1]-r[0])
+        P = posterior["P"].values.reshape(-1, len(r))
+        P = P/(np.sum(P, axis=1, keepdims=True)*(r[1]-r[0]))
+        lower, upper = np.quantile(P, [0.025, 0.975], axis=0)
+        accuracy["P_rmse"] = float(np.sqrt(np.mean((P.mean(axis=0) - Ptrue)**2))/Ptrue.max())
+        accuracy["P_coverage"] = float(np.mean((Ptrue >= lower) & (Ptrue <= upper)))
+
+    # parameters that are missing from the trace (e.g. dropped deterministics) are skipped
+    scales = {"lamb": 1, "k": 1, "V0": pars["Vscale"], "sigma": pars["Vscale"]}
+    for var, scale in scales.items():
+        if var in posterior:
+            accuracy[var] = float(abs(posterior[var].mean()*scale - truth[var]))
+    return accuracy
+
+def _format(value, spec):
+    return "n/a".rjust(int(spec.split(".")[0])) if value is None else format(value, spec)
+
+def _gitcommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
@@ -7,31 +7,39 @@ from .constants import *
 def dd_gauss(r,r0,fwhm,a=1):
     """
     Calculates a multi-Gauss distance distribution over distance vector r.
+    r0, fwhm and a can have leading dimensions (e.g. one row per posterior draw),
+    in which case one normalized distribution is returned per row.
     """
 
-    nGauss = np.size(r0)
+    r0 = np.atleast_1d(r0)
 
-    if np.size(fwhm)!=nGauss:
+    if np.size(fwhm)!=np.size(r0):
         raise ValueError("r0 and fwhm need to have the same number of elements.")
-    if np.size(a)!=nGauss:
+    if np.size(a)!=np.size(r0):
         raise ValueError("r0 and a need to have the same number of elements.")
     
-    sig = np.array(fwhm)/2/m.sqrt(2*m.log(2))
+    sig = np.reshape(fwhm,np.shape(r0))/2/m.sqrt(2*m.log(2))
+    a = np.reshape(a,np.shape(r0))
 
-    if nGauss==1:
-        P = a*gauss(r,r0,sig)
-    else:
-        P = np.zeros_like(r)
-        for k in range(nGauss):
-            P += a[k]*gauss(r,r0[k],sig[k])
+    P = multigauss(r,r0,sig,a)
 
     # normalize P
-    scale = P.sum() * (r[1]-r[0])
+    scale = P.sum(axis=-1,keepdims=True) * (r[1]-r[0])
     P /= scale
 
     return P
 
 
+def multigauss(r,r0,sig,a):
+    """
+    Calculates the sum of Gaussians with centers r0, standard deviations sig and
+    amplitudes a over distance vector r as one broadcast (nGauss x nr) operation
+    followed by a single reduction. Works for NumPy arrays and PyTensor tensors.
+    Leading dimensions of r0, sig and a are kept.
+    """
+    return (a[...,None]*gauss(r,r0[...,None],sig[...,None])).sum(axis=-2)
+
+
 def gauss(r,r0,sig):
     """
     Calculates a single-Gauss distance distribution over distance vector r.
@@ -2,7 +2,6 @@ from warnings import warn
 import re
 import numpy as np
 import os
-import matplotlib.pyplot as plt
 
 #-------------------------------------------------------------------------------
 def deerload(fullbasename,Scaling=None,plot=False,*args,**kwargs):
@@ -238,6 +237,7 @@ def deerload(fullbasename,Scaling=None,plot=False,*args,**kwargs):
                 warn('Cannot scale by temperature, since STMP in the DSC file is missing.')
     
     if plot:
+        import matplotlib.pyplot as plt
         plt.plot(abscissa/1e3,np.real(data),abscissa/1e3,np.imag(data))
         plt.xlabel("time (μs)")
         plt.ylabel("intensity")
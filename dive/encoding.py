@@ -0,0 +1,126 @@
+import numpy as np
+import xarray as xr
+import arviz as az
+
+from .deer import multigauss
+
+# Available encodings of the P draws
+_encodings = ["sparse", "float16"]
+
+def encodeP(trace, encoding="sparse", tol=0):
+    """
+    Returns a copy of trace in which the draws of P are moved from the posterior into
+    a compact encoding in the group P_encoded:
+      sparse    bit mask and values of the elements above tol*max(P) of every draw
+                (lossless for tol = 0, since P has exact zeros)
+      float16   half-precision values, scaled by the maximum of every draw
+    The maximum round-trip error relative to max(P) is printed and stored in
+    P_encoded.attrs["max_error"]. decodeP restores P.
+    """
+    if encoding not in _encodings:
+        raise ValueError(f"Unknown P encoding '{encoding}'.")
+    if "P" not in trace.posterior:
+        raise KeyError("The trace contains no draws of P.")
+
+    P = trace.posterior["P"]
+    values = P.values
+    Pmax = values.max(axis=-1, keepdims=True)
+
+    if encoding == "sparse":
+        mask = values > tol*Pmax
+        encoded = xr.Dataset({"mask": ("byte", np.packbits(mask)), "value": ("element", values[mask])})
+    else:
+        scale = np.where(Pmax > 0, Pmax, 1)
+        encoded = xr.Dataset({"value": (P.dims, (values/scale).astype(np.float16)), "scale": (P.dims[:-1], scale[..., 0])})
+
+    encoded = encoded.assign_coords({dim: P[dim].values for dim in P.dims})
+    encoded.attrs.update({"encoding": encoding, "shape": list(values.shape), "dims": ",".join(P.dims), "dtype": str(values.dtype)})
+
+    error = float(np.max(np.abs(_decode(encoded) - values))/np.max(values))
+    encoded.attrs["max_error"] = error
+    size = sum(var.nbytes for var in encoded.data_vars.values())
+    print(f"P encoding:         {encoding}, {values.nbytes/size:.3g}x smaller, max. relative round-trip error {error:.2g}")
+
+    return _replaceposterior(trace, trace.posterior.drop_vars("P"), P_encoded=encoded)
+
+def decodeP(trace):
+    """
+    Returns a copy of trace with the draws of P decoded from the group P_encoded back
+    into the posterior. Traces without encoded P are returned unchanged.
+    """
+    if "P_encoded" not in trace.groups() or "P" in trace.posterior:
+        return trace
+
+    encoded = trace.P_encoded
+    dims = encoded.attrs["dims"].split(",")
+    # coordinates already in the posterior take precedence, so that P aligns with them
+    coords = {dim: (trace.posterior[dim] if dim in trace.posterior.coords else encoded[dim]).values for dim in dims}
+    P = xr.DataArray(_decode(encoded), dims=dims, coords=coords)
+
+    return _replaceposterior(trace, trace.posterior.assign(P=P), drop=["P_encoded"])
+
+def _decode(encoded):
+    """
+    Returns the array of P draws from the encoded dataset.
+    """
+    shape = tuple(int(n) for n in np.atleast_1d(encoded.attrs["shape"]))
+    dtype = encoded.attrs["dtype"]
+    if encoded.attrs["encoding"] == "sparse":
+        mask = np.unpackbits(encoded["mask"].values, count=np.prod(shape)).astype(bool).reshape(shape)
+        P = np.zeros(shape, dtype=dtype)
+        P[mask] = encoded["value"].values
+        return P
+    else:
+        return encoded["value"].values.astype(dtype)*encoded["scale"].values[..., np.newaxis]
+
+# Deterministics that are recalculated from the stored variables by restoreDeterministics
+_recomputable = ["P", "r0", "Bend", "k", "sigma", "lg_alpha", "lg_delta"]
+
+def restoreDeterministics(trace):
+    """
+    Returns a copy of trace in which the deterministic variables that were not stored
+    (see sample(..., store_deterministics=False)) are recalculated from the stored
+    variables, over the distance and time vectors of the model, which sample stores in
+    posterior.attrs["deterministics_r"] and ["deterministics_t"]. Other traces are
+    returned unchanged.
+    """
+    if "dropped_deterministics" not in trace.posterior.attrs:
+        return trace
+    dropped = [name for name in trace.posterior.attrs["dropped_deterministics"].split(",") if name and name not in trace.posterior]
+    posterior = trace.posterior
+    r = np.asarray(posterior.attrs["deterministics_r"])
+    t = np.asarray(posterior.attrs["deterministics_t"])
+    draws = ("chain", "draw")
+    values = {}
+
+    if "r0" in dropped:
+        values["r0"] = (draws + ("r0_dim_0",), np.sort(posterior["r0_rel"].values, axis=-1)*(r.max()-r.min()) + r.min())
+    if "P" in dropped:
+        if "P_Dirichlet" in posterior:
+            P = posterior["P_Dirichlet"].values/(r[1]-r[0])
+        else:
+            r0 = values["r0"][1] if "r0" in values else posterior["r0"].values
+            w = posterior["w"].values
+            a = posterior["a"].values if "a" in posterior else np.ones_like(w)
+            P = multigauss(r, r0, w/(2*np.sqrt(2*np.log(2))), a)
+        values["P"] = (draws + ("P_dim_0",), P)
+    if "Bend" in dropped:
+        values["Bend"] = (draws, np.exp(-posterior["k"].values*t[-1]))
+    if "k" in dropped:
+        values["k"] = (draws, -np.log(posterior["Bend"].values)/t[-1])
+    if "sigma" in dropped:
+        values["sigma"] = (draws, 1/np.sqrt(posterior["tau"].values))
+    if "lg_alpha" in dropped:
+        values["lg_alpha"] = (draws, np.log10(np.sqrt(posterior["delta"].values/posterior["tau"].values)))
+    if "lg_delta" in dropped:
+        values["lg_delta"] = (draws, np.log10(posterior["delta"].values))
+
+    return _replaceposterior(trace, posterior.assign(values))
+
+def _replaceposterior(trace, posterior, drop=[], **groups):
+    """
+    Returns a new InferenceData with the posterior replaced, the groups in drop removed
+    and the given groups added.
+    """
+    groups = {**{group: trace[group] for group in trace.groups() if group not in ["posterior"] + drop}, **groups}
+    return az.InferenceData(posterior=posterior, **groups)
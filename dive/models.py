@@ -1,12 +1,43 @@
 import pymc as pm
 
 import numpy as np
+import arviz as az
+import xarray as xr
 import deerlab as dl
+import time
+import functools
+import warnings
+from collections import OrderedDict
 import pytensor as pt
+import pytensor.sparse
+from scipy.optimize import least_squares
 
 from .utils import *
 from .deer import *
 from .samplers import *
+from .encoding import *
+from .encoding import _recomputable
+from .plotting import _relevantVariables
+from .tempering import paralleltempering
+
+# PyMC models and their compiled NUTS steps, cached by graph structure so that
+# fits of new datasets on the same grids reuse the compiled PyTensor functions.
+# Both caches are least-recently-used with at most _cachesize models and
+# _cachesize steps per model; clearcache empties them.
+_modelcache = OrderedDict()
+_stepcache = OrderedDict()
+_cachesize = 8
+
+# Gibbs steps for P in the regularization models, selected with pars['P_sampler']
+_Psamplers = {"fnnls": randPnorm_posterior, "iterative": randPiterative_posterior, "hmc": randPtmvn_posterior}
+
+# Supports of P in randPnorm_posterior, selected with pars['P_support']
+_Psupports = ["full", "adaptive"]
+
+# Samplers for V0 and lamb, and for the background variable in the regularization
+# models, selected with pars['amp_sampler'] and pars['bkgd_sampler']
+_ampsamplers = ["nuts", "gibbs"]
+_bkgdsamplers = ["nuts", "slice"]
 
 def model(t, Vexp, pars):
     """
@@ -14,11 +45,25 @@ def model(t, Vexp, pars):
     and the PyMC model in m['model']. Additional (constant) model parameters
     are in m['pars'].
     The data are rescaled internally to max(Vexp)==1.
+    Unless pars['reuse'] is False, the PyMC model is taken from a cache keyed by
+    method, grid sizes and background, and only the data containers are swapped.
+    The cache keeps the most recently used models; clearcache empties it.
+    With pars['dtype'] = 'float32', kernels, Gram matrices, the PyMC model and the
+    stored traces are in single precision.
+    With pars['amp_sampler'] = 'gibbs', V0 and lamb of the regularization models are
+    drawn from their full conditional (randAmp_posterior) instead of by NUTS, and with
+    pars['bkgd_sampler'] = 'slice', the background variable is slice-sampled
+    (randBkgd_posterior). These steps come after the P step in sample's step order,
+    and if no variables are left for NUTS, no NUTS step (and no gradient) is compiled.
     """
     
+    dtype = pars["dtype"] if "dtype" in pars else "float64"
+    if dtype not in ["float64", "float32"]:
+        raise ValueError(f"Unknown dtype '{dtype}'.")
+
     # Rescale data to max 1
     Vscale = np.amax(Vexp)
-    Vexp_scaled = Vexp/Vscale
+    Vexp_scaled = (Vexp/Vscale).astype(dtype)
 
     if "method" not in pars:
         raise KeyError("'method' is a required field.")
@@ -30,48 +75,83 @@ def model(t, Vexp, pars):
     # Supplement defaults
     rmax_opt = pars["rmax_opt"] if "rmax_opt" in pars else "user"
     bkgd_var = pars["bkgd_var"] if "bkgd_var" in pars else "Bend"
+    reuse = pars["reuse"] if "reuse" in pars else True
 
-    if rmax_opt == "auto":
-        r_ = pars["r"]
-        tmax = max(abs(t))
-        rmax= (108*tmax)**0.333333333333333
-        dr = (max(r_)-min(r_))/len(r_)
-        num = int((rmax-min(r_))/dr)
-        r = np.linspace(min(r_),rmax,num)
-
-    elif rmax_opt == "user":
-        r = pars["r"]
-
-    else:
-        raise ValueError(f"Unknown rmax selection method '{rmax_opt}'.")
+    r = _distancegrid(t, pars["r"], rmax_opt)
 
     if method == "gaussian":
         if "nGauss" not in pars:
            raise KeyError(f"nGauss is a required key for ""method"" = ""{method}"".") 
         nGauss = pars["nGauss"]
 
-        K0 = dl.dipolarkernel(t, r, integralop=True)
-        model_pymc = multigaussmodel(t, Vexp_scaled, K0, r, nGauss, bkgd_var=bkgd_var)
+        # a precomputed kernel can be passed in to share it between several models
+        K0 = pars["K0"] if "K0" in pars else dl.dipolarkernel(t, r, integralop=True)
+        K0 = K0.astype(dtype)
+
+        # Likelihood backend: exact (K0@P) or interpolated from a table of Gaussian signals
+        likelihood = pars["likelihood"] if "likelihood" in pars else "exact"
+        if likelihood == "table":
+            table_size = tuple(pars["table_size"]) if "table_size" in pars else (2*len(r), 30)
+            table = gausstable(K0, r, *table_size)
+        elif likelihood == "exact":
+            table_size = None
+            table = None
+        else:
+            raise ValueError(f"Unknown likelihood '{likelihood}'.")
+
+        cachekey = (method, nGauss, len(t), len(r), bkgd_var, table_size, dtype)
+        if reuse and cachekey in _modelcache:
+            model_pymc = _modelcache[cachekey]
+        else:
+            with pt.config.change_flags(floatX=dtype):
+                model_pymc = multigaussmodel(t, Vexp_scaled, K0, r, nGauss, bkgd_var=bkgd_var, table=table)
         
-        model_pars = {"K0": K0, "r": r, "nGauss": nGauss}
+        model_pars = {"K0": K0, "r": r, "nGauss": nGauss, "table": table}
 
     elif method == "regularization" or method == "regularizationP" or method == "regularization_NUTS":
 
-        K0 = dl.dipolarkernel(t, r,integralop=False)
-        L = dl.regoperator(np.arange(len(r)), 2, includeedges=False)
-        LtL = L.T@L
+        K0 = dl.dipolarkernel(t, r,integralop=False).astype(dtype)
+        # L is tridiagonal and LtL pentadiagonal, so both are kept sparse
+        L = regoperator(len(r), dtype=dtype)
+        LtL = (L.T@L).tocsr()
         K0tK0 = K0.T@K0
 
         delta_prior = [1, 1e-6]
         tau_prior = [1, 1e-4]
+        lamb_prior = [1.3, 2.0]
+        V0_prior = [1, 0.2]
+        Bend_prior = [1.0, 1.5]
+        k_scale = 0.1
 
         alpha = pars["alpha"] if "alpha" in pars else None
+
+        P_sampler = pars["P_sampler"] if "P_sampler" in pars else "fnnls"
+        if P_sampler not in _Psamplers:
+            raise ValueError(f"Unknown P sampler '{P_sampler}'.")
+        amp_sampler = pars["amp_sampler"] if "amp_sampler" in pars else "nuts"
+        if amp_sampler not in _ampsamplers:
+            raise ValueError(f"Unknown amplitude sampler '{amp_sampler}'.")
+        bkgd_sampler = pars["bkgd_sampler"] if "bkgd_sampler" in pars else "nuts"
+        if bkgd_sampler not in _bkgdsamplers:
+            raise ValueError(f"Unknown background sampler '{bkgd_sampler}'.")
+        P_support = pars["P_support"] if "P_support" in pars else "full"
+        if P_support not in _Psupports:
+            raise ValueError(f"Unknown P support '{P_support}'.")
+        if P_support == "adaptive" and P_sampler != "fnnls":
+            raise ValueError(f"P_support = 'adaptive' is only available with P_sampler = 'fnnls', not '{P_sampler}'.")
         
         tauGibbs = method == "regularization"
         deltaGibbs = (method == "regularization" and "alpha" not in pars)
-        model_pymc = regularizationmodel(t, Vexp_scaled, K0, L, LtL, r, delta_prior=delta_prior, tau_prior=tau_prior, tauGibbs=tauGibbs, deltaGibbs=deltaGibbs, bkgd_var=bkgd_var, alpha=alpha, allNUTS=(method=="regularization_NUTS"))
+        cachekey = (method, len(t), len(r), bkgd_var, alpha, dtype)
+        if reuse and cachekey in _modelcache:
+            model_pymc = _modelcache[cachekey]
+        else:
+            with pt.config.change_flags(floatX=dtype):
+                model_pymc = regularizationmodel(t, Vexp_scaled, K0, L, LtL, r, delta_prior=delta_prior, tau_prior=tau_prior, lamb_prior=lamb_prior, V0_prior=V0_prior, Bend_prior=Bend_prior, k_scale=k_scale, tauGibbs=tauGibbs, deltaGibbs=deltaGibbs, bkgd_var=bkgd_var, alpha=alpha, allNUTS=(method=="regularization_NUTS"))
 
-        model_pars = {"r": r, "K0": K0, "L": L, "LtL": LtL, "K0tK0": K0tK0, "delta_prior": delta_prior, "tau_prior": tau_prior}
+        model_pars = {"r": r, "K0": K0, "L": L, "LtL": LtL, "K0tK0": K0tK0, "delta_prior": delta_prior, "tau_prior": tau_prior, "lamb_prior": lamb_prior, "V0_prior": V0_prior, "Bend_prior": Bend_prior, "k_scale": k_scale, "P_sampler": P_sampler, "amp_sampler": amp_sampler, "bkgd_sampler": bkgd_sampler}
+        if "P_support" in pars:
+            model_pars.update({"P_support": pars["P_support"]})
         if alpha is not None:
             model_pars.update({"alpha": alpha})
     
@@ -84,8 +164,13 @@ def model(t, Vexp, pars):
     model_pars['t'] = t
     model_pars['dr'] = r[1]-r[0]
     model_pars['background'] = bkgd_var
+    model_pars['dtype'] = dtype
+    model_pars['cachekey'] = cachekey if reuse else None
+    if reuse:
+        _cachemodel(cachekey, model_pymc)
 
     model = {'model': model_pymc, 'pars': model_pars, 't': t, 'Vexp': Vexp_scaled}
+    _setdata(model)
     
     # Print information about data and model
     print(f"Time range:         {min(t):g} µs to {max(t):g} µs  ({len(t):d} points, step size {t[1]-t[0]:g} µs)")
@@ -94,44 +179,136 @@ def model(t, Vexp, pars):
     print(f"Background:         exponential")
     if method == "gaussian":
         print(f"P model:            {nGauss} Gaussians")
+        if table is not None:
+            print(f"Signal table:       {table_size[0]} x {table_size[1]} (r0 x w), max. interpolation error {gausstable_error(K0, r, table):.2g} ({table.nbytes/2**20:.0f} MB)")
     else:
         print(f"P model:            {method}")
     
     return model
 
+def _distancegrid(t, r, rmax_opt="user"):
+    """
+    Returns the distance vector used for the model, given the user-supplied r
+    and the rmax selection method rmax_opt.
+    """
+    if rmax_opt == "auto":
+        tmax = max(abs(t))
+        rmax= (108*tmax)**0.333333333333333
+        dr = (max(r)-min(r))/len(r)
+        num = int((rmax-min(r))/dr)
+        r = np.linspace(min(r),rmax,num)
+
+    elif rmax_opt != "user":
+        raise ValueError(f"Unknown rmax selection method '{rmax_opt}'.")
+
+    return r
+
+# Bounds of the FWHM prior in multigaussmodel, which are covered by gausstable
+_wmin, _wmax = 0.05, 3.0
+
+def gausstable(K0, r, nr0=None, nw=30):
+    """
+    Calculates the time-domain signals K0@P of single Gaussians P on a grid of nr0
+    center distances spanning r (default 2*len(r)) and nw FWHMs spaced
+    logarithmically over the support of the FWHM prior, plus one extra grid point on
+    every side for the bicubic interpolation. Returns a float32 array of size
+    (nr0+2, nw+2, nt).
+    """
+    nr0 = 2*len(r) if nr0 is None else nr0
+    r0grid = min(r) + (max(r)-min(r))/(nr0-1)*np.arange(-1, nr0+1)
+    wgrid = _wmin*(_wmax/_wmin)**(np.arange(-1, nw+1)/(nw-1))
+    table = np.empty((nr0+2, nw+2, np.shape(K0)[0]), dtype=np.float32)
+    for i in range(nr0+2):
+        table[i] = gauss(r, r0grid[i], FWHM2sigma(wgrid)[:, np.newaxis]) @ K0.T
+    return table
+
+def gausstable_error(K0, r, table, n=1000, seed=0):
+    """
+    Returns the maximum absolute deviation between the signals interpolated from the
+    table and the exact signals K0@P, for n random single Gaussians with FWHMs of at
+    least two distance increments. Narrower Gaussians are not resolved by r, so that
+    K0@P itself jumps as their centers move between grid points.
+    """
+    rng = np.random.default_rng(seed)
+    r0_rel, w = rng.random(n), rng.uniform(max(_wmin, 2*(r[1]-r[0])), _wmax, n)
+    Vexact = gauss(r, (r0_rel*(max(r)-min(r)) + min(r))[:, np.newaxis], FWHM2sigma(w)[:, np.newaxis]) @ K0.T
+    return np.max(np.abs(_gaussinterp(table, r0_rel, w) - Vexact))
+
+def _gausssignals(table, r0_rel, w, a):
+    """
+    Sum of the signals of Gaussians with relative center distances r0_rel (between 0
+    and 1), FWHMs w and amplitudes a, interpolated from a gausstable.
+    Works for NumPy arrays and PyTensor tensors.
+    """
+    return (a[:, None]*_gaussinterp(table, r0_rel, w)).sum(axis=0)
+
+def _gaussinterp(table, r0_rel, w):
+    """
+    Signals of single Gaussians, bicubically (Catmull-Rom) interpolated from a
+    gausstable in r0_rel and log(w), so that the gradient is continuous.
+    """
+    nr0, nw = np.shape(table)[:2] if isinstance(table, np.ndarray) else table.get_value().shape[:2]
+    nr0, nw = nr0-2, nw-2
+    x = r0_rel*(nr0-1)
+    y = np.log(w/_wmin)/np.log(_wmax/_wmin)*(nw-1) if isinstance(w, np.ndarray) else pm.math.log(w/_wmin)/np.log(_wmax/_wmin)*(nw-1)
+    i = (x - x%1).clip(0, nr0-2).astype('int64')
+    j = (y - y%1).clip(0, nw-2).astype('int64')
+    wx, wy = _cubicweights(x-i), _cubicweights(y-j)
+    S = 0
+    for k in range(4):
+        for l in range(4):
+            S = S + (wx[k]*wy[l])[:, None]*table[i+k, j+l]
+    return S
+
+def _cubicweights(f):
+    """
+    Catmull-Rom weights of the four grid points around fractional positions f.
+    """
+    return [(-f**3 + 2*f**2 - f)/2, (3*f**3 - 5*f**2 + 2)/2, (-3*f**3 + 4*f**2 + f)/2, (f**3 - f**2)/2]
+
 def multigaussmodel(t, Vdata, K0, r, nGauss=1,
-        includeBackground=True, includeModDepth=True, includeAmplitude=True, bkgd_var="Bend"
+        includeBackground=True, includeModDepth=True, includeAmplitude=True, bkgd_var="Bend", table=None
     ):
     """
     Generates a PyMC model for a DEER signal over time vector t
     (in µs) given data in Vdata.
     It uses a multi-Gaussian distributions, where nGauss is the number
     of Gaussians, plus an exponential background.
+    If a signal table from gausstable is given, the time-domain signal is bicubically
+    interpolated from it in O(nt*nGauss) instead of calculated as K0@P.
+    t, r, K0 and Vdata are held in data containers and can be swapped with _setdata.
     """
 
     # Model definition
     with pm.Model() as model:
         
+        # Data containers
+        t = pm.MutableData('t', t)
+        r = pm.MutableData('r', r)
+        K0 = pm.MutableData('K0', K0)
+        Vdata = pm.MutableData('Vexp', Vdata)
+
         # Distance distribution parameters
         r0_rel = pm.Beta('r0_rel', alpha=2, beta=2, shape=nGauss)
-        r0 = pm.Deterministic('r0', r0_rel.sort()*(max(r)-min(r)) + min(r))  # for reporting
-        w = pm.TruncatedNormal('w', pm.InverseGamma('w_mu', alpha=0.1, beta=0.2, shape=nGauss), lower=0.05, upper=3.0, shape=nGauss)
+        r0 = pm.Deterministic('r0', r0_rel.sort()*(r.max()-r.min()) + r.min())  # for reporting
+        w = pm.TruncatedNormal('w', pm.InverseGamma('w_mu', alpha=0.1, beta=0.2, shape=nGauss), lower=_wmin, upper=_wmax, shape=nGauss)
         #w = pm.Truncated('w', pm.InverseGamma.dist(alpha=0.1, beta=0.5, shape=nGauss), lower=0.02, upper=4.0)   # Old definition
 
         if nGauss>1:
             a = pm.Dirichlet('a', a=np.ones(nGauss))
+        else:
+            a = np.ones(1, dtype=pt.config.floatX)
         
         # Calculate distance distribution
-        if nGauss==1:
-            P = gauss(r, r0, FWHM2sigma(w))
-        else:
-            P = np.zeros(np.size(K0,1))
-            for i in range(nGauss):
-                P += a[i]*gauss(r, r0[i], FWHM2sigma(w[i]))
+        P = multigauss(r, r0, FWHM2sigma(w), a)
         pm.Deterministic('P', P)  # for reporting
         
         # Time-domain model signal
-        Vmodel = pm.math.dot(K0,P)
+        if table is None:
+            Vmodel = pm.math.dot(K0,P)
+        else:
+            table = pm.MutableData('table', table)
+            Vmodel = _gausssignals(table, r0_rel.sort(), w, a)
 
         # Add modulation depth
         if includeModDepth:
@@ -142,11 +319,11 @@ def multigaussmodel(t, Vdata, K0, r, nGauss=1,
         if includeBackground:
             if bkgd_var == "k":
                 k = pm.Exponential("k", scale=0.1) # lambda = 10
-                Bend = pm.Deterministic("Bend", np.exp(0-k*t[-1])) # for reporting
+                Bend = pm.Deterministic("Bend", pm.math.exp(0-k*t[-1])) # for reporting
             else:
                 Bend = pm.Beta("Bend", alpha=1.0, beta=1.5)
-                k = pm.Deterministic('k', -np.log(Bend)/t[-1])  # for reporting
-            B = bg_exp(t,k)
+                k = pm.Deterministic('k', -pm.math.log(Bend)/t[-1])  # for reporting
+            B = pm.math.exp(-abs(t)*k)
             Vmodel *= B
 
         # Add overall amplitude
@@ -164,7 +341,7 @@ def multigaussmodel(t, Vdata, K0, r, nGauss=1,
     return model
 
 def regularizationmodel(t, Vdata, K0, L, LtL, r,
-        delta_prior=[1, 1e-6], tau_prior=[1, 1e-4],
+        delta_prior=[1, 1e-6], tau_prior=[1, 1e-4], lamb_prior=[1.3, 2.0], V0_prior=[1, 0.2], Bend_prior=[1.0, 1.5], k_scale=0.1,
         includeBackground=True, includeModDepth=True, includeAmplitude=True,
         tauGibbs=True, deltaGibbs=True, bkgd_var="Bend", alpha=None, allNUTS=False
     ):
@@ -178,12 +355,24 @@ def regularizationmodel(t, Vdata, K0, L, LtL, r,
       k      background decay rate constant (µs^-1)
       Bend   background decay value at end of time interval
       V0     overall amplitude
+    The priors of lamb (Beta), V0 (normal truncated at 0), Bend (Beta) and k
+    (exponential with scale k_scale) are set by lamb_prior, V0_prior, Bend_prior and
+    k_scale, which the Gibbs and slice samplers of these variables read from the
+    model parameters as well.
+    t, r, K0 and Vdata are held in data containers and can be swapped with _setdata.
     """
     
-    dr = r[1]-r[0]
+    nr = len(r)
     
     # Model definition
-    with pm.Model() as model:               
+    with pm.Model() as model:
+        # Data containers
+        t = pm.MutableData('t', t)
+        r = pm.MutableData('r', r)
+        K0 = pm.MutableData('K0', K0)
+        Vdata = pm.MutableData('Vexp', Vdata)
+        dr = r[1]-r[0]
+
         # Noise parameter
         if tauGibbs: # no prior (it's included in the Gibbs sampler)
             tau = pm.Flat('tau', initval=1.2)
@@ -211,12 +400,13 @@ def regularizationmodel(t, Vdata, K0, L, LtL, r,
             #constraint = (P >= 0).all()
             #nonnegativity = pm.Potential("P_nonnegative", pm.math.log(pm.math.switch(constraint, 1, 0)))
 
-            P_Dirichlet = pm.Dirichlet('P_Dirichlet', shape=len(r), a=np.ones(len(r))) # sums to 1
+            P_Dirichlet = pm.Dirichlet('P_Dirichlet', shape=nr, a=np.ones(nr)) # sums to 1
             P = pm.Deterministic('P', P_Dirichlet/dr) # integrates to 1
             n_p = len(np.nonzero(np.asarray(P))[0]) # nonzero points in P
-            smoothness = pm.Potential("P_smoothness", 0.5*n_p*np.log(delta)-0.5*delta*np.linalg.norm(L@P)**2)
+            LP = pt.sparse.structured_dot(pt.sparse.as_sparse_variable(L), P[:, None])
+            smoothness = pm.Potential("P_smoothness", 0.5*n_p*np.log(delta)-0.5*delta*pm.math.sum(LP**2))
         else:
-            P = pm.MvNormal('P', shape=len(r), mu=np.zeros(len(r)), cov=np.identity(len(r)))
+            P = pm.MvNormal('P', shape=nr, mu=np.zeros(nr), cov=np.identity(nr))
         
         # Time-domain model signal
         Vmodel = pm.math.dot(K0*dr,P)
@@ -231,23 +421,23 @@ def regularizationmodel(t, Vdata, K0, L, LtL, r,
                 # deterministic lamb and V0 for reporting
                 #V0 = pm.Deterministic('V0', b+c*pm.math.sum(P)*dr) # V0 = b+c after normalization
                 #lamb = pm.Deterministic('lamb', 1/(1+b/(c*pm.math.sum(P)*dr))) # lamb = 1/(1+b/c) after norm.
-            lamb = pm.Beta('lamb', alpha=1.3, beta=2.0, initval=0.2)
+            lamb = pm.Beta('lamb', alpha=lamb_prior[0], beta=lamb_prior[1], initval=0.2)
             Vmodel = (1-lamb) + lamb*Vmodel
 
         # Add background
         if includeBackground:
             if bkgd_var == "k":
-                k = pm.Exponential("k", scale=0.1) # lambda = 10
-                Bend = pm.Deterministic("Bend", np.exp(0-k*t[-1])) # for reporting
+                k = pm.Exponential("k", scale=k_scale)
+                Bend = pm.Deterministic("Bend", pm.math.exp(0-k*t[-1])) # for reporting
             else:
-                Bend = pm.Beta("Bend", alpha=1.0, beta=1.5)
-                k = pm.Deterministic('k', -np.log(Bend)/t[-1])  # for reporting
-            B = bg_exp(t,k)
+                Bend = pm.Beta("Bend", alpha=Bend_prior[0], beta=Bend_prior[1])
+                k = pm.Deterministic('k', -pm.math.log(Bend)/t[-1])  # for reporting
+            B = pm.math.exp(-abs(t)*k)
             Vmodel *= B
 
         # Add overall amplitude
         if includeAmplitude:
-            V0 = pm.TruncatedNormal('V0', mu=1, sigma=0.2, lower=0)
+            V0 = pm.TruncatedNormal('V0', mu=V0_prior[0], sigma=V0_prior[1], lower=0)
             Vmodel *= V0
         
         # Add likelihood
@@ -256,9 +446,113 @@ def regularizationmodel(t, Vdata, K0, L, LtL, r,
     return model
 
 
-def sample(model_dic, MCMCparameters, steporder=None, NUTSpars=None, seed=None):
+def _setdata(model_dic):
+    """
+    Loads the data and grids of model_dic into the data containers of its PyMC model.
+    """
+    pars = model_dic['pars']
+    newdata = {"t": pars['t'], "r": pars['r'], "K0": pars['K0'], "Vexp": pars['Vexp']}
+    if "table" in pars and pars["table"] is not None:
+        newdata["table"] = pars["table"]
+    newdata = {key: np.asarray(value, dtype=np.float32 if key == "table" else pars['dtype']) for key, value in newdata.items()}
+    with pt.config.change_flags(floatX=pars['dtype']):
+        pm.set_data(newdata, model=model_dic['model'])
+
+def _NUTS(model_pars, NUTS_varlist, NUTSpars, **kwargs):
+    """
+    Returns a NUTS step for the variables in NUTS_varlist. For cached models, the step
+    (and with it the compiled logp and gradient functions) is reused across datasets.
+    """
+    NUTSpars = {} if NUTSpars is None else NUTSpars
+    cachekey = model_pars['cachekey']
+    if cachekey is None:
+        return pm.NUTS(NUTS_varlist, **kwargs, **NUTSpars)
+    
+    stepkey = (cachekey, tuple(var.name for var in NUTS_varlist), repr(sorted(NUTSpars.items())), repr(sorted(kwargs.items())))
+    if stepkey not in _stepcache:
+        _stepcache[stepkey] = pm.NUTS(NUTS_varlist, **kwargs, **NUTSpars)
+    _stepcache.move_to_end(stepkey)
+    steps = [key for key in _stepcache if key[0] == cachekey]
+    for key in steps[:-_cachesize]:
+        del _stepcache[key]
+    return _stepcache[stepkey]
+
+def _cachemodel(cachekey, model_pymc):
+    """
+    Stores a model in the cache as the most recently used one, and drops the least
+    recently used models (and their NUTS steps) beyond _cachesize.
+    """
+    _modelcache[cachekey] = model_pymc
+    _modelcache.move_to_end(cachekey)
+    while len(_modelcache) > _cachesize:
+        oldkey, _ = _modelcache.popitem(last=False)
+        for key in [key for key in _stepcache if key[0] == oldkey]:
+            del _stepcache[key]
+
+def clearcache():
+    """
+    Removes all cached PyMC models and NUTS steps (with their compiled functions).
+    """
+    _modelcache.clear()
+    _stepcache.clear()
+
+def _modelprecision(function):
+    """
+    Decorator that runs function(model_dic, ...) with floatX set to the precision of
+    the model, so that steps are compiled and draws stored in that precision.
+    """
+    @functools.wraps(function)
+    def wrapper(model_dic, *args, **kwargs):
+        with pt.config.change_flags(floatX=model_dic['pars']['dtype']):
+            return function(model_dic, *args, **kwargs)
+    return wrapper
+
+@_modelprecision
+def sample(model_dic, MCMCparameters, steporder=None, NUTSpars=None, seed=None, multires=None, warmstart=False, stopping=None, P_summary=None, P_encoding=None, store_deterministics=True, tempering=None):
     """
     Use PyMC to draw samples from the posterior for the model, according to the parameters provided with MCMCparameters.
+
+    For the regularization models, multires = {"factor": 4, "tune": 1000} first tunes
+    and burns in the chains on a grid coarsened by factor (every factor-th r point),
+    and then starts the chains on the full grid from the last coarse draws, with P
+    interpolated to the full grid. MCMCparameters["tune"] then only sets the number
+    of tuning steps on the full grid.
+
+    With warmstart = True, the chains are started around a fast point estimate of the
+    parameters (see _pointestimate) instead of the fixed initial values of the model,
+    which allows for a considerably shorter tuning phase.
+
+    With stopping = {"block": 100, "rhat": 1.01, "ess_bulk": 400, "ess_tail": 400},
+    MCMCparameters["draws"] is only the budget: R-hat and bulk/tail ESS of the relevant
+    variables are checked after every block of draws, and sampling stops as soon as
+    the targets are met. stopping["max_time"] (in seconds) adds a wall-time budget, and
+    stopping["P_quantiles"] (e.g. [0.1, 0.5, 0.9]) also monitors the distances at these
+    quantiles of P. All chains run in parallel (cores is set to chains, with a warning
+    if they differ), and the reason for stopping is recorded in
+    idata.sample_stats.attrs["stopping_reason"]. A RuntimeError is raised if max_time
+    runs out before every chain has finished tuning.
+
+    With P_summary = {"thin": 10, "quantiles": [0.025, 0.5, 0.975]}, P is not stored for
+    every draw. Running means, variances and quantiles of P over all chains are kept
+    during sampling and stored in idata.P_summary, every thin-th draw of P is stored in
+    idata.P_thinned, and the mean distance and width of every draw are added to the
+    posterior as r_mean and r_width.
+
+    With P_encoding = "sparse" or "float16", the draws of P are returned in the compact
+    encoding of encodeP, which is decoded transparently by loadTrace,
+    drawPosteriorSamples and interpret.
+
+    With store_deterministics = False, the deterministics that can be recalculated from
+    the other variables (P of the Gaussian model, r0, Bend or k, sigma, lg_alpha and
+    lg_delta) are not stored. restoreDeterministics recalculates them (over the r and t
+    of the model, which are stored in posterior.attrs), which is done on access by
+    loadTrace, interpret and the plotting functions.
+
+    For the Gaussian model, tempering = {"nbetas": 8, "beta_min": 0.01, "leapfrog": 10}
+    samples by parallel tempering instead of NUTS, which lets the chains move between
+    the modes of multimodal posteriors (see paralleltempering). Of the other options,
+    only warmstart and P_encoding apply; stopping, P_summary and
+    store_deterministics = False raise a ValueError.
     """
     
     # Complain about missing required keywords
@@ -266,21 +560,54 @@ def sample(model_dic, MCMCparameters, steporder=None, NUTSpars=None, seed=None):
     for key in requiredKeys:
         if key not in MCMCparameters:
             raise KeyError(f"The required MCMC parameter '{key}' is missing.")
+
+    # Parallel tempering returns its own draws, without the callbacks and trace options
+    if tempering is not None:
+        unsupported = {"stopping": stopping is not None, "P_summary": P_summary is not None, "store_deterministics": not store_deterministics}
+        for key, used in unsupported.items():
+            if used:
+                raise ValueError(f"The option '{key}' is not available with parallel tempering.")
     
     # Supplement defaults for optional keywords
     defaults = {"cores": 2, "progressbar": True}
     MCMCparameters = {**defaults, **MCMCparameters}
+    if stopping is not None:
+        # The chains have to advance together for the convergence checks
+        if MCMCparameters["cores"] != MCMCparameters["chains"]:
+            warnings.warn(f"With stopping, all {MCMCparameters['chains']} chains run in parallel, so cores = {MCMCparameters['cores']} is ignored.")
+        MCMCparameters["cores"] = MCMCparameters["chains"]
     
     model = model_dic['model']
     model_pars = model_dic['pars']
     method = model_pars['method']
     bkgd_var = model_pars['background']
+
+    # Burn in on a coarse grid and start the chains from there
+    if multires is not None:
+        MCMCparameters = {**MCMCparameters, "initvals": _multires_initvals(model_dic, MCMCparameters, multires, steporder, NUTSpars, seed, warmstart)}
+    elif warmstart:
+        MCMCparameters = {"init": "adapt_diag", **MCMCparameters, "initvals": _warmstart_initvals(model_dic['pars'], MCMCparameters["chains"], seed)}
+
+    # Make sure the (possibly shared) model holds the data of this model_dic
+    _setdata(model_dic)
+
+    # Replica-exchange sampling
+    if tempering is not None:
+        if method != "gaussian":
+            raise ValueError("Parallel tempering is only available for the Gaussian model.")
+        idata = paralleltempering(model, MCMCparameters, tempering, seed)
+        idata.add_groups(observed_data={"V": model_pars['Vexp']})
+        for key in ["r0_rel", "w_mu"]:
+            del idata.posterior[key]
+        if P_encoding is not None:
+            idata = encodeP(idata, P_encoding)
+        return idata
     
     # Set stepping methods, depending on model
     if method == "gaussian":
-        
+    
         removeVars  = ["r0_rel", "w_mu"]
-        
+    
         with model:
             NUTS_varlist = [model['r0_rel'], model['w'], model['w_mu']]
             if model_pars['nGauss']>1:
@@ -289,68 +616,482 @@ def sample(model_dic, MCMCparameters, steporder=None, NUTSpars=None, seed=None):
             NUTS_varlist.append(model[bkgd_var])
             NUTS_varlist.append(model['V0'])
             NUTS_varlist.append(model['lamb'])
-            if NUTSpars is None:
-                step_NUTS = pm.NUTS(NUTS_varlist)
-            else:
-                step_NUTS = pm.NUTS(NUTS_varlist, **NUTSpars)
-    
+            step_NUTS = _NUTS(model_pars, NUTS_varlist, NUTSpars)
+
         step = [step_NUTS]
-        
+    
     elif method == "regularization":
-        
+    
         removeVars = ["lg_alpha"] if "alpha" in model_pars else None
-        
+    
         with model:
-            
+        
             conjstep_tau = randTau_posterior(model_pars)
-            conjstep_P = randPnorm_posterior(model_pars)
+            conjstep_P = _Psamplers[model_pars["P_sampler"]](model_pars)
+            step = [conjstep_tau, conjstep_P]
             if "alpha" not in model_pars:
                 conjstep_delta = randDelta_posterior(model_pars)
-            
-            NUTS_varlist = [model['V0'], model['lamb'], model[bkgd_var]]
-            if NUTSpars is None:
-                step_NUTS = pm.NUTS(NUTS_varlist, on_unused_input="ignore")
+                step.insert(1, conjstep_delta)
+        
+            # V0, lamb and the background are Gibbs-sampled or sampled by NUTS
+            NUTS_varlist = []
+            if model_pars["amp_sampler"] == "gibbs":
+                step.append(randAmp_posterior(model_pars))
             else:
-                step_NUTS = pm.NUTS(NUTS_varlist, on_unused_input="ignore", **NUTSpars)
-            
-        step = [conjstep_tau, conjstep_delta, conjstep_P, step_NUTS] if "alpha" not in model_pars else [conjstep_tau, conjstep_P, step_NUTS]
+                NUTS_varlist.extend([model['V0'], model['lamb']])
+            if model_pars["bkgd_sampler"] == "slice":
+                step.append(randBkgd_posterior(model_pars))
+            else:
+                NUTS_varlist.append(model[bkgd_var])
+            if NUTS_varlist:
+                step.append(_NUTS(model_pars, NUTS_varlist, NUTSpars, on_unused_input="ignore"))
+        
         if steporder is not None:
             step = [step[i] for i in steporder]
-        
+    
     elif method == "regularizationP":
-        
+    
         removeVars = None
-        
+    
         with model:
-                
-            conjstep_P = randPnorm_posterior(model_pars)
             
-            NUTS_varlist = [model['tau'], model['delta'], model[bkgd_var], model['V0'], model['lamb']]
-            if NUTSpars is None:
-                step_NUTS = pm.NUTS(NUTS_varlist)
+            conjstep_P = _Psamplers[model_pars["P_sampler"]](model_pars)
+            step = [conjstep_P]
+        
+            NUTS_varlist = [model['tau'], model['delta']]
+            if model_pars["bkgd_sampler"] == "nuts":
+                NUTS_varlist.append(model[bkgd_var])
+            if model_pars["amp_sampler"] == "gibbs":
+                step.append(randAmp_posterior(model_pars))
             else:
-                step_NUTS = pm.NUTS(NUTS_varlist, **NUTSpars)
-                
-        step = [conjstep_P, step_NUTS]
+                NUTS_varlist.extend([model['V0'], model['lamb']])
+            if model_pars["bkgd_sampler"] == "slice":
+                step.append(randBkgd_posterior(model_pars))
+            step.append(_NUTS(model_pars, NUTS_varlist, NUTSpars))
+            
         if steporder is not None:
             step = [step[i] for i in steporder]
 
     elif method == "regularization_NUTS":
-        
+    
         removeVars = None
         step = None
-            
-    else:
         
+    else:
+    
         raise KeyError(f"Unknown method '{method}'.",method)
 
+    # Summarize P and check convergence while sampling
+    callbacks = []
+    tracevars = model.unobserved_value_vars
+    if P_summary is not None:
+        summary = _PSummary(model, model_pars['r'], MCMCparameters["chains"], P_summary)
+        callbacks.append(summary)
+        tracevars = summary.tracevars
+    if not store_deterministics:
+        dropped = [var.name for var in model.deterministics if var.name in _recomputable]
+        tracevars = [var for var in tracevars if var.name not in dropped]
+        if removeVars is not None:
+            removeVars = [var for var in removeVars if var != "r0_rel"]  # needed for r0
+    if [var.name for var in tracevars] != [var.name for var in model.unobserved_value_vars]:
+        MCMCparameters = {**MCMCparameters, "trace": _NDArray(model=model, vars=tracevars)}
+    if stopping is not None:
+        monitor = _ConvergenceMonitor(model, model_pars['r'], MCMCparameters["chains"], stopping)
+        callbacks.append(monitor)
+    if callbacks:
+        MCMCparameters = {**MCMCparameters, "callback": lambda trace, draw: [callback(trace, draw) for callback in callbacks]}
+
     # Perform MCMC sampling
     idata = pm.sample(model=model, step=step, random_seed=seed, **MCMCparameters)
 
+    if P_summary is not None:
+        summary.store(idata)
+    if not store_deterministics:
+        idata.posterior.attrs.update({"dropped_deterministics": ",".join(dropped), "deterministics_r": model_pars['r'], "deterministics_t": model_dic['t']})
+    if stopping is not None:
+        print(f"Stopped after {idata.posterior.dims['draw']} draws: {monitor.reason}")
+        idata.sample_stats.attrs.update({"stopping_reason": monitor.reason, **monitor.diagnostics})
+
     # Remove undesired variables
     if removeVars is not None:
         for key in removeVars:
             if key in idata.posterior:
                 del idata.posterior[key]
 
+    # The data containers (kernel and grids) are in model_dic and need not be in the trace
+    if "constant_data" in idata.groups():
+        del idata.constant_data
+
+    if P_encoding is not None and "P" in idata.posterior:
+        idata = encodeP(idata, P_encoding)
+
     return idata
+
+class _ConvergenceMonitor:
+    """
+    Callback for pm.sample that collects the draws of all chains, checks R-hat and
+    bulk/tail ESS of the relevant variables after every block of draws, and stops
+    sampling (by raising KeyboardInterrupt) once the targets are met or the wall-time
+    budget is exhausted.
+    """
+
+    def __init__(self, model, r, chains, stopping):
+        defaults = {"block": 100, "rhat": 1.01, "ess_bulk": 400, "ess_tail": 400, "max_time": None, "P_quantiles": None}
+        self.pars = {**defaults, **stopping}
+        self.r = r
+        self.chains = chains
+        self.start = time.time()
+        self.reason = "draws budget exhausted"
+        self.diagnostics = {}
+
+        # Function to calculate the (untransformed) variables from a point;
+        # P is only needed for its quantiles
+        outs = [var for var in model.unobserved_value_vars if not var.name.endswith("__")]
+        if self.pars["P_quantiles"] is None:
+            outs = [var for var in outs if var.name not in ["P", "P_Dirichlet"]]
+        self.names = [var.name for var in outs]
+        self.fn = model.compile_fn(outs, inputs=model.value_vars, on_unused_input="ignore", point_fn=True)
+
+        self.draws = [{name: [] for name in self.names} for chain in range(chains)]
+        self.nextcheck = self.pars["block"]
+
+    def __call__(self, trace, draw):
+        if self.pars["max_time"] is not None and time.time() - self.start > self.pars["max_time"]:
+            if draw.tuning or any(not chain[self.names[0]] for chain in self.draws):
+                raise RuntimeError(f"The time budget of {self.pars['max_time']:g} s ran out during tuning, before every chain had a draw. Increase stopping['max_time'] or reduce MCMCparameters['tune'].")
+            self.reason = "time budget exhausted"
+            raise KeyboardInterrupt()
+        if draw.tuning:
+            return
+
+        for name, value in zip(self.names, self.fn(draw.point)):
+            self.draws[draw.chain][name].append(value)
+
+        ndraws = min(len(chain[self.names[0]]) for chain in self.draws)
+        if ndraws >= self.nextcheck:
+            self.nextcheck += self.pars["block"]
+            if self._converged(ndraws):
+                self.reason = "convergence targets met"
+                raise KeyboardInterrupt()
+
+    def _converged(self, ndraws):
+        posterior = {name: np.array([chain[name][:ndraws] for chain in self.draws]) for name in self.names}
+        if self.pars["P_quantiles"] is not None:
+            P = posterior["P"]
+            cdf = np.cumsum(P, axis=-1)/np.sum(P, axis=-1, keepdims=True)
+            posterior["P_quantiles"] = np.apply_along_axis(lambda c: np.interp(self.pars["P_quantiles"], c, self.r), -1, cdf)
+        idata = az.from_dict(posterior=posterior)
+
+        var_names = _relevantVariables(idata)
+        if self.pars["P_quantiles"] is not None:
+            var_names.append("P_quantiles")
+        rhat = max(float(az.rhat(idata, var_names=var_names)[var].max()) for var in var_names) if self.chains > 1 else 1.0
+        ess_bulk = min(float(az.ess(idata, var_names=var_names, method="bulk")[var].min()) for var in var_names)
+        ess_tail = min(float(az.ess(idata, var_names=var_names, method="tail")[var].min()) for var in var_names)
+        self.diagnostics = {"stopping_rhat": rhat, "stopping_ess_bulk": ess_bulk, "stopping_ess_tail": ess_tail}
+
+        return rhat <= self.pars["rhat"] and ess_bulk >= self.pars["ess_bulk"] and ess_tail >= self.pars["ess_tail"]
+
+class _NDArray(pm.backends.NDArray):
+    """
+    NDArray backend for a subset of the variables. pm.sample gives every chain a
+    shallow copy of the backend, so the sample arrays are created per copy here;
+    otherwise all chains would write into the same arrays.
+    """
+
+    def setup(self, draws, chain, sampler_vars=None):
+        self.samples = {}
+        super().setup(draws, chain, sampler_vars)
+
+class _PSummary:
+    """
+    Callback for pm.sample that keeps running summaries of P over all chains (mean and
+    variance with Welford's method, quantiles with the P-square algorithm), the mean
+    distance and width of every draw, and every thin-th draw of P.
+    """
+
+    def __init__(self, model, r, chains, pars):
+        defaults = {"thin": 10, "quantiles": [0.025, 0.5, 0.975]}
+        self.pars = {**defaults, **pars}
+        self.r = r
+        self.dr = r[1]-r[0]
+
+        # Everything but the grid-sized variables goes into the trace
+        self.tracevars = [var for var in model.unobserved_value_vars if var.name not in ["P", "P_Dirichlet"]]
+        P = [var for var in model.unobserved_value_vars if var.name == "P"][0]
+        self.fn = model.compile_fn(P, inputs=model.value_vars, on_unused_input="ignore", point_fn=True)
+
+        self.n = 0
+        self.mean = np.zeros(len(r))
+        self.M2 = np.zeros(len(r))
+        self.quantiles = [_P2Quantile(q, len(r)) for q in self.pars["quantiles"]]
+        self.moments = [{"r_mean": [], "r_width": []} for chain in range(chains)]
+        self.thinned = [[] for chain in range(chains)]
+
+    def __call__(self, trace, draw):
+        if draw.tuning:
+            return
+
+        P = np.asarray(self.fn(draw.point), dtype=float)
+        P = P/np.sum(P)/self.dr
+
+        self.n += 1
+        diff = P - self.mean
+        self.mean += diff/self.n
+        self.M2 += diff*(P - self.mean)
+        for quantile in self.quantiles:
+            quantile.update(P)
+
+        moments = self.moments[draw.chain]
+        if (len(moments["r_mean"]) % self.pars["thin"]) == 0:
+            self.thinned[draw.chain].append(P)
+        r_mean = np.sum(self.r*P)*self.dr
+        moments["r_mean"].append(r_mean)
+        moments["r_width"].append(np.sqrt(np.sum((self.r-r_mean)**2*P)*self.dr))
+
+    def store(self, idata):
+        """
+        Adds the summaries to idata (trimmed to the draws kept by pm.sample).
+        """
+        ndraws = idata.posterior.dims["draw"]
+        chains = idata.posterior.chain.values
+        for name in ["r_mean", "r_width"]:
+            idata.posterior[name] = (("chain", "draw"), np.array([self.moments[chain][name][:ndraws] for chain in chains]))
+
+        draws = np.arange(0, ndraws, self.pars["thin"])
+        thinned = np.array([self.thinned[chain][:len(draws)] for chain in chains])
+        idata.add_groups({
+            "P_thinned": xr.Dataset({"P": (("chain", "draw", "P_dim_0"), thinned)}, coords={"chain": chains, "draw": draws}),
+            "P_summary": xr.Dataset(
+                {"mean": ("r", self.mean), "var": ("r", self.M2/max(self.n-1, 1)),
+                 "quantiles": (("quantile", "r"), np.array([quantile.value() for quantile in self.quantiles]))},
+                coords={"r": self.r, "quantile": self.pars["quantiles"]}),
+        })
+
+class _P2Quantile:
+    """
+    Streaming estimate of the p-quantile of every element of a vector, with the
+    P-square algorithm (five markers per element, no draws stored).
+
+    R. Jain, I. Chlamtac, The P2 algorithm for dynamic calculation of quantiles and
+    histograms without storing observations, Commun. ACM 28 (1985) 1076-1085
+    """
+
+    def __init__(self, p, n):
+        self.p = p
+        self.first = []
+        self.q = None
+        self.npos = np.tile(np.arange(1, 6, dtype=float)[:, None], (1, n))
+        self.ndes = np.array([1, 1+2*p, 1+4*p, 3+2*p, 5])
+        self.dn = np.array([0, p/2, p, (1+p)/2, 1])
+
+    def update(self, x):
+        # The first five observations initialize the markers
+        if self.q is None:
+            self.first.append(x.copy())
+            if len(self.first) == 5:
+                self.q = np.sort(np.array(self.first), axis=0)
+            return
+
+        q, npos = self.q, self.npos
+        q[0] = np.minimum(q[0], x)
+        q[4] = np.maximum(q[4], x)
+        k = np.sum(x >= q[1:4], axis=0)
+        npos += np.arange(5)[:, None] > k
+        self.ndes += self.dn
+
+        # Adjust the heights of the middle markers
+        with np.errstate(divide="ignore", invalid="ignore"):
+            for i in range(1, 4):
+                d = self.ndes[i] - npos[i]
+                move = ((d >= 1) & (npos[i+1]-npos[i] > 1)) | ((d <= -1) & (npos[i-1]-npos[i] < -1))
+                s = np.sign(d)
+                parabolic = q[i] + s/(npos[i+1]-npos[i-1])*((npos[i]-npos[i-1]+s)*(q[i+1]-q[i])/(npos[i+1]-npos[i]) + (npos[i+1]-npos[i]-s)*(q[i]-q[i-1])/(npos[i]-npos[i-1]))
+                j = np.where(s > 0, i+1, i-1)
+                qj = np.take_along_axis(q, j[None, :], 0)[0]
+                nj = np.take_along_axis(npos, j[None, :], 0)[0]
+                linear = q[i] + s*(qj-q[i])/(nj-npos[i])
+                q[i] = np.where(move, np.where((q[i-1] < parabolic) & (parabolic < q[i+1]), parabolic, linear), q[i])
+                npos[i] += np.where(move, s, 0)
+
+    def value(self):
+        if self.q is None:
+            return np.quantile(np.array(self.first), self.p, axis=0)
+        return self.q[2]
+
+def _multires_initvals(model_dic, MCMCparameters, multires, steporder=None, NUTSpars=None, seed=None, warmstart=False):
+    """
+    Samples the regularization model in model_dic on a coarsened r grid and returns
+    a list with the last draw of every chain, transferred to the full grid.
+    """
+    model_pars = model_dic['pars']
+    method = model_pars['method']
+    if method == "gaussian":
+        raise ValueError("Multi-resolution sampling is only available for the regularization models.")
+
+    factor = multires["factor"] if "factor" in multires else 4
+    tune = multires["tune"] if "tune" in multires else MCMCparameters["tune"]
+    bkgd_var = model_pars['background']
+    r = model_pars['r']
+
+    # Coarse model with the same settings
+    r_coarse = r[::factor]
+    pars = {"method": method, "r": r_coarse, "bkgd_var": bkgd_var, "dtype": model_pars['dtype'],
+            "P_sampler": model_pars['P_sampler'], "amp_sampler": model_pars['amp_sampler'], "bkgd_sampler": model_pars['bkgd_sampler'], "reuse": model_pars['cachekey'] is not None}
+    for key in ["alpha", "P_support"]:
+        if key in model_pars:
+            pars[key] = model_pars[key]
+    coarse_dic = model(model_pars['t'], model_pars['Vexp'], pars)
+
+    print(f"Coarse burn-in:     {tune} steps on {len(r_coarse)} of {len(r)} distance points")
+    coarse = sample(coarse_dic, {**MCMCparameters, "tune": tune, "draws": 1}, steporder, NUTSpars, seed, warmstart=warmstart)
+    last = coarse.posterior.isel(draw=-1)
+
+    # The smoothness penalty |L P|^2 scales with dr^3
+    delta_scale = (coarse_dic['pars']['dr']/model_pars['dr'])**3
+
+    variables = [bkgd_var, "V0", "lamb", "tau"]
+    if "alpha" not in model_pars:
+        variables.append("delta")
+
+    initvals = []
+    for chain in last.chain.values:
+        init = {var: last[var].values[chain] for var in variables}
+        if "delta" in init:
+            init["delta"] = init["delta"]*delta_scale
+
+        P = np.interp(r, r_coarse, last["P"].values[chain])
+        P = np.maximum(P, 0)
+        P = P/np.sum(P)/model_pars['dr']
+        if method == "regularization_NUTS":
+            # keep the Dirichlet initial value inside the simplex
+            P_Dirichlet = np.maximum(P*model_pars['dr'], 1e-8)
+            init["P_Dirichlet"] = P_Dirichlet/np.sum(P_Dirichlet)
+        else:
+            init["P"] = P
+        initvals.append({var: np.asarray(value, dtype=model_pars['dtype']) for var, value in init.items()})
+
+    return initvals
+
+def _pointestimate(model_pars):
+    """
+    Returns a fast point estimate of V0, lamb, k, sigma, alpha and P for the (scaled)
+    data in model_pars:
+      sigma          from the differences of neighboring points
+      k, V0, lamb    from a log-linear fit of the second half of the signal
+      P, alpha       by non-negative Tikhonov regularization (fnnls), with alpha
+                     chosen by the discrepancy principle
+    For the Gaussian model, r0, w and a are additionally obtained from a
+    least-squares fit started from the regularized P.
+    """
+    t = model_pars['t']
+    V = np.asarray(model_pars['Vexp'], dtype=float)
+    r = model_pars['r']
+    dr = model_pars['dr']
+    method = model_pars['method']
+    K0 = np.asarray(model_pars['K0'], dtype=float)
+    if method != "gaussian":
+        K0 = K0*dr
+
+    # Noise level from the second differences of the (smooth) second half of the signal
+    tail = t >= t[-1]/2
+    sigma = np.std(np.diff(V[tail], 2))/np.sqrt(6)
+
+    # Initial background and modulation depth from a log-linear fit of the second half
+    slope, intercept = np.polyfit(t[tail], np.log(np.clip(V[tail], 1e-3, None)), 1)
+    k = max(-slope, 1e-3)
+    V0 = np.mean(V[np.argsort(np.abs(t))[:3]])
+    lamb = np.clip(1 - np.exp(intercept)/V0, 0.05, 0.95)
+
+    L = regoperator(len(r))
+    LtL = (L.T@L).toarray()
+    for iteration in range(3):
+        # Regularized P, for decreasing alpha until the residual reaches the noise level
+        B = bg_exp(t, k)
+        K = V0*lamb*B[:, np.newaxis]*K0
+        Vintra = V - V0*(1-lamb)*B
+        KtK = K.T@K
+        KtV = K.T@Vintra
+        for alpha in np.logspace(2, -3, 21):
+            P = fnnls(KtK + alpha**2*LtL, KtV)
+            if np.sqrt(np.mean((Vintra - K@P)**2)) <= 1.05*sigma:
+                break
+        P = P/np.sum(P)/dr
+
+        # Refit background and modulation depth for this P
+        KP = K0@P
+        x = least_squares(lambda x: V - x[0]*bg_exp(t, x[2])*((1-x[1]) + x[1]*KP), [V0, lamb, k], bounds=([0, 0, 0], [np.inf, 1, np.inf])).x
+        V0, lamb, k = x[0], np.clip(x[1], 0.01, 0.99), max(x[2], 1e-3)
+
+    estimate = {"V0": V0, "lamb": lamb, "k": k, "sigma": sigma, "alpha": alpha, "P": P}
+
+    if method == "gaussian":
+        nGauss = model_pars['nGauss']
+        cdf = np.cumsum(P)*dr
+        B = bg_exp(t, k)
+        r0 = np.interp((np.arange(nGauss)+0.5)/nGauss, cdf, r)
+        w = np.full(nGauss, 0.5)
+        a = np.ones(nGauss)/nGauss
+
+        def residuals(x):
+            r0, w, a, V0, lamb = x[:nGauss], x[nGauss:2*nGauss], x[2*nGauss:3*nGauss], x[-2], x[-1]
+            P = multigauss(r, r0, FWHM2sigma(w), a/np.sum(a))
+            return V - V0*B*((1-lamb) + lamb*(K0@P))
+
+        x0 = np.concatenate([r0, w, a, [V0, lamb]])
+        lower = np.concatenate([np.full(nGauss, r.min()), np.full(nGauss, _wmin), np.full(nGauss, 1e-3), [0, 0]])
+        upper = np.concatenate([np.full(nGauss, r.max()), np.full(nGauss, _wmax), np.ones(nGauss), [np.inf, 1]])
+        x = least_squares(residuals, np.clip(x0, lower, upper), bounds=(lower, upper)).x
+        order = np.argsort(x[:nGauss])
+        estimate.update({"r0": x[:nGauss][order], "w": x[nGauss:2*nGauss][order], "a": x[2*nGauss:3*nGauss][order]/np.sum(x[2*nGauss:3*nGauss]), "V0": x[-2], "lamb": x[-1]})
+
+    return estimate
+
+def _warmstart_initvals(model_pars, chains, seed=None, spread=0.1):
+    """
+    Returns a list of initial values for every chain, spread around the point estimate
+    of _pointestimate by relative random perturbations of size spread.
+    """
+    method = model_pars['method']
+    bkgd_var = model_pars['background']
+    r = model_pars['r']
+    dr = model_pars['dr']
+    t = model_pars['t']
+    estimate = _pointestimate(model_pars)
+    print(f"Warm start:         V0 = {estimate['V0']:.3g}, lamb = {estimate['lamb']:.3g}, k = {estimate['k']:.3g}, sigma = {estimate['sigma']:.3g}, alpha = {estimate['alpha']:.3g}")
+
+    rng = np.random.default_rng(seed)
+    def perturb(x):
+        return x*np.exp(spread*rng.standard_normal(np.shape(x)))
+
+    initvals = []
+    for chain in range(chains):
+        k = perturb(estimate['k'])
+        init = {
+            "V0": perturb(estimate['V0']),
+            "lamb": np.clip(perturb(estimate['lamb']), 0.01, 0.99),
+            bkgd_var: k if bkgd_var == "k" else np.clip(np.exp(-k*t[-1]), 0.01, 0.99),
+        }
+        sigma = perturb(estimate['sigma'])
+
+        if method == "gaussian":
+            r0_rel = (estimate['r0']-r.min())/(r.max()-r.min())
+            w = np.clip(perturb(estimate['w']), 1.01*_wmin, 0.99*_wmax)
+            init.update({"r0_rel": np.sort(np.clip(perturb(r0_rel), 0.01, 0.99)), "w": w, "w_mu": w, "sigma": sigma})
+            if model_pars['nGauss'] > 1:
+                a = perturb(estimate['a'])
+                init["a"] = a/np.sum(a)
+        else:
+            tau = 1/sigma**2
+            init["tau"] = tau
+            if "alpha" not in model_pars:
+                init["delta"] = perturb(estimate['alpha'])**2*tau
+            P = perturb(np.maximum(estimate['P'], 1e-6*np.max(estimate['P'])))
+            if method == "regularization_NUTS":
+                init["P_Dirichlet"] = P/np.sum(P)
+            else:
+                init["P"] = P/np.sum(P)/dr
+
+        initvals.append({var: np.asarray(value, dtype=model_pars['dtype']) for var, value in init.items()})
+
+    return initvals
@@ -3,15 +3,19 @@
 # Import modules
 from matplotlib.backend_bases import key_press_handler
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.colors import to_rgb
 import numpy as np
 import random
+import hashlib
 import arviz as az
+import xarray as xr
 from IPython.display import display
 import deerlab as dl
 from scipy.io import loadmat
 
-from .utils import *
 from .deer import *
+from .encoding import *
 
 
 def _relevantVariables(trace):
@@ -42,6 +46,7 @@ def printsummary(trace, model_dic):
     Print table of all parameters, including their means, standard deviations,
     effective sample sizes, Monte Carlo standard errors, and R-hat diagnostics.
     """
+    trace = restoreDeterministics(trace)
     Vars = _relevantVariables(trace)
     with model_dic['model']:
         summary = az.summary(trace, var_names=Vars)
@@ -54,6 +59,7 @@ def plotmarginals(trace, GroundTruth=None, plot_args={"hdi_prob":"hide"}):
     """
     Plot marginalized posteriors
     """
+    trace = restoreDeterministics(trace)
     Vars = _relevantVariables(trace)
     plot = az.plot_posterior(trace, var_names=Vars, **plot_args)
     for ax in plot.flatten():
@@ -68,11 +74,14 @@ def plotmarginals(trace, GroundTruth=None, plot_args={"hdi_prob":"hide"}):
 
     return plot
 
-def plotcorrelations(trace, model_dic, figsize=None, marginals=True, div=False):
+def plotcorrelations(trace, model_dic, figsize=None, marginals=True, div=False, max_points=5000, bins=50):
     """
     Matrix of pairwise correlation plots between model parameters.
+    Traces with more than max_points draws are shown as 2D histograms instead of KDEs
+    (see _pairgrid).
     """
     # determine variables to include
+    trace = restoreDeterministics(trace)
     Vars = _relevantVariables(trace)
     nVars = len(Vars)
     
@@ -82,6 +91,10 @@ def plotcorrelations(trace, model_dic, figsize=None, marginals=True, div=False):
             figsize = (7, 7)
         else:
             figsize = (10, 10)
+    nDraws = trace.posterior.dims["chain"]*trace.posterior.dims["draw"]
+    if nDraws > max_points:
+        return _pairgrid(trace, Vars, figsize, marginals, div, bins)
+
     if div == True:
         class Object(object):
             pass
@@ -116,6 +129,84 @@ def plotcorrelations(trace, model_dic, figsize=None, marginals=True, div=False):
 
     return fig
 
+def _pairgrid(trace, Vars, figsize, marginals=True, div=False, bins=50):
+    """
+    Matrix of pairwise 2D histograms (with histograms on the diagonal) for large traces.
+    The bin edges of every variable are calculated once in a shared pass over the
+    trace, and the histograms are rasterized. Divergent draws are overlaid if div.
+    """
+    # one column per scalar parameter
+    posterior = az.extract(trace, var_names=Vars)
+    columns, labels = [], []
+    for var in Vars:
+        values = posterior[var].values
+        if values.ndim > 1:
+            for i in range(values.shape[0]):
+                columns.append(values[i])
+                labels.append(f"{var}[{i}]")
+        else:
+            columns.append(values)
+            labels.append(var)
+    data = np.array(columns)
+
+    # shared binning pass
+    limits = np.nanquantile(data, [0.001, 0.999], axis=1)
+    edges = [np.linspace(low, high, bins+1) for low, high in limits.T]
+
+    diverging = None
+    if div and "sample_stats" in trace.groups() and "diverging" in trace.sample_stats:
+        diverging = az.extract(trace, group="sample_stats", var_names=["diverging"]).values.astype(bool)
+
+    n = len(columns)
+    fig, axs = plt.subplots(n, n, figsize=figsize, squeeze=False, sharex="col")
+    for i in range(n):
+        for j in range(n):
+            ax = axs[i, j]
+            if j > i or (i == j and not marginals):
+                ax.axis("off")
+                continue
+            if i == j:
+                ax.hist(data[i], bins=edges[i], color="C0")
+            else:
+                H, _, _ = np.histogram2d(data[j], data[i], bins=[edges[j], edges[i]])
+                ax.pcolormesh(edges[j], edges[i], np.ma.masked_equal(H.T, 0), cmap="Blues", rasterized=True)
+                if diverging is not None:
+                    ax.plot(data[j][diverging], data[i][diverging], "o", color="C3", alpha=0.4, markersize=3)
+            if i == n-1:
+                ax.set_xlabel(_betterLabels(labels[j]))
+            else:
+                ax.tick_params(labelbottom=False)
+            if j == 0 and i > 0:
+                ax.set_ylabel(_betterLabels(labels[i]))
+            else:
+                ax.tick_params(labelleft=False)
+
+    return fig
+
+def _subsample(n, max_points, rng=0):
+    """
+    Returns the (sorted) indices of a random subset of at most max_points of n points.
+    """
+    if n <= max_points:
+        return np.arange(n)
+    return np.sort(np.random.default_rng(rng).choice(n, max_points, replace=False))
+
+def _scatter(ax, x, y, marker=".", max_points=5000, **kwargs):
+    """
+    Plots the points (x, y), subsampled to at most max_points, and rasterized if
+    there are many of them.
+    """
+    x, y = np.asarray(x), np.asarray(y)
+    idx = _subsample(len(x), max_points)
+    return ax.plot(x[idx], y[idx], marker, linestyle="None", rasterized=len(idx) > 1000, **kwargs)
+
+def _density(ax, x, y, bins=50, cmap="Greys"):
+    """
+    Plots the density of the points (x, y) as a rasterized 2D histogram.
+    """
+    H, xedges, yedges = np.histogram2d(np.asarray(x), np.asarray(y), bins=bins)
+    return ax.pcolormesh(xedges, yedges, np.ma.masked_equal(H.T, 0), cmap=cmap, rasterized=True)
+
 def summary(trace, model_dic):
     
     printsummary(trace, model_dic)
@@ -163,7 +254,8 @@ def plotresult(trace, model_dic, nDraws=100, rng=0, Pid=None, Pref=None, rref=No
     r = model_dic['pars']['r']
     
     Ps, Vs, Bs, _, _ = drawPosteriorSamples(trace, nDraws, r, t, rng)
-    fig = plotMCMC(Ps, Vs, Bs, Vexp, t, r, Pref, rref, show_ave, colors)
+    summary = posteriorPredictive(trace, model_dic) if show_ave is not None else None
+    fig = plotMCMC(Ps, Vs, Bs, Vexp, t, r, Pref, rref, show_ave, colors, summary)
 
     return fig, fig1
 
@@ -218,90 +310,184 @@ def _betterLabels(x):
         return [_table.get(x_,x_) for x_ in x]
 
 
+def _thinnedtrace(trace):
+    """
+    Returns the trace restricted to the draws with stored P, if P was only stored for
+    a thinned subset of the draws (see sample(..., P_summary=...)).
+    """
+    if "P" in trace.posterior or "P_thinned" not in trace.groups():
+        return trace
+    posterior = trace.posterior.sel(draw=trace.P_thinned.draw).assign(P=trace.P_thinned.P)
+    return az.InferenceData(posterior=posterior)
+
 def drawPosteriorSamples(trace, nDraws=100, r=np.linspace(2, 8, num=200), t=None, rng=0):
     # Extracts (nDraws) random samples from the trace and reshapes it to work nicely
+    trace = _thinnedtrace(restoreDeterministics(decodeP(trace)))
+    nDraws = min(nDraws, trace.posterior.dims["chain"]*trace.posterior.dims["draw"])
     varDict = az.extract(trace, num_samples=nDraws, rng=rng).transpose("sample", ...)
 
-    # Draw P's -------------------------------------------------------------------
-    Ps = []
-    # Determine if a Gaussian model was used
-    GaussianModel = "r0" in varDict
-    if GaussianModel:
-        # if gaussian, build P from r0 (mean), w (width), and a (amplitude)
-        r0_vecs = varDict["r0"].values
-        w_vecs = varDict["w"].values
-        if "a" in varDict:
-            a_vecs = varDict["a"].values
-        else:
-            a_vecs = np.ones(nDraws)
-        for iDraw in range(nDraws):
-            P = dd_gauss(r,r0_vecs[iDraw],w_vecs[iDraw],a_vecs[iDraw])
-            Ps.append(P)
-    else:
-        # if regularization, simply take P from model
-        for iDraw in range(nDraws):
-            P = varDict["P"][iDraw]
-            # normalize P
-            P /= (r[1]-r[0])*P.sum()
-            Ps.append(P.values)
-
-    # Rename time-domain parameters to make code below cleaner -------------------------
-    if 'V0' in varDict:
-        V0 = varDict["V0"].values
-    if 'k' in varDict:
-        k = varDict["k"].values
-    if 'Bend' in varDict:
-        Bend = varDict["Bend"].values   
-    if 'tauB' in varDict:
-        tauB = varDict["tauB"].values
-    if 'lamb' in varDict:
-        lamb = varDict["lamb"].values
-
-    # Generate V's and B's from P's and other parameters --------------------------------
-    Vs = []
-    Bs = []
+    # Generate P's, V's and B's for all draws at once
     K0 = dl.dipolarkernel(t, r, integralop=False)
+    P, V, B = _ensemble(varDict, r, t, K0)
+
+    return list(P), list(V), list(B), t, r
+
+def _ensemble(posterior, r, t, K0):
+    """
+    Returns the distance distributions P, the signals V and the backgrounds B
+    (including amplitude and modulation depth), one row per draw, for the draws
+    in posterior (with the draws along the first dimension).
+    """
     dr = r[1] - r[0]
 
-    for iDraw in range(nDraws):
-        V_ = dr*K0@Ps[iDraw]
+    if "r0" in posterior:
+        # Gaussian model: build P from r0 (mean), w (width), and a (amplitude)
+        r0 = posterior["r0"].values
+        a = posterior["a"].values if "a" in posterior else np.ones_like(r0)
+        P = dd_gauss(r, r0, posterior["w"].values, a)
+    else:
+        # regularization: take P from model, normalized
+        P = posterior["P"].values.astype(float)
+        P = P/(dr*P.sum(axis=-1, keepdims=True))
+
+    if "Bend" in posterior:
+        B = bg_exp(t, -np.log(posterior["Bend"].values[:, np.newaxis])/t[-1])
+    elif "tauB" in posterior:
+        B = bg_exp_time(t, posterior["tauB"].values[:, np.newaxis])
+    else:
+        B = bg_exp(t, posterior["k"].values[:, np.newaxis])
 
-        if 'lamb' in varDict:
-            V_ = (1-lamb[iDraw]) + lamb[iDraw]*V_
+    lamb = posterior["lamb"].values[:, np.newaxis]
+    V0 = posterior["V0"].values[:, np.newaxis] if "V0" in posterior else 1
 
-        if 'Bend' in varDict:
-            k = -1/t[-1]*np.log(Bend[iDraw])
-            B = bg_exp(t,k)
-        elif 'tauB' in varDict:
-            B = bg_exp_time(t,tauB[iDraw])
-        else:
-            B = bg_exp(t,k[iDraw])
-        
-        V_ *= B
-        Blamb = (1-lamb[iDraw])*B
-            
-        if 'V0' in varDict:
-            Blamb *= V0[iDraw]
-        Bs.append(Blamb)
-        
-        if 'tauB' in varDict:
-            B = bg_exp_time(t,tauB[iDraw])
-            V_ *= B
+    V = V0*B*((1-lamb) + lamb*dr*P@K0.T)
+    Blamb = V0*(1-lamb)*B
 
-            Blamb = (1-lamb[iDraw])*B
-            if 'V0' in varDict:
-                Blamb *= V0[iDraw]
-            Bs.append(Blamb)
+    return P, V, Blamb
 
-        if 'V0' in varDict:
-            V_ *= V0[iDraw]
+def posteriorPredictive(trace, model_dic, hdi_prob=0.95, quantiles=(0.025, 0.5, 0.975), chunksize=500, bins=1000):
+    """
+    Returns the means, quantiles and highest-density intervals of P, V, B and the
+    residuals V - Vexp over all posterior draws, as an xarray Dataset.
+    The ensembles are calculated in vectorized chunks of chunksize draws and reduced
+    chunk by chunk: the means are accumulated exactly, and the quantiles and HDIs are
+    taken from histograms with bins bins between the smallest and largest value of
+    every point (found in a first pass over the chunks), so they are accurate to about
+    1/bins of that range. Besides the trace (with decoded P), the memory used is
+    bounded by chunksize and bins instead of growing with the number of draws.
+    The result is cached in the group trace.predictive and reused for the same
+    hdi_prob, quantiles and bins and the same t, r and Vexp (compared by a hash).
+    """
+    t = model_dic['t']
+    r = model_dic['pars']['r']
+    Vexp = model_dic['Vexp']
+    datahash = _datahash(t, r, Vexp)
+
+    if "predictive" in trace.groups():
+        cached = trace.predictive
+        if (cached.attrs["hdi_prob"] == hdi_prob and np.array_equal(cached.attrs["quantiles"], quantiles)
+                and cached.attrs["bins"] == bins and cached.attrs.get("data_hash") == datahash):
+            return cached
+        del trace.predictive
+
+    posterior = _thinnedtrace(restoreDeterministics(decodeP(trace))).posterior
+    posterior = posterior.stack(sample=("chain", "draw")).transpose("sample", ...)
+    nDraws = posterior.dims["sample"]
+    K0 = dl.dipolarkernel(t, r, integralop=False)
+    names = ["P", "V", "B", "residuals"]
+
+    def chunks():
+        for start in range(0, nDraws, chunksize):
+            P, V, B = _ensemble(posterior.isel(sample=slice(start, min(start+chunksize, nDraws))), r, t, K0)
+            yield dict(zip(names, [P, V, B, V - Vexp]))
+
+    # first pass: sums and ranges
+    sums = {name: 0 for name in names}
+    lows = {name: np.inf for name in names}
+    highs = {name: -np.inf for name in names}
+    for ensembles in chunks():
+        for name, ensemble in ensembles.items():
+            sums[name] = sums[name] + ensemble.sum(axis=0)
+            lows[name] = np.minimum(lows[name], ensemble.min(axis=0))
+            highs[name] = np.maximum(highs[name], ensemble.max(axis=0))
+
+    # second pass: histograms
+    counts = {name: np.zeros((len(lows[name]), bins), dtype=np.int64) for name in names}
+    for ensembles in chunks():
+        for name, ensemble in ensembles.items():
+            counts[name] += _histogram(ensemble, lows[name], highs[name], bins)
+
+    data = {}
+    for name in names:
+        dim = "r" if name == "P" else "t"
+        edges = _edges(lows[name], highs[name], bins)
+        data[f"{name}_mean"] = (dim, sums[name]/nDraws)
+        data[f"{name}_quantiles"] = (("quantile", dim), _histquantiles(counts[name], edges, quantiles))
+        data[f"{name}_hdi"] = (("hdi", dim), _histhdi(counts[name], edges, hdi_prob))
+    summary = xr.Dataset(data, coords={"r": r, "t": t, "quantile": list(quantiles), "hdi": ["lower", "higher"]},
+                         attrs={"hdi_prob": hdi_prob, "quantiles": list(quantiles), "bins": bins, "draws": nDraws, "data_hash": datahash})
+
+    trace.add_groups({"predictive": summary})
+    return summary
+
+def _datahash(*arrays):
+    """
+    Returns the SHA-1 hex digest of the values of the arrays.
+    """
+    digest = hashlib.sha1()
+    for array in arrays:
+        digest.update(np.ascontiguousarray(array, dtype=np.float64).tobytes())
+    return digest.hexdigest()
 
-        Vs.append(V_)
+def _edges(low, high, bins):
+    """
+    Returns the bin edges (one row per column) of the histograms of _histogram.
+    """
+    width = np.maximum(high - low, np.finfo(float).tiny)
+    return low[:, np.newaxis] + width[:, np.newaxis]*np.linspace(0, 1, bins+1)
 
-    return Ps, Vs, Bs, t, r
+def _histogram(x, low, high, bins):
+    """
+    Returns the histograms (one row per column of x) of the values of x with bins
+    equal bins between low and high.
+    """
+    width = np.maximum(high - low, np.finfo(float).tiny)
+    index = np.clip(((x - low)/width*bins).astype(np.int64), 0, bins-1)
+    index += bins*np.arange(x.shape[1])
+    return np.bincount(index.ravel(), minlength=x.shape[1]*bins).reshape(x.shape[1], bins)
 
+def _histquantiles(counts, edges, quantiles):
+    """
+    Returns the quantiles (one row per quantile) of all histograms in counts,
+    interpolating linearly within the bins.
+    """
+    cdf = np.cumsum(np.hstack([np.zeros((len(counts), 1)), counts]), axis=1)
+    cdf = cdf/cdf[:, -1:]
+    return np.array([np.interp(quantiles, c, e) for c, e in zip(cdf, edges)]).T
 
-def plotMCMC(Ps, Vs, Bs, Vdata, t, r, Pref=None, rref=None, show_ave = None, colors=["#4A5899","#F38D68"]):
+def _histhdi(counts, edges, prob):
+    """
+    Returns the highest-density intervals (lower and upper row) of all histograms in
+    counts: the narrowest ranges of bins that hold at least a fraction prob of the
+    values.
+    """
+    hdi = np.empty((2, len(counts)))
+    for column, (c, e) in enumerate(zip(counts, edges)):
+        cdf = np.concatenate([[0], np.cumsum(c)])
+        upper = np.searchsorted(cdf, cdf + np.ceil(prob*cdf[-1]))
+        valid = upper < len(cdf)
+        lower = np.flatnonzero(valid)
+        i = np.argmin(e[upper[valid]] - e[lower])
+        hdi[:, column] = e[lower[i]], e[upper[valid][i]]
+    return hdi
+
+
+def plotMCMC(Ps, Vs, Bs, Vdata, t, r, Pref=None, rref=None, show_ave = None, colors=["#4A5899","#F38D68"], summary=None):
+    """
+    Plots the ensembles of signals, backgrounds, residuals and distance distributions.
+    If summary (from posteriorPredictive) is given, the averages shown with show_ave
+    are taken from it (all draws) instead of from the ensembles.
+    """
 
 
 
@@ -315,14 +501,17 @@ def plotMCMC(Ps, Vs, Bs, Vdata, t, r, Pref=None, rref=None, show_ave = None, col
         residuals_offset = 0
 
     # Plot time-domain quantities
-    for V, B in zip(Vs, Bs):
-        residuals = V - Vdata
-        ax1.plot(t, V, color=colors[0], alpha=0.2)
-        ax1.plot(t, B, color=colors[1], alpha=0.2)
-        ax1.plot(t, residuals+residuals_offset, color=colors[0], alpha=0.2)
-    Vavg = np.mean(Vs, 0)
-    Bavg = np.mean(Bs, 0)
-    Pavg = np.mean(Ps, 0)
+    _ensembleplot(ax1, t, Vs, colors[0], alpha=0.2)
+    _ensembleplot(ax1, t, Bs, colors[1], alpha=0.2)
+    _ensembleplot(ax1, t, np.asarray(Vs) - Vdata + residuals_offset, colors[0], alpha=0.2)
+    if summary is not None:
+        Vavg = summary["V_mean"].values
+        Bavg = summary["B_mean"].values
+        Pavg = summary["P_mean"].values
+    else:
+        Vavg = np.mean(Vs, 0)
+        Bavg = np.mean(Bs, 0)
+        Pavg = np.mean(Ps, 0)
 
     ax1.scatter(t, Vdata, color='#BFBFBF', s=5)
     ax1.hlines(residuals_offset, min(t), max(t), color='black')
@@ -341,13 +530,12 @@ def plotMCMC(Ps, Vs, Bs, Vdata, t, r, Pref=None, rref=None, show_ave = None, col
 
 
     # Plot distance distributions
-    for P in Ps:
-        ax2.plot(r, P, color=colors[0], alpha=0.2)
-    Pmax = max([max(P) for P in Ps])
+    _ensembleplot(ax2, r, Ps, colors[0], alpha=0.2)
+    Pmax = np.max(Ps)
     ax2.set_xlabel('$r$ (nm)')
     ax2.set_ylabel('$P$ (nm$^{-1}$)')
     ax2.set_xlim(min(r), max(r))
-    ax2.set_ylim(0,max(P)+0.2)
+    ax2.set_ylim(0,Pmax+0.2)
     ax2.set_title('distance domain')
 
     if Pref is not None:
@@ -359,8 +547,43 @@ def plotMCMC(Ps, Vs, Bs, Vdata, t, r, Pref=None, rref=None, show_ave = None, col
         
     return fig
 
-def pairplot_chain(trace, var1, var2, plot_inits=False, gauss_id=1, ax=None, colors=["r","g","b","y","m","c","orange","deeppink","indigo","seagreen"], alpha_points=0.1, alpha_inits=1):
-    """Plots two parameters against each other for each chain."""
+def _ensembleplot(ax, x, ys, color, alpha=1, linewidth=None, maxlines=500, label=None):
+    """
+    Plots the curves ys (one per row) over x as a single LineCollection. More than
+    maxlines curves are drawn as an image of the density of curves instead, with the
+    opacity that overplotting them with the given alpha would give.
+    Returns an artist for the legend.
+    """
+    ys = np.asarray(ys)
+    if len(ys) <= maxlines:
+        segments = np.stack(np.broadcast_arrays(x, ys), axis=-1)
+        lines = LineCollection(segments, colors=color, alpha=alpha, linewidths=linewidth, label=label)
+        ax.add_collection(lines)
+        ax.autoscale_view()
+        return lines
+
+    # Interpolate to a finer grid, so that steep segments are covered, and bin
+    nx, ny = max(len(x), 800), 400
+    xfine = np.linspace(x[0], x[-1], nx)
+    i = np.clip(np.searchsorted(x, xfine) - 1, 0, len(x) - 2)
+    f = (xfine - x[i])/(x[i+1] - x[i])
+    yfine = ys[:, i]*(1-f) + ys[:, i+1]*f
+
+    ymin, ymax = yfine.min(), yfine.max()
+    rows = np.clip(((yfine - ymin)/(ymax - ymin)*ny).astype(int), 0, ny-1)
+    counts = np.bincount((rows*nx + np.arange(nx)).ravel(), minlength=ny*nx).reshape(ny, nx)
+    # every curve covers about three rows, like a line
+    counts = np.pad(counts, ((1, 1), (0, 0)))
+    counts = counts[:-2] + counts[1:-1] + counts[2:]
+
+    image = np.zeros((ny, nx, 4))
+    image[..., :3] = to_rgb(color)
+    image[..., 3] = 1 - (1-alpha)**counts
+    ax.imshow(image, extent=(x[0], x[-1], ymin, ymax), origin="lower", aspect="auto", interpolation="nearest")
+    return plt.Line2D([], [], color=color, alpha=alpha, linewidth=linewidth, label=label)
+
+def pairplot_chain(trace, var1, var2, plot_inits=False, gauss_id=1, ax=None, colors=["r","g","b","y","m","c","orange","deeppink","indigo","seagreen"], alpha_points=0.1, alpha_inits=1, max_points=5000):
+    """Plots two parameters against each other for each chain (at most max_points points in total)."""
     if not ax:
         # creates ax object if not provided
         _, ax = plt.subplots(1, 1, figsize=(5,5))
@@ -381,7 +604,7 @@ def pairplot_chain(trace, var1, var2, plot_inits=False, gauss_id=1, ax=None, col
         # if color is a string, it uses that color; if it is a list, it uses them in order
         color = colors if isinstance(colors, str) else colors[chain%len(colors)]
         # plots the two parameters
-        ax.plot(v1, v2, ".", color=color, alpha=alpha_points)
+        _scatter(ax, v1, v2, max_points=max_points//trace.posterior.dims["chain"], color=color, alpha=alpha_points)
         if plot_inits:
             # if plot_inits is True, it plots the initial points as a larger dot
             ax.plot(v1[0], v2[0], "o", color=color, alpha=alpha_inits)
@@ -391,8 +614,12 @@ def pairplot_chain(trace, var1, var2, plot_inits=False, gauss_id=1, ax=None, col
     ax.set_title("scatter plot between %s and %s" % (_betterLabels(xlabel), _betterLabels(ylabel)))
     return ax
 
-def pairplot_divergence(trace, var1, var2, gauss_id=1, ax=None, color="C2", divergence_color="C3", alpha=0.2, divergence_alpha=0.4):
-    """Plots two parameters against each other and highlights divergences."""
+def pairplot_divergence(trace, var1, var2, gauss_id=1, ax=None, color="C2", divergence_color="C3", alpha=0.2, divergence_alpha=0.4, max_points=5000, density=False):
+    """
+    Plots two parameters against each other and highlights divergences.
+    At most max_points draws are shown, or, with density, a 2D histogram of all draws.
+    All divergent draws are shown.
+    """
     gauss_id -= 1 # to fix off-by-one error
     v1 = az.extract(trace, var_names=[var1])
     v2 = az.extract(trace, var_names=[var2])
@@ -410,17 +637,23 @@ def pairplot_divergence(trace, var1, var2, gauss_id=1, ax=None, color="C2", dive
         # creates an ax object if not provided
         _, ax = plt.subplots(1, 1, figsize=(5, 5))
     # plots all the points first
-    ax.plot(v1, v2, ".", color=color, alpha=alpha)
+    if density:
+        _density(ax, v1, v2)
+    else:
+        _scatter(ax, v1, v2, max_points=max_points, color=color, alpha=alpha)
     # then, plots the divergent points in divergence_color & larger
-    divergent = az.extract(trace, group="sample_stats", var_names=["diverging"])
-    ax.plot(v1[divergent], v2[divergent], "o", color=divergence_color, alpha=divergence_alpha)
+    divergent = az.extract(trace, group="sample_stats", var_names=["diverging"]).values.astype(bool)
+    ax.plot(np.asarray(v1)[divergent], np.asarray(v2)[divergent], "o", color=divergence_color, alpha=divergence_alpha)
     ax.set_xlabel(_betterLabels(xlabel))
     ax.set_ylabel(_betterLabels(ylabel))
     ax.set_title("scatter plot with divergences between %s and %s" % (_betterLabels(xlabel), _betterLabels(ylabel)))
     return ax
 
-def pairplot_condition(trace, var1, var2, gauss_id=1, ax=None, criterion=None, threshold=None, color_greater="dodgerblue", color_lesser="hotpink", alpha_greater=0.2, alpha_lesser=0.2):
-    """Plots two parameters against each other and divides points greater and less than a threshold in a certain criterion."""
+def pairplot_condition(trace, var1, var2, gauss_id=1, ax=None, criterion=None, threshold=None, color_greater="dodgerblue", color_lesser="hotpink", alpha_greater=0.2, alpha_lesser=0.2, max_points=5000):
+    """
+    Plots two parameters against each other and divides points greater and less than a threshold in a certain criterion.
+    At most max_points draws are shown for each of the two groups.
+    """
     # the criterion should be in sample_stats, e.g. tree_depth
     # points above and below the threshold in this criterion will be plotted in different colors
     gauss_id -= 1 # to fix off-by-one error
@@ -440,11 +673,10 @@ def pairplot_condition(trace, var1, var2, gauss_id=1, ax=None, criterion=None, t
     if not ax:
         # creates an ax object if not provided
         _, ax = plt.subplots(1, 1, figsize=(5, 5))
-    for i in range(len(v1)):
-        if stats[i] > threshold:
-            ax.plot(v1[i], v2[i], ".", color=color_greater, alpha=alpha_greater)
-        else:
-            ax.plot(v1[i], v2[i], ".", color=color_lesser, alpha=alpha_lesser)
+    greater = np.asarray(stats) > threshold
+    v1, v2 = np.asarray(v1), np.asarray(v2)
+    _scatter(ax, v1[greater], v2[greater], max_points=max_points, color=color_greater, alpha=alpha_greater)
+    _scatter(ax, v1[~greater], v2[~greater], max_points=max_points, color=color_lesser, alpha=alpha_lesser)
     ax.set_xlabel(_betterLabels(xlabel))
     ax.set_ylabel(_betterLabels(ylabel))
     ax.set_title("scatter plot between %s and %s split at %s = %s" % (_betterLabels(xlabel), _betterLabels(ylabel), criterion, threshold))
@@ -0,0 +1,125 @@
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+import arviz as az
+import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+
+from .saving import loadTrace
+from .plotting import plotmarginals, plotcorrelations, plotresult, _relevantVariables
+
+# Figures of a report, in the order of plotting.summary
+_figures = ["marginals", "correlations", "result"]
+
+def makeReports(paths, outdir="reports", formats=("png",), cores=None, force=False):
+    """
+    Renders the summary of every saved trace in paths (netCDF files written by
+    saveTrace) without a display: the figures of plotmarginals, plotcorrelations and
+    plotresult are saved as outdir/<name>_<figure>.<format> for all formats ("png",
+    "svg"), and the parameter tables of all traces are combined into
+    outdir/summary.html and outdir/summary.json.
+
+    The traces are rendered in parallel on a process pool with the non-interactive Agg
+    backend. A manifest (outdir/manifest.json) records a hash of every input file, so
+    that figures of unchanged traces are not rendered again unless force. A trace
+    that fails to render is left out of the summary, its error is recorded in its
+    manifest entry, and it is rendered again in the next call.
+
+    Returns the combined summary table.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    manifestfile = os.path.join(outdir, "manifest.json")
+    manifest = {}
+    if os.path.exists(manifestfile) and not force:
+        with open(manifestfile) as f:
+            manifest = json.load(f)
+
+    # determine which figures have to be (re)rendered
+    jobs = []
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        digest = _filehash(path)
+        entry = manifest.get(name, {})
+        if entry.get("hash") != digest:
+            entry = {"hash": digest}
+        todo = [figure for figure in _figures
+                if not all(os.path.exists(_figurepath(outdir, name, figure, format)) for format in formats)
+                or figure not in entry.get("figures", [])]
+        if todo or "summary" not in entry:
+            jobs.append((name, path, todo))
+        manifest[name] = entry
+
+    try:
+        if jobs:
+            print(f"Rendering {len(jobs)} of {len(paths)} reports")
+            with ProcessPoolExecutor(max_workers=cores, initializer=_initworker) as pool:
+                futures = [pool.submit(_report, name, path, todo, outdir, formats) for name, path, todo in jobs]
+                for (name, _, todo), future in zip(jobs, futures):
+                    entry = manifest[name]
+                    try:
+                        rows = future.result()
+                    except Exception as error:
+                        entry["error"] = f"{type(error).__name__}: {error}"
+                        print(f"Failed to render {name}: {entry['error']}")
+                        continue
+                    entry.pop("error", None)
+                    entry["figures"] = sorted(set(entry.get("figures", [])) | set(todo), key=_figures.index)
+                    entry["summary"] = rows
+        else:
+            print(f"All {len(paths)} reports are up to date")
+    finally:
+        with open(manifestfile, "w") as f:
+            json.dump(manifest, f, indent=1)
+
+    # combined summary table of the traces in paths
+    names = [os.path.splitext(os.path.basename(path))[0] for path in paths]
+    rows = [{"trace": name, **row} for name in names for row in manifest[name].get("summary", [])]
+    table = pd.DataFrame(rows) if rows else pd.DataFrame(columns=["trace", "parameter"])
+    table = table.set_index(["trace", "parameter"])
+    table.to_html(os.path.join(outdir, "summary.html"), escape=False)
+    with open(os.path.join(outdir, "summary.json"), "w") as f:
+        json.dump(rows, f, indent=1)
+
+    return table
+
+def _initworker():
+    plt.switch_backend("Agg")
+
+def _report(name, path, figures, outdir, formats):
+    """
+    Worker: renders the given figures of the trace in path and returns the rows of
+    its summary table.
+    """
+    trace, model_dic = loadTrace(path)
+
+    Vars = _relevantVariables(trace)
+    summary = az.summary(trace, var_names=Vars)
+    rows = [{"parameter": parameter, **{key: float(value) for key, value in row.items()}} for parameter, row in summary.iterrows()]
+
+    for figure in figures:
+        if figure == "marginals":
+            fig = np.atleast_1d(plotmarginals(trace)).flat[0].figure
+        elif figure == "correlations":
+            fig = plotcorrelations(trace, model_dic)
+        else:
+            fig, _ = plotresult(trace, model_dic)
+        for format in formats:
+            fig.savefig(_figurepath(outdir, name, figure, format), bbox_inches="tight")
+        plt.close(fig)
+
+    return rows
+
+def _figurepath(outdir, name, figure, format):
+    return os.path.join(outdir, f"{name}_{figure}.{format}")
+
+def _filehash(path, blocksize=2**20):
+    """
+    Returns the SHA-1 hex digest of the contents of a file.
+    """
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            digest.update(block)
+    return digest.hexdigest()
@@ -1,5 +1,6 @@
+import warnings
 import numpy as np
-from scipy.linalg import sqrtm
+from scipy.linalg import sqrtm, cho_solve, solve_triangular
 from pymc.step_methods.arraystep import BlockedStep
 import pymc as pm
 
@@ -26,9 +27,20 @@ class randPnorm_posterior(BlockedStep):
       Bend    end value of background decay function (at t[-1])
       lamb    modulation depth
       V0      overall amplitude
+
+    With pars['P_support'] = 'adaptive', r points where P has been zero in every
+    draw of the last window are dropped, and P is solved and sampled on the reduced
+    support (with a margin of neighboring points) only. The support is only adapted
+    during tuning: the full grid is used for the first window draws, and then one
+    full-grid draw every check (50) steps detects re-entry of mass and updates the
+    support. At the end of tuning (stop_tuning) the support is frozen, so all
+    production draws come from the conditional of P given P=0 outside that support.
+    This equals the full conditional wherever the full-grid draws of P are zero
+    outside the support, as for distributions with empty tails on a wide grid. The
+    subclasses with their own P draws do not support this option.
     """
     
-    def __init__(self, pars):
+    def __init__(self, pars, window=100, check=50, margin=3):
         # Set self.vars with the list of variables covered by this sampler
         pymcmodel = pm.modelcontext(None)
         P_value_var = pymcmodel.rvs_to_values[pymcmodel['P']]
@@ -38,13 +50,54 @@ class randPnorm_posterior(BlockedStep):
         self.V = pars["Vexp"]
         self.t = pars["t"]
         self.K0 = pars["K0"]
-        self.LtL = pars["LtL"]
+        self.LtL = pars["LtL"].tocoo()
         self.dr = pars["dr"]
+        self.dtype = pars["dtype"]
         if "alpha" in pars:
             self.alpha = pars["alpha"]
 
+        # Adaptive support
+        self.adaptive = "P_support" in pars and pars["P_support"] == "adaptive"
+        self.window = window
+        self.check = check
+        self.margin = margin
+        self.reset_tuning()
+
+    def reset_tuning(self):
+        # Called by PyMC at the start of every chain
+        self.tune = True
+        self.nsteps = 0
+        self.support = None
+        self.active = np.zeros(np.shape(self.K0)[1], dtype=bool)
+
+    def stop_tuning(self):
+        # Called by PyMC at the end of tuning: the support is frozen from here on
+        self.tune = False
+        if self.adaptive and self.support is None and self.active.any():
+            self._updatesupport()
+
     def step(self, point: dict):
         
+        tau, delta, K = self._conditional(point)
+
+        # Draw new sample of P
+        Pdraw = self._drawP(tau, delta, K)
+        
+        # Normalize P
+        Pdraw =  Pdraw / np.sum(Pdraw) / self.dr
+
+        # Store new sample
+        newpoint = point.copy()
+        newpoint['P'] = Pdraw.astype(self.dtype)
+        
+        stats = []
+        return newpoint, stats
+
+    def _conditional(self, point):
+        """
+        Returns tau, delta and the full kernel matrix K (including background,
+        modulation depth, amplitude and dr) for the current point.
+        """
         # Get current parameter values and backtransform if necessary
         tau = point['tau'] if 'tau' in point else np.exp(point['tau_log__'])
         delta = point['delta'] if 'delta' in point else (np.exp(point['delta_log__']) if 'delta_log__' in point else self.alpha**2*tau)
@@ -62,24 +115,136 @@ class randPnorm_posterior(BlockedStep):
         K *= B[:, np.newaxis]
         K *= V0*self.dr
 
-        # Calculate posterior distribution parameters
+        return tau, delta, K
+
+    def _precision(self, tau, delta, K, LtL=None):
+        """
+        Returns tau*K'*V and the precision matrix tau*K'*K + delta*L'*L
+        of the full conditional of P.
+        """
+        LtL = self.LtL if LtL is None else LtL
         KtK = np.matmul(np.transpose(K), K)
         KtV = np.matmul(np.transpose(K), self.V) 
         tauKtV = tau*KtV
-        invSigma = tau*KtK + delta*self.LtL
+        invSigma = tau*KtK
+        _addsparse(invSigma, LtL, delta)
+        return tauKtV, invSigma
 
-        # Draw new sample of P
-        Pdraw = _randP(tauKtV, invSigma)
-        
-        # Normalize P
-        Pdraw =  Pdraw / np.sum(Pdraw) / self.dr
+    def _drawP(self, tau, delta, K):
+        if not self.adaptive:
+            tauKtV, invSigma = self._precision(tau, delta, K)
+            return _randP(tauKtV, invSigma)
 
-        # Store new sample
-        newpoint = point.copy()
-        newpoint['P'] = Pdraw
-        
-        stats = []
-        return newpoint, stats
+        self.nsteps += 1
+        fullgrid = self.support is None or (self.tune and self.nsteps % self.check == 0)
+        if fullgrid:
+            tauKtV, invSigma = self._precision(tau, delta, K)
+            P = _randP(tauKtV, invSigma)
+        else:
+            # Solve on the reduced support, P is zero elsewhere
+            tauKtV, invSigma = self._precision(tau, delta, K[:, self.support], self.LtL_support)
+            P = np.zeros(np.shape(K)[1])
+            P[self.support] = _randP(tauKtV, invSigma)
+        self.active |= P > 0
+
+        # During tuning, update the support at the end of the warm-up window and at
+        # every full-grid check
+        if self.tune and ((self.support is None and self.nsteps >= self.window) or (self.support is not None and fullgrid)):
+            self._updatesupport()
+
+        return P
+
+    def _updatesupport(self):
+        """
+        Sets the support to the points that were active since the last update,
+        widened by margin points on either side.
+        """
+        active = np.convolve(self.active, np.ones(2*self.margin+1), mode="same") > 0
+        self.support = np.flatnonzero(active)
+        self.LtL_support = self.LtL.tocsr()[self.support][:, self.support].tocoo()
+        self.active[:] = False
+
+class randPiterative_posterior(randPnorm_posterior):
+    """
+    Draws samples of P (with non-negative elements) from the full conditional
+    distribution of P like randPnorm_posterior, but without forming or factoring
+    the nr x nr precision matrix, so that it scales to large distance grids.
+
+    The Gaussian perturbation of the right-hand side is drawn as
+    sqrt(tau)*K'*e1 + sqrt(delta)*L'*e2 with standard normal e1 and e2
+    (perturbation-optimization), and the non-negative least-squares problem is
+    solved with the nonmonotone spectral projected gradient method (_pnnls),
+    warm-started from the previous draw. Only products with K, K', L and L' are
+    needed. A RuntimeWarning is issued if the solver does not converge in maxiter
+    iterations.
+
+    based on:
+    F. Orieux, O. Feron, J.-F. Giovannelli, Sampling high-dimensional Gaussian
+    distributions for general linear inverse problems, IEEE Signal Process. Lett.
+    19 (2012) 251-254
+    """
+
+    def __init__(self, pars, tol=1e-6, maxiter=5000):
+        super().__init__(pars)
+        if self.adaptive:
+            raise ValueError("randPiterative_posterior does not support P_support = 'adaptive'.")
+        self.L = pars["L"]
+        self.tol = tol
+        self.maxiter = maxiter
+
+    def reset_tuning(self):
+        super().reset_tuning()
+        self.Plast = None
+
+    def _drawP(self, tau, delta, K):
+        # Perturbed right-hand side, with covariance equal to the precision matrix
+        e1 = np.random.standard_normal(size=np.shape(K)[0])
+        e2 = np.random.standard_normal(size=np.shape(self.L)[0])
+        b = K.T@(tau*self.V + np.sqrt(tau)*e1) + np.sqrt(delta)*(self.L.T@e2)
+
+        # Products with the precision matrix
+        def Amul(x):
+            return tau*(K.T@(K@x)) + delta*(self.L.T@(self.L@x))
+
+        x0 = np.zeros(len(b)) if self.Plast is None else self.Plast
+        P, converged = _pnnls(Amul, np.asarray(b, dtype=np.float64), x0, self.tol, self.maxiter)
+        if not converged:
+            warnings.warn(f"randPiterative_posterior: the NNLS solver did not converge in {self.maxiter} iterations, P is approximate.", RuntimeWarning)
+        self.Plast = P
+        return P
+
+class randPtmvn_posterior(randPnorm_posterior):
+    """
+    Samples P from the non-negatively truncated Gaussian full conditional
+    distribution of P with exact Hamiltonian Monte Carlo, i.e. trajectories that are
+    integrated analytically and reflected at the walls P=0, instead of projecting a
+    perturbed unconstrained draw as randPnorm_posterior does. It uses the same
+    precision matrix. Each step is one trajectory of length pi/2 started from the
+    previous (unnormalized) draw of the chain, or from a draw of _randP in the first
+    step. This is a Markov transition that leaves the truncated Gaussian invariant,
+    so successive draws are correlated rather than independent.
+
+    based on:
+    A. Pakman, L. Paninski, Exact Hamiltonian Monte Carlo for truncated multivariate
+    Gaussians, J. Comput. Graph. Stat. 23 (2014) 518-542
+    https://doi.org/10.1080/10618600.2013.788448
+    """
+
+    def __init__(self, pars, maxbounces=100000):
+        super().__init__(pars)
+        if self.adaptive:
+            raise ValueError("randPtmvn_posterior does not support P_support = 'adaptive'.")
+        self.maxbounces = maxbounces
+
+    def reset_tuning(self):
+        super().reset_tuning()
+        self.Plast = None
+
+    def _drawP(self, tau, delta, K):
+        tauKtV, invSigma = self._precision(tau, delta, K)
+        x0 = _randP(tauKtV, invSigma) if self.Plast is None else self.Plast
+        self.Plast = _randPtmvn(tauKtV, invSigma, x0, self.maxbounces)
+        return self.Plast
 
 class randDelta_posterior(BlockedStep):
     
@@ -94,6 +259,7 @@ class randDelta_posterior(BlockedStep):
         self.a_delta = delta_prior[0]
         self.b_delta = delta_prior[1]
         self.L = pars["L"]
+        self.dtype = pars["dtype"]
 
     def step(self, point: dict):
         
@@ -103,14 +269,14 @@ class randDelta_posterior(BlockedStep):
         # Calculate posterior distribution parameters
         n_p = sum(np.asarray(P)>0)
         a_delta = self.a_delta + 0.5*n_p
-        b_delta = self.b_delta + 0.5*np.linalg.norm(self.L@P)**2
+        b_delta = self.b_delta + 0.5*np.sum((self.L@P)**2)  # O(nr) for sparse L
 
         # Draw new sample of delta
         delta_draw = np.random.gamma(a_delta, 1/b_delta)
         
         # Save sample
         newpoint = point.copy()
-        newpoint['delta'] = delta_draw
+        newpoint['delta'] = np.asarray(delta_draw, dtype=self.dtype)
         
         stats = []
         return newpoint, stats
@@ -137,6 +303,7 @@ class randTau_posterior(BlockedStep):
         self.a_tau = tau_prior[0]
         self.b_tau = tau_prior[1]
         self.K0dr = pars["K0"]*dr
+        self.dtype = pars["dtype"]
 
     def step(self, point: dict):
 
@@ -166,11 +333,301 @@ class randTau_posterior(BlockedStep):
 
         # Save new sample
         newpoint = point.copy()
-        newpoint['tau'] = tau_draw
+        newpoint['tau'] = np.asarray(tau_draw, dtype=self.dtype)
         
         stats = []
         return newpoint, stats
 
+class randAmp_posterior(BlockedStep):
+    """
+    Draws the overall amplitude V0 and the modulation depth lamb from their joint full
+    conditional distribution.
+
+    Given P, the background B and tau, the model signal V0*B*((1-lamb) + lamb*K0*P*dr)
+    = B*(b + c*K0*P*dr) is linear in b = V0*(1-lamb) and c = V0*lamb, so the likelihood
+    is Gaussian in (b, c). A proposal is drawn from this Gaussian and accepted with the
+    ratio of the priors of V0 and lamb transformed to (b, c) (independence
+    Metropolis-Hastings), so that the draws follow the full conditional under the
+    priors of the model exactly. The parameters of the Beta prior of lamb and the
+    (truncated) normal prior of V0 are taken from pars['lamb_prior'] and
+    pars['V0_prior'], the values the model was built with.
+    """
+
+    def __init__(self, pars):
+        # Set self.vars with the list of variables covered by this sampler
+        model = pm.modelcontext(None)
+        self.vars = [model.rvs_to_values[model['V0']], model.rvs_to_values[model['lamb']]]
+
+        # Store data and constants
+        self.V = np.asarray(pars["Vexp"], dtype=np.float64)
+        self.t = pars["t"]
+        self.K0dr = pars["K0"]*pars["dr"]
+        self.dtype = pars["dtype"]
+        self.lamb_prior = pars["lamb_prior"]
+        self.V0_prior = pars["V0_prior"]
+
+    def step(self, point: dict):
+
+        # Get current parameter values and backtransform if necessary
+        P = point['P']
+        tau = point['tau'] if 'tau' in point else np.exp(point['tau_log__'])
+        k = _bgrate(point, self.t)
+        lamb = 1/(1+np.exp(-point['lamb_logodds__']))
+        V0 = np.exp(point['V0_interval__'])
+
+        # Gaussian likelihood of (b, c)
+        B = bg_exp(self.t, k)
+        X = np.stack([B, B*(self.K0dr@P)], axis=1).astype(np.float64)
+        XtX = X.T@X
+        mean = np.linalg.solve(XtX, X.T@self.V)
+        C_L = np.linalg.cholesky(np.linalg.inv(tau*XtX))
+        b, c = mean + C_L@np.random.standard_normal(size=2)
+
+        # Accept with the prior ratio
+        newpoint = point.copy()
+        if b > 0 and c > 0 and np.log(np.random.uniform()) < self._logprior(b, c) - self._logprior(V0*(1-lamb), V0*lamb):
+            V0 = b + c
+            lamb = c/V0
+            newpoint['V0_interval__'] = np.asarray(np.log(V0), dtype=self.dtype)
+            newpoint['lamb_logodds__'] = np.asarray(np.log(lamb/(1-lamb)), dtype=self.dtype)
+
+        stats = []
+        return newpoint, stats
+
+    def _logprior(self, b, c):
+        """
+        Returns the (unnormalized) log prior density of (b, c), including the
+        Jacobian 1/V0 of the transformation from (V0, lamb).
+        """
+        V0 = b + c
+        lamb = c/V0
+        a_lamb, b_lamb = self.lamb_prior
+        mu_V0, sigma_V0 = self.V0_prior
+        return (a_lamb-1)*np.log(lamb) + (b_lamb-1)*np.log1p(-lamb) - 0.5*((V0-mu_V0)/sigma_V0)**2 - np.log(V0)
+
+class randBkgd_posterior(BlockedStep):
+    """
+    Draws the background variable (Bend or k, whichever is sampled) from its full
+    conditional distribution with a univariate slice sampler (stepping out and
+    shrinkage) on the transformed value, so that no gradient is needed.
+
+    The intramolecular signal V0*((1-lamb) + lamb*K0*P*dr) is calculated once per step,
+    so every evaluation of the conditional density costs O(nt). During tuning, the
+    slice width is set to twice the mean distance moved per step. The parameters of
+    the Beta prior of Bend and the scale of the exponential prior of k are taken from
+    pars['Bend_prior'] and pars['k_scale'], the values the model was built with.
+
+    based on:
+    R.M. Neal, Slice sampling, Ann. Statist. 31 (2003) 705-767
+    https://doi.org/10.1214/aos/1056562461
+    """
+
+    def __init__(self, pars, width=1.0, maxsteps=50):
+        # Set self.vars with the list of variables covered by this sampler
+        model = pm.modelcontext(None)
+        self.bkgd_var = pars["background"]
+        self.vars = [model.rvs_to_values[model[self.bkgd_var]]]
+        self.name = self.vars[0].name
+
+        # Store data and constants
+        self.V = np.asarray(pars["Vexp"], dtype=np.float64)
+        self.t = pars["t"]
+        self.abst = np.abs(pars["t"])
+        self.K0dr = pars["K0"]*pars["dr"]
+        self.dtype = pars["dtype"]
+        self.Bend_prior = pars["Bend_prior"]
+        self.k_scale = pars["k_scale"]
+        self.width0 = width
+        self.maxsteps = maxsteps
+        self.reset_tuning()
+
+    def reset_tuning(self):
+        # Called by PyMC at the start of every chain
+        self.tune = True
+        self.width = self.width0
+        self.ntune = 0
+
+    def step(self, point: dict):
+
+        # Get current parameter values and backtransform if necessary
+        P = point['P']
+        tau = point['tau'] if 'tau' in point else np.exp(point['tau_log__'])
+        lamb = 1/(1+np.exp(-point['lamb_logodds__']))
+        V0 = np.exp(point['V0_interval__'])
+        Vintra = V0*((1-lamb) + lamb*(self.K0dr@P))
+
+        def logp(x):
+            return self._logprior(x) - 0.5*tau*np.sum((self.V - Vintra*np.exp(-self._k(x)*self.abst))**2)
+
+        x0 = float(point[self.name])
+        y = logp(x0) - np.random.standard_exponential()
+
+        # Stepping out, with at most maxsteps steps in total
+        left = x0 - np.random.uniform()*self.width
+        right = left + self.width
+        nleft = int(np.floor(np.random.uniform()*self.maxsteps))
+        nright = self.maxsteps - 1 - nleft
+        while nleft > 0 and y < logp(left):
+            left -= self.width
+            nleft -= 1
+        while nright > 0 and y < logp(right):
+            right += self.width
+            nright -= 1
+
+        # Shrinkage
+        while True:
+            x = np.random.uniform(left, right)
+            if y < logp(x):
+                break
+            if x < x0:
+                left = x
+            else:
+                right = x
+
+        if self.tune:
+            self.width = (self.width*self.ntune + abs(x - x0)*2)/(self.ntune + 1)
+            self.ntune += 1
+
+        newpoint = point.copy()
+        newpoint[self.name] = np.asarray(x, dtype=self.dtype)
+
+        stats = []
+        return newpoint, stats
+
+    def _k(self, x):
+        """
+        Returns the background decay rate k for the transformed value x.
+        """
+        if self.bkgd_var == "Bend":
+            return np.logaddexp(0, -x)/self.t[-1]  # -log(Bend)/t[-1]
+        return np.exp(x)
+
+    def _logprior(self, x):
+        """
+        Returns the (unnormalized) log prior density of the transformed value x,
+        including the Jacobian of the transformation.
+        """
+        if self.bkgd_var == "Bend":
+            logBend, log1mBend = -np.logaddexp(0, -x), -np.logaddexp(0, x)
+            a, b = self.Bend_prior
+            return a*logBend + b*log1mBend
+        return -np.exp(x)/self.k_scale + x
+
+def _bgrate(point, t):
+    """
+    Returns the background decay rate k of the point, sampled as Bend or k.
+    """
+    if "Bend_logodds__" in point:
+        Bend = 1/(1+np.exp(-point['Bend_logodds__']))
+        return -1/t[-1]*np.log(Bend)
+    return np.exp(point["k_log__"])
+
+def _addsparse(A, S, c):
+    """
+    Adds c*S to the dense matrix A in place, touching only the nonzero
+    elements of the sparse (COO, without duplicate entries) matrix S.
+    """
+    A[S.row, S.col] += c*S.data
+
+def _pnnls(Amul, b, x0, tol=1e-6, maxiter=5000, memory=10, gamma=1e-4):
+    """
+    Solves min f(x) = 0.5*x'*A*x - b'*x subject to x >= 0, given the function Amul
+    that returns A*x, with the spectral projected gradient method started from x0:
+    projected Barzilai-Borwein steps with a nonmonotone line search, which accepts
+    a step if f decreases sufficiently relative to the largest of the last memory
+    values of f. Since f is quadratic, the line search needs no further products
+    with A. Stops when the norm of the projected gradient drops below tol*norm(b).
+    Returns x and whether it converged within maxiter iterations.
+
+    based on:
+    E.G. Birgin, J.M. Martinez, M. Raydan, Nonmonotone spectral projected gradient
+    methods on convex sets, SIAM J. Optim. 10 (2000) 1196-1211
+    https://doi.org/10.1137/S1052623497330963
+    """
+    x = np.maximum(x0, 0)
+    Ax = Amul(x)
+    g = Ax - b
+    f = [0.5*x@Ax - b@x]
+    tol = tol*np.linalg.norm(b)
+
+    for it in range(maxiter):
+        # Projected gradient (components at the bound can only move inwards)
+        pg = np.where(x > 0, g, np.minimum(g, 0))
+        if np.linalg.norm(pg) <= tol:
+            return x, True
+        if it == 0:
+            alpha = (pg@pg)/(pg@Amul(pg))  # Cauchy step
+
+        # Search direction, and step length lam along it from the nonmonotone
+        # Armijo condition, with f(x + lam*d) = f(x) + lam*gd + lam^2/2*dAd
+        d = np.maximum(x - alpha*g, 0) - x
+        Ad = Amul(d)
+        gd, dAd = g@d, d@Ad
+        lam, fmax = 1.0, max(f[-memory:])
+        while f[-1] + lam*gd + 0.5*lam**2*dAd > fmax + gamma*lam*gd and lam > 1e-10:
+            lam = min(0.5*lam, -gd/dAd) if dAd > 0 else 0.5*lam  # safeguarded minimizer
+
+        s, y = lam*d, lam*Ad
+        x, Ax = x + s, Ax + y
+        g = Ax - b
+        f.append(f[-1] + lam*gd + 0.5*lam**2*dAd)
+
+        # Barzilai-Borwein step length, kept within safe bounds
+        sy = s@y
+        alpha = np.clip((s@s)/sy, 1e-30, 1e30) if sy > 0 else 1e30
+
+    return x, False
+
+def _randPtmvn(tauKtX, invSigma, x0, maxbounces=100000):
+    r"""
+    Moves the non-negative x0 by one exact HMC trajectory (Pakman & Paninski) that
+    leaves the Gaussian with precision matrix invSigma and mean invSigma\tauKtX,
+    truncated to P>=0, invariant. The result is correlated with x0.
+    """
+    tauKtX = np.asarray(tauKtX, dtype=np.float64)
+    invSigma = np.asarray(invSigma, dtype=np.float64)
+
+    # Whitening: x = mu + F@z with z standard normal, F = inv(R), invSigma = R'*R
+    R = np.linalg.cholesky(invSigma).T
+    mu = cho_solve((R, False), tauKtX)
+    F = solve_triangular(R, np.identity(len(mu)))
+    
+    # Start strictly inside the feasible region
+    x0 = np.maximum(x0, 1e-12*max(1, np.max(x0)))
+    z = R@(x0 - mu)
+    v = np.random.standard_normal(size=len(mu))
+
+    # Constraints F@z + mu >= 0; the trajectory is z(t) = v*sin(t) + z*cos(t)
+    T = np.pi/2
+    last = -1
+    for _ in range(maxbounces):
+        Fv = F@v
+        Fz = F@z
+        U = np.sqrt(Fv**2 + Fz**2)
+        phi = np.arctan2(-Fv, Fz)
+
+        # Times at which the walls are crossed from the inside
+        hittimes = np.full(len(mu), np.inf)
+        canhit = U > np.abs(mu)
+        hittimes[canhit] = np.mod(np.arccos(-mu[canhit]/U[canhit]) - phi[canhit], 2*np.pi)
+        if last >= 0 and hittimes[last] < 1e-10:
+            hittimes[last] = np.inf  # wall that was just hit
+        j = np.argmin(hittimes)
+        
+        if hittimes[j] >= T:
+            z = v*np.sin(T) + z*np.cos(T)
+            break
+
+        # Move to the wall and reflect the velocity
+        th = hittimes[j]
+        z, v = v*np.sin(th) + z*np.cos(th), v*np.cos(th) - z*np.sin(th)
+        f = F[j]
+        v = v - 2*(v@f)/(f@f)*f
+        T -= th
+        last = j
+
+    return np.maximum(mu + F@z, 0)
+
 def _randP(tauKtX, invSigma):
     r"""
     Draws a random P with non-negative elements
@@ -180,6 +637,10 @@ def _randP(tauKtX, invSigma):
     nonnegativity constrained inverse problems, Inverse Probl. Sci. Eng. 20 (2012)
     https://doi.org/10.1080/17415977.2011.637208
     """
+    # Factorizations and the NNLS solve are done in double precision
+    tauKtX = np.asarray(tauKtX, dtype=np.float64)
+    invSigma = np.asarray(invSigma, dtype=np.float64)
+
     Sigma = np.linalg.inv(invSigma)
 
     try:
@@ -3,9 +3,11 @@ import arviz as az
 from datetime import date
 from .models import *
 
-def saveTrace(trace, model_dic, SaveName=None):
+def saveTrace(trace, model_dic, SaveName=None, P_encoding=None):
     """
     Saves a trace to a netCDF file.
+    With P_encoding = "sparse" or "float16", the draws of P are saved in the
+    compact encoding of encodeP.
     """
     # adds important supplemental info to the xarray object
     trace.observed_data.coords["V_dim_0"] = model_dic["t"]
@@ -17,6 +19,10 @@ def saveTrace(trace, model_dic, SaveName=None):
     if "alpha" in model_dic["pars"]:
         trace.posterior.attrs["alpha"] = model_dic["pars"]["alpha"]
 
+    # encodes P after setting its distance coordinates, so that they are stored with it
+    if P_encoding is not None and "P" in trace.posterior:
+        trace = encodeP(trace, P_encoding)
+
     # creates the proper name for the file
     if not SaveName:
         today = date.today()
@@ -35,7 +41,7 @@ def loadTrace(path):
     Returns the trace and the model dictionary from a netCDF file.
     """
     # reads netCDF file (as an InferenceData object)
-    trace = az.from_netcdf(path)
+    trace = decodeP(az.from_netcdf(path))
 
     # recreates model_dic object
     t = trace.observed_data.coords["V_dim_0"].values
@@ -47,5 +53,6 @@ def loadTrace(path):
         pars.update({"alpha": trace.posterior.attrs["alpha"]})
 
     model_dic = model(t, Vexp, pars)
+    trace = restoreDeterministics(trace)
 
     return trace, model_dic
\ No newline at end of file
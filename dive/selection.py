@@ -0,0 +1,120 @@
+import numpy as np
+import pandas as pd
+import arviz as az
+import deerlab as dl
+from concurrent.futures import ProcessPoolExecutor
+
+from .models import *
+from .models import _distancegrid
+from .smc import sample_smc
+
+# Data shared with the worker processes of select_ngauss (set by _initworker)
+_shared = {}
+
+def select_ngauss(t, Vexp, pars, MCMCparameters, nGauss=(1, 2, 3, 4), cores=None, ic="loo", pilot=None, dominance=4, seed=None):
+    """
+    Fits the Gaussian model for every number of Gaussians in nGauss concurrently on a
+    process pool and ranks the fits by LOO or WAIC (ic) using arviz.compare.
+    The kernel is calculated once and sent to every worker process when it starts
+    (each worker holds its own copy), instead of being recalculated for every
+    candidate. Pointwise log-likelihoods are stored in single precision.
+
+    If pilot is given (a dictionary of MCMC parameters for a short run), all candidates
+    are first sampled with it, and candidates whose elpd is more than dominance standard
+    errors below the best one are not sampled again with MCMCparameters.
+
+    With ic = "evidence", every candidate is instead sampled once by sample_smc (with
+    MCMCparameters["draws"] particles and MCMCparameters["chains"] chains) and ranked
+    by its log marginal likelihood. The weights are the posterior probabilities of the
+    candidates for equal prior probabilities. pilot is not used.
+
+    Returns the comparison table and a dictionary of traces keyed by nGauss.
+    """
+    pars = {**pars, "method": "gaussian"}
+
+    # Calculate distance vector and kernel once for all candidate models; they are
+    # copied to the workers by _initworker
+    r = _distancegrid(t, pars["r"], pars["rmax_opt"] if "rmax_opt" in pars else "user")
+    K0 = dl.dipolarkernel(t, r, integralop=True)
+    pars.update({"r": r, "rmax_opt": "user", "K0": K0})
+
+    if cores is None:
+        cores = len(nGauss)
+
+    if ic == "evidence":
+        with ProcessPoolExecutor(max_workers=cores, initializer=_initworker, initargs=(t, Vexp, pars)) as pool:
+            seeds = [None if seed is None else seed + n for n in nGauss]
+            traces = dict(zip(nGauss, pool.map(_evidencecandidate, nGauss, [MCMCparameters]*len(nGauss), seeds)))
+        return _comparebyevidence(traces), traces
+
+    with ProcessPoolExecutor(max_workers=cores, initializer=_initworker, initargs=(t, Vexp, pars)) as pool:
+
+        candidates = list(nGauss)
+        dominated = []
+        if pilot is not None:
+            traces = _samplecandidates(pool, candidates, pilot, seed)
+            comparison = az.compare(traces, ic=ic)
+            for n in candidates:
+                if comparison.loc[n, "elpd_diff"] > dominance*comparison.loc[n, "dse"]:
+                    dominated.append(n)
+            candidates = [n for n in candidates if n not in dominated]
+            if dominated:
+                print(f"Dominated after pilot run: nGauss = {dominated}")
+
+        traces = _samplecandidates(pool, candidates, MCMCparameters, seed)
+
+    comparison = az.compare(traces, ic=ic)
+    comparison.attrs["dominated"] = dominated
+
+    return comparison, traces
+
+def _initworker(t, Vexp, pars):
+    _shared.update({"t": t, "Vexp": Vexp, "pars": pars})
+
+def _samplecandidates(pool, candidates, MCMCparameters, seed):
+    """
+    Samples the Gaussian model for all numbers of Gaussians in candidates on the pool.
+    """
+    seeds = [None if seed is None else seed + n for n in candidates]
+    results = pool.map(_samplecandidate, candidates, [MCMCparameters]*len(candidates), seeds)
+    return dict(zip(candidates, results))
+
+def _samplecandidate(n, MCMCparameters, seed):
+    """
+    Worker: builds and samples the model with n Gaussians, sampling chains
+    sequentially since the candidates already run in parallel.
+    """
+    model_dic = model(_shared["t"], _shared["Vexp"], {**_shared["pars"], "nGauss": n})
+    MCMCparameters = {**MCMCparameters, "cores": 1, "progressbar": False, "idata_kwargs": {"log_likelihood": True}}
+    trace = sample(model_dic, MCMCparameters, seed=seed)
+
+    # Store the pointwise log-likelihood compactly
+    trace.log_likelihood["V"] = trace.log_likelihood["V"].astype(np.float32)
+
+    return trace
+
+def _evidencecandidate(n, MCMCparameters, seed):
+    """
+    Worker: builds the model with n Gaussians and samples it by sequential Monte
+    Carlo, running the chains sequentially since the candidates already run in parallel.
+    """
+    model_dic = model(_shared["t"], _shared["Vexp"], {**_shared["pars"], "nGauss": n})
+    SMCparameters = {key: MCMCparameters[key] for key in ["draws", "chains"] if key in MCMCparameters}
+    return sample_smc(model_dic, **SMCparameters, cores=1, seed=seed)
+
+def _comparebyevidence(traces):
+    """
+    Returns the table of candidates ranked by their log evidence (mean over chains),
+    with its standard error (from the spread over chains) and the posterior
+    probability of every candidate.
+    """
+    logZ = {n: trace.sample_stats["log_marginal_likelihood"].values.ravel() for n, trace in traces.items()}
+    comparison = pd.DataFrame({
+        "log_evidence": {n: values.mean() for n, values in logZ.items()},
+        "se": {n: values.std(ddof=1)/np.sqrt(len(values)) if len(values) > 1 else np.nan for n, values in logZ.items()},
+    }).sort_values("log_evidence", ascending=False)
+    comparison.insert(0, "rank", np.arange(len(comparison)))
+    comparison["evidence_diff"] = comparison["log_evidence"].iloc[0] - comparison["log_evidence"]
+    comparison["weight"] = np.exp(-comparison["evidence_diff"])/np.sum(np.exp(-comparison["evidence_diff"]))
+    comparison.attrs["dominated"] = []
+    return comparison
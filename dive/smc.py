@@ -0,0 +1,337 @@
+import numpy as np
+import arviz as az
+from concurrent.futures import ProcessPoolExecutor
+from scipy import stats
+from scipy.special import gammaln, logsumexp, expit, erfcx
+
+from .deer import multigauss
+from .utils import FWHM2sigma
+from .models import _wmin, _wmax
+
+# Data of the model shared with the worker processes of sample_smc (set by _initworker)
+_shared = {}
+
+# Prior table of the widths, calculated once per session (see _wprior)
+_cache = {}
+
+def sample_smc(model_dic, draws=2000, chains=4, cores=None, threshold=0.5, max_steps=100, seed=None):
+    """
+    Samples the Gaussian model by sequential Monte Carlo and returns an InferenceData
+    with draws particles per chain and the estimated log marginal likelihood (evidence)
+    of every chain in sample_stats["log_marginal_likelihood"].
+
+    The particles are drawn from the prior and moved through tempered posteriors
+    prior*likelihood^beta, with every increment of beta chosen such that the effective
+    sample size of the reweighted particles is threshold*draws. After resampling, the
+    particles are mutated by differential-evolution Metropolis steps in an
+    unconstrained space until they are decorrelated from their start (at most
+    max_steps steps), with a proposal scale that is adapted between the stages. The
+    log prior and the log likelihood of all particles are evaluated as one batch,
+    with a single product with the kernel K0. The
+    hyperparameter w_mu is integrated out of the prior of the widths, which leaves the
+    evidence unchanged.
+
+    The chains are independent runs on cores processes, and the spread of their
+    evidence estimates is a measure of its error (too few particles or steps bias it
+    low). The evidence refers to the data scaled to max 1 (see model), which shifts it
+    by the same amount for every nGauss.
+
+    based on:
+    N. Chopin, O. Papaspiliopoulos, An Introduction to Sequential Monte Carlo,
+    Springer (2020) https://doi.org/10.1007/978-3-030-47845-2
+    C.J.F. ter Braak, A Markov Chain Monte Carlo version of the genetic algorithm
+    Differential Evolution, Stat. Comput. 16 (2006) 239-249
+    https://doi.org/10.1007/s11222-006-8769-1
+    """
+    pars = model_dic['pars']
+    if pars['method'] != "gaussian":
+        raise ValueError("Sequential Monte Carlo is only available for the Gaussian model.")
+
+    data = {"t": np.asarray(pars['t'], dtype=float), "Vexp": np.asarray(pars['Vexp'], dtype=float),
+            "K0": np.asarray(pars['K0'], dtype=float), "r": np.asarray(pars['r'], dtype=float),
+            "nGauss": pars['nGauss'], "background": pars['background'], "wprior": _wprior()}
+
+    cores = min(chains if cores is None else cores, chains)
+    seeds = np.random.SeedSequence(seed).spawn(chains)
+    args = (draws, threshold, max_steps)
+    print(f"Sequential Monte Carlo: {draws} particles per chain, {chains} chains in {cores} jobs")
+    if cores > 1:
+        with ProcessPoolExecutor(max_workers=cores, initializer=_initworker, initargs=(data,)) as pool:
+            results = list(pool.map(_chain, seeds, *[[arg]*chains for arg in args]))
+    else:
+        _shared.update(data)
+        results = [_chain(s, *args) for s in seeds]
+
+    posterior = {key: np.array([result["values"][key] for result in results]) for key in results[0]["values"]}
+    sample_stats = {"log_marginal_likelihood": np.array([result["logZ"] for result in results])}
+    idata = az.from_dict(posterior=posterior, sample_stats=sample_stats, observed_data={"V": pars['Vexp']})
+    stages = [len(result["betas"]) - 1 for result in results]
+    idata.sample_stats.attrs.update({"stages": stages, "mutation_steps": [int(result["steps"].sum()) for result in results]})
+
+    logZ = sample_stats["log_marginal_likelihood"]
+    print(f"Log evidence:       {logZ.mean():.2f} ± {logZ.std(ddof=1) if chains > 1 else np.nan:.2f} (mean and std over chains, {np.mean(stages):.0f} stages)")
+
+    return idata
+
+def _initworker(data):
+    _shared.update(data)
+
+def _chain(seed, draws, threshold, max_steps, correlation=0.01, target=0.234):
+    """
+    Worker: runs one SMC chain and returns the final particles, the log evidence and
+    the sequence of inverse temperatures.
+    """
+    rng = np.random.default_rng(seed)
+
+    z = _drawprior(rng, draws)
+    lp, ll = _logdensity(z)
+    n = z.shape[1]
+    scale = 2.38/np.sqrt(2*n)
+
+    beta, betas, steps, logZ = 0.0, [0.0], [], 0.0
+    while beta < 1:
+
+        # Next inverse temperature by bisection on the effective sample size
+        def ess(b):
+            logw = (b - beta)*ll
+            w = np.exp(logw - logw.max())
+            return w.sum()**2/np.sum(w**2)
+        if ess(1.0) >= threshold*draws:
+            newbeta = 1.0
+        else:
+            low, high = beta, 1.0
+            while high - low > 1e-10:
+                mid = (low + high)/2
+                low, high = (mid, high) if ess(mid) >= threshold*draws else (low, mid)
+            newbeta = low if low > beta else high
+
+        # Reweight and resample (systematic)
+        logw = (newbeta - beta)*ll
+        logZ += logsumexp(logw) - np.log(draws)
+        weights = np.exp(logw - logsumexp(logw))
+        idx = np.minimum(np.searchsorted(np.cumsum(weights), (rng.random() + np.arange(draws))/draws), draws-1)
+        z, lp, ll = z[idx], lp[idx], ll[idx]
+        beta = newbeta
+        betas.append(beta)
+
+        # Mutate by differential-evolution Metropolis steps: each half of the particles
+        # proposes moves along differences of two particles of the other half, which
+        # follow the shape of the tempered posterior (with jumps between its modes for
+        # gamma = 1), until the particles are decorrelated from their start
+        zstart = z.copy()
+        halves = np.array_split(rng.permutation(draws), 2)
+        acceptance = []
+        for step in range(max_steps):
+            gamma = 1.0 if step % 10 == 9 else scale
+            for half, other in [halves, halves[::-1]]:
+                i, j = rng.choice(other, len(half)), rng.choice(other, len(half))
+                znew = z[half] + gamma*(z[i] - z[j]) + 1e-4*rng.standard_normal((len(half), n))
+                lpnew, llnew = _logdensity(znew)
+                accept = np.log(rng.random(len(half))) < (lpnew + beta*llnew) - (lp[half] + beta*ll[half])
+                z[half[accept]], lp[half[accept]], ll[half[accept]] = znew[accept], lpnew[accept], llnew[accept]
+                if gamma != 1.0:
+                    acceptance.append(accept.mean())
+            if np.mean(_correlation(zstart, z)) < correlation:
+                break
+        steps.append(step + 1)
+
+        # Adapt the proposal scale to the acceptance rate of this stage; it is only
+        # changed between stages, so that every stage mutates with a fixed kernel
+        if acceptance:
+            scale *= np.exp(2*(np.mean(acceptance) - target))
+
+    return {"values": _deterministics(_backward(z)[0]), "logZ": logZ, "betas": np.array(betas), "steps": np.array(steps)}
+
+def _drawprior(rng, N):
+    """
+    Returns the unconstrained coordinates (see _backward) of N draws from the prior of
+    the Gaussian model (see multigaussmodel).
+    """
+    nGauss = _shared["nGauss"]
+    r0_rel = np.sort(rng.beta(2, 2, (N, nGauss)), axis=1)
+    a = rng.dirichlet(np.ones(nGauss), N)
+    lamb = rng.beta(1.3, 2.0, N)
+    bkgd = np.log(rng.exponential(0.1, N)) if _shared["background"] == "k" else _logit(rng.beta(1.0, 1.5, N))
+    V0 = stats.truncnorm.rvs(-5, np.inf, loc=1, scale=0.2, size=N, random_state=rng)
+    sigma = rng.gamma(0.7, 1/2, N)
+
+    # Widths from the truncated normal distribution around w_mu, as distances delta
+    # from _wmax. For w_mu far above _wmax, delta is drawn from an exponential
+    # distribution with rejection, which is exact and resolves delta << 1e-16.
+    W = _wmax - _wmin
+    w_mu = stats.invgamma.rvs(0.1, scale=0.2, size=(N, nGauss), random_state=rng)
+    delta = np.empty_like(w_mu)
+    near = w_mu < _wmax + 10
+    delta[near] = _wmax - stats.truncnorm.rvs(_wmin - w_mu[near], _wmax - w_mu[near], loc=w_mu[near], random_state=rng)
+    far = np.flatnonzero(~near)
+    while len(far):
+        c = w_mu.flat[far] - _wmax
+        d = -np.log1p(rng.random(len(far))*np.expm1(-c*W))/c
+        accepted = rng.random(len(far)) < np.exp(-d**2/2)
+        delta.flat[far[accepted]] = d[accepted]
+        far = far[~accepted]
+    logdelta = np.log(delta/W)/10
+    w = logdelta - np.log(-np.expm1(logdelta))
+
+    columns = [_logit(r0_rel), w, np.log(a[:, :-1]/a[:, -1:]), _logit(lamb)[:, None], bkgd[:, None], np.log(V0)[:, None], np.log(sigma)[:, None]]
+    return np.concatenate(columns, axis=1)
+
+def _backward(z):
+    """
+    Returns the parameters of the particles with unconstrained coordinates z, and the
+    log Jacobian determinant of the transformation. The widths w enter as logits of
+    ((_wmax - w)/(_wmax - _wmin))^0.1, which spreads out the prior mass concentrated
+    near _wmax (see _wprior). Their prior density is given by _logwprior.
+    """
+    nGauss = _shared["nGauss"]
+    parts = np.split(z, np.cumsum([nGauss, nGauss, nGauss-1, 1, 1, 1]), axis=1)
+    params, logjac = {}, 0
+
+    params["r0_rel"] = expit(parts[0])
+    logjac += np.sum(np.log(params["r0_rel"]) + np.log1p(-params["r0_rel"]), axis=1)
+    params["w"] = _wmin - (_wmax - _wmin)*np.expm1(-10*np.logaddexp(0, -parts[1]))
+
+    # Additive log-ratio transform of the amplitudes
+    logits = np.concatenate([parts[2], np.zeros((len(z), 1))], axis=1)
+    loga = logits - logsumexp(logits, axis=1, keepdims=True)
+    params["a"] = np.exp(loga)
+    logjac += np.sum(loga, axis=1)
+
+    params["lamb"] = expit(parts[3][:, 0])
+    logjac += np.log(params["lamb"]) + np.log1p(-params["lamb"])
+    if _shared["background"] == "k":
+        params["k"] = np.exp(parts[4][:, 0])
+        logjac += parts[4][:, 0]
+    else:
+        params["Bend"] = expit(parts[4][:, 0])
+        logjac += np.log(params["Bend"]) + np.log1p(-params["Bend"])
+    params["V0"] = np.exp(parts[5][:, 0])
+    logjac += parts[5][:, 0]
+    params["sigma"] = np.exp(parts[6][:, 0])
+    logjac += parts[6][:, 0]
+
+    return params, logjac
+
+def _logdensity(z):
+    """
+    Returns the log prior (including the Jacobian of the transformation) and the log
+    likelihood of the particles with unconstrained coordinates z.
+    """
+    params, logjac = _backward(z)
+    nGauss = _shared["nGauss"]
+
+    lp = logjac + np.sum(stats.beta.logpdf(params["r0_rel"], 2, 2), axis=1)
+    lp += np.sum(_logwprior(z[:, nGauss:2*nGauss]), axis=1)
+    lp += gammaln(nGauss)
+    lp += stats.beta.logpdf(params["lamb"], 1.3, 2.0)
+    if "k" in params:
+        lp += stats.expon.logpdf(params["k"], scale=0.1)
+    else:
+        lp += stats.beta.logpdf(params["Bend"], 1.0, 1.5)
+    lp += _logtruncnorm((params["V0"] - 1)/0.2, -5, np.inf) - np.log(0.2)
+    lp += stats.gamma.logpdf(params["sigma"], 0.7, scale=1/2)
+
+    # Model signals of all particles from a single product with the kernel
+    t, Vexp = _shared["t"], _shared["Vexp"]
+    r0 = np.sort(params["r0_rel"], axis=1)*(_shared["r"].max() - _shared["r"].min()) + _shared["r"].min()
+    P = multigauss(_shared["r"], r0, FWHM2sigma(params["w"]), params["a"])
+    Vmodel = P@_shared["K0"].T
+    Vmodel = (1 - params["lamb"][:, None]) + params["lamb"][:, None]*Vmodel
+    Vmodel *= np.exp(-np.abs(t)*_rate(params)[:, None])
+    Vmodel *= params["V0"][:, None]
+    sigma = params["sigma"]
+    ll = -len(t)*(np.log(sigma) + 0.5*np.log(2*np.pi)) - 0.5*np.sum((Vexp - Vmodel)**2, axis=1)/sigma**2
+
+    # The model only depends on the sorted centers, so the particles are restricted to
+    # ascending r0_rel, one of the nGauss! equivalent modes. Particles outside the
+    # floating-point range of the transformation are rejected as well.
+    ascending = np.all(np.diff(z[:, :nGauss], axis=1) >= 0, axis=1)
+    lp = np.where(ascending & np.isfinite(lp) & np.isfinite(ll), lp, -np.inf)
+    ll = np.where(np.isfinite(ll), ll, -np.inf)
+    return lp, ll
+
+def _deterministics(params):
+    """
+    Returns the variables reported for the Gaussian model by sample.
+    """
+    r = _shared["r"]
+    r0 = np.sort(params["r0_rel"], axis=1)*(r.max() - r.min()) + r.min()
+    values = {"r0": r0, "w": params["w"], "lamb": params["lamb"], "V0": params["V0"], "sigma": params["sigma"]}
+    if _shared["nGauss"] > 1:
+        values["a"] = params["a"]
+    k = _rate(params)
+    values.update({"k": k, "Bend": np.exp(-k*_shared["t"][-1])})
+    values["P"] = multigauss(r, r0, FWHM2sigma(params["w"]), params["a"])
+    return values
+
+def _correlation(x, y):
+    """
+    Returns the correlation between the columns of x and y.
+    """
+    x, y = x - x.mean(axis=0), y - y.mean(axis=0)
+    return np.sum(x*y, axis=0)/np.sqrt(np.sum(x**2, axis=0)*np.sum(y**2, axis=0))
+
+def _rate(params):
+    return params["k"] if "k" in params else -np.log(params["Bend"])/_shared["t"][-1]
+
+def _logit(p):
+    return np.log(p) - np.log1p(-p)
+
+def _logwprior(u):
+    """
+    Returns the log prior density of the coordinates u of the widths, interpolated from
+    the table of _wprior and extrapolated linearly into the exponential tails.
+    """
+    grid, logp = _shared["wprior"]
+    slopes = np.diff(logp[[0, 1, -2, -1]])[[0, 2]]/(grid[1] - grid[0])
+    return np.where(u < grid[0], logp[0] + slopes[0]*(u - grid[0]),
+                    np.where(u > grid[-1], logp[-1] + slopes[1]*(u - grid[-1]), np.interp(u, grid, logp)))
+
+def _wprior():
+    """
+    Returns a grid of the coordinates u of the widths w (see _backward) and the log
+    prior density of u, in which the hyperparameter w_mu of multigaussmodel is
+    integrated out numerically over log(w_mu). Most of the prior mass of w_mu lies far
+    above _wmax, where w is concentrated within 1/w_mu of _wmax, so sampling w_mu
+    would require the particles to follow a narrow funnel. The marginal prior density
+    of w diverges as (_wmax - w)^-0.9, which the power 0.1 in u compensates.
+    """
+    if "wprior" not in _cache:
+        W = _wmax - _wmin
+        grid = np.linspace(-20, 20, 801)
+        v = np.linspace(-25, 215, 12001)
+        w_mu = np.exp(v)
+        logprior = stats.invgamma.logpdf(w_mu, 0.1, scale=0.2) + v
+
+        # For w_mu above _wmax, the truncated normal density is evaluated in terms of
+        # the distance delta of w from _wmax and c = w_mu - _wmax
+        c = np.maximum(w_mu - _wmax, 1e-300)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            lognorm = 0.5*np.log(2/np.pi) - np.log(erfcx(c/np.sqrt(2))) - np.log1p(-np.exp(np.log(erfcx((c + W)/np.sqrt(2))) - np.log(erfcx(c/np.sqrt(2))) - W*(2*c + W)/2))
+
+        logp = np.empty_like(grid)
+        for i, u in enumerate(grid):
+            delta = W*np.exp(-10*np.logaddexp(0, -u))
+            logtn = np.where(w_mu > _wmax, -delta*(2*c + delta)/2 + lognorm, _logtruncnorm(_wmax - delta - w_mu, _wmin - w_mu, _wmax - w_mu))
+            logp[i] = logsumexp(logtn + logprior) + np.log(v[1] - v[0]) + np.log(10*delta) - np.logaddexp(0, u)
+        _cache["wprior"] = grid, logp
+    return _cache["wprior"]
+
+def _logtruncnorm(x, a, b):
+    """
+    Returns the log density at x of the standard normal distribution truncated to
+    [a, b], accurately also for bounds far in one tail (where Phi(y) is expressed by
+    the scaled complementary error function).
+    """
+    # Mirror the upper tail onto the lower tail
+    flip = a > 0
+    x, a, b = np.where(flip, -x, x), np.where(flip, -b, a), np.where(flip, -a, b)
+    tail = b < 0
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        central = stats.norm.logpdf(x) - np.log(stats.norm.cdf(b) - stats.norm.cdf(a))
+        x, a, b = np.where(tail, x, -1), np.where(tail, a, -2), np.where(tail, b, -1)
+        logratio = np.log(erfcx(-a/np.sqrt(2))) - np.log(erfcx(-b/np.sqrt(2))) - (a - b)*(a + b)/2   # log(Phi(a)/Phi(b))
+        lower = -(x - b)*(x + b)/2 + 0.5*np.log(2/np.pi) - np.log(erfcx(-b/np.sqrt(2))) - np.log1p(-np.exp(logratio))
+
+    return np.where(tail, lower, central)
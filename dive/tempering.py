@@ -0,0 +1,193 @@
+import numpy as np
+import arviz as az
+import pytensor
+import cloudpickle
+from concurrent.futures import ProcessPoolExecutor
+from scipy.linalg import solve_triangular
+from pymc.blocking import DictToArrayBijection, RaveledVars
+from pymc.initial_point import make_initial_point_fns_per_chain
+from pymc.pytensorf import compile_pymc, join_nonshared_inputs
+
+# Compiled functions shared with the worker processes of paralleltempering (set by _initworker)
+_shared = {}
+
+def paralleltempering(model, MCMCparameters, tempering, seed=None):
+    """
+    Samples a PyMC model by parallel tempering (replica exchange) and returns an
+    InferenceData with the draws of the untempered replicas.
+
+    Every chain runs a ladder of nbetas replicas that target prior*likelihood^beta,
+    with inverse temperatures beta spaced geometrically from 1 down to beta_min.
+    Each replica makes one Hamiltonian Monte Carlo transition (with
+    tempering["leapfrog"] leapfrog steps) in the transformed space between rounds of
+    swap moves between all neighboring temperatures, and every round gives one draw.
+    During tuning, the step size and mass matrix of every replica are adapted to its
+    acceptance rate and to the covariance of its draws, and the temperature spacing is
+    adapted so that all neighboring pairs swap equally often (with beta = 1 fixed).
+
+    The chains start from MCMCparameters["initvals"] if given, and otherwise from the
+    initial point of the model with jitter. They run in parallel on
+    MCMCparameters["cores"] processes. The swap acceptance of every pair of
+    neighboring replicas is reported in sample_stats["swap_accepted"], and the final
+    ladders and mean swap acceptance in sample_stats.attrs.
+
+    based on:
+    W.D. Vousden, W.M. Farr, I. Mandel, Dynamic temperature selection for parallel
+    tempering in Markov chain Monte Carlo simulations, Mon. Not. R. Astron. Soc. 455
+    (2016) 1919-1937 https://doi.org/10.1093/mnras/stv2422
+    """
+    defaults = {"nbetas": 8, "beta_min": 0.01, "leapfrog": 10}
+    tempering = {**defaults, **tempering}
+    betas = np.geomspace(1, tempering["beta_min"], tempering["nbetas"])
+
+    chains = MCMCparameters["chains"]
+    cores = min(MCMCparameters["cores"] if "cores" in MCMCparameters else 1, chains)
+    initvals = MCMCparameters["initvals"] if "initvals" in MCMCparameters else None
+
+    # Log prior (with Jacobians), log likelihood and their gradients as functions of
+    # the raveled values
+    start = model.initial_point()
+    point = {var.name: start[var.name] for var in model.value_vars}
+    [logprior, loglike], x = join_nonshared_inputs(point, [model.logp(vars=model.free_RVs), model.logp(vars=model.observed_RVs)], model.value_vars)
+    logp = compile_pymc([x], [logprior, loglike, pytensor.grad(logprior, x), pytensor.grad(loglike, x)])
+    outvars = [var for var in model.unobserved_value_vars if not var.name.endswith("__")]
+    deterministics = model.compile_fn(outvars, inputs=model.value_vars, on_unused_input="ignore", point_fn=True)
+    fns = {"logp": logp, "deterministics": deterministics, "pointinfo": DictToArrayBijection.map(point).point_map_info}
+
+    # Starting points of the chains
+    seeds = np.random.SeedSequence(seed).spawn(chains)
+    startfns = make_initial_point_fns_per_chain(model=model, overrides=initvals, jitter_rvs=set(), chains=chains)
+    starts = [fn(int(s.generate_state(1)[0])) for fn, s in zip(startfns, seeds)]
+    x0 = [DictToArrayBijection.map({name: start[name] for name in point}).data for start in starts]
+
+    args = (betas, MCMCparameters["tune"], MCMCparameters["draws"], tempering["leapfrog"], initvals is None)
+    print(f"Parallel tempering: {len(betas)} replicas per chain, {chains} chains in {cores} jobs")
+    if cores > 1:
+        with ProcessPoolExecutor(max_workers=cores, initializer=_initworker, initargs=(cloudpickle.dumps(fns),)) as pool:
+            results = list(pool.map(_chain, seeds, x0, *[[arg]*chains for arg in args]))
+    else:
+        _shared.update(fns)
+        results = [_chain(s, x, *args) for s, x in zip(seeds, x0)]
+
+    # Collect the draws of the untempered replicas
+    posterior = {var.name: np.array([result["values"][i] for result in results]) for i, var in enumerate(outvars)}
+    sample_stats = {
+        "acceptance_rate": np.array([result["acceptance_rate"] for result in results]),
+        "swap_accepted": np.array([result["swap_accepted"] for result in results]),
+    }
+    idata = az.from_dict(posterior=posterior, sample_stats=sample_stats, dims={"swap_accepted": ["replica_pair"]})
+
+    swap_acceptance = np.mean(sample_stats["swap_accepted"], axis=(0, 1))
+    ladders = np.array([result["betas"] for result in results])
+    idata.sample_stats.attrs.update({"betas": ladders.tolist(), "swap_acceptance": swap_acceptance.tolist(), "leapfrog": tempering["leapfrog"]})
+    print(f"Swap acceptance:    {np.array2string(swap_acceptance, precision=2)}")
+    print(f"Inverse temp.:      {np.array2string(ladders.mean(axis=0), precision=3)} (mean over chains)")
+
+    return idata
+
+def _initworker(fns):
+    _shared.update(cloudpickle.loads(fns))
+
+def _chain(seed, x0, betas, tune, draws, leapfrog, jitter, target=0.65, nu=100, t0=1000):
+    """
+    Worker: runs one chain (a ladder of replicas) started from x0, and returns the
+    values, acceptance rates and swap acceptances of the untempered replica and the
+    final ladder. nu and t0 set the rate of the ladder adaptation (Vousden et al.).
+    """
+    rng = np.random.default_rng(seed)
+    nbetas, n = len(betas), len(x0)
+
+    # Starting points, jittered as in pm.sample
+    x = np.tile(x0, (nbetas, 1))
+    if jitter:
+        x += rng.uniform(-1, 1, size=(nbetas, n))
+    states = [_evaluate(xi) for xi in x]
+    logeps = np.full(nbetas, np.log(0.1))
+    C_L = np.tile(np.identity(n), (nbetas, 1, 1))
+    window, windowdraws, windowstart = 50, [], 0
+
+    # Log spacings of the temperatures 1/beta
+    S = np.log(np.diff(1/betas))
+
+    values, acceptance_rate, swap_accepted = [], [], []
+    for it in range(tune + draws):
+
+        # One HMC transition of every replica
+        accept = np.zeros(nbetas)
+        for b in range(nbetas):
+            eps = np.exp(logeps[b])*rng.uniform(0.8, 1.2)
+            x[b], states[b], accept[b] = _hmc(x[b], states[b], betas[b], eps, C_L[b], leapfrog, rng)
+
+        # Swap moves between neighboring temperatures, from hot to cold
+        ll = np.array([state[1] for state in states])
+        swaps = np.zeros(nbetas-1)
+        for b in reversed(range(nbetas-1)):
+            if np.log(rng.uniform()) < (betas[b] - betas[b+1])*(ll[b+1] - ll[b]):
+                x[[b, b+1]] = x[[b+1, b]]
+                states[b], states[b+1] = states[b+1], states[b]
+                ll[[b, b+1]] = ll[[b+1, b]]
+                swaps[b] = 1
+
+        if it < tune:
+            # Adapt the step size to the acceptance rate, and the mass matrix to the
+            # covariance of the draws in windows of doubling length
+            logeps += (accept - target)/np.sqrt(it - windowstart + 1)
+            windowdraws.append(x.copy())
+            if len(windowdraws) == window and it + window < tune:
+                windowdraws = np.array(windowdraws)
+                for b in range(nbetas):
+                    C_L[b] = np.linalg.cholesky(np.cov(windowdraws[:, b], rowvar=False) + 1e-8*np.identity(n))
+                logeps[:] = np.log(0.5)
+                window, windowdraws, windowstart = 2*window, [], it + 1
+
+            # Equalize the swap acceptance of neighboring pairs
+            S[:-1] += (swaps[:-1] - swaps[1:])/nu*t0/(it + t0)
+            betas = 1/np.concatenate([[1], 1 + np.cumsum(np.exp(S))])
+        else:
+            point = DictToArrayBijection.rmap(RaveledVars(x[0], _shared["pointinfo"]))
+            values.append(_shared["deterministics"](point))
+            acceptance_rate.append(accept[0])
+            swap_accepted.append(swaps)
+
+    return {
+        "values": [np.array([v[i] for v in values]) for i in range(len(values[0]))],
+        "acceptance_rate": np.array(acceptance_rate),
+        "swap_accepted": np.array(swap_accepted),
+        "betas": betas,
+    }
+
+def _evaluate(x):
+    """
+    Returns the log prior, log likelihood and their gradients at x.
+    """
+    lp, ll, glp, gll = _shared["logp"](x)
+    if not (np.isfinite(lp) and np.isfinite(ll) and np.all(np.isfinite(glp)) and np.all(np.isfinite(gll))):
+        return -np.inf, -np.inf, glp, gll
+    return float(lp), float(ll), glp, gll
+
+def _hmc(x, state, beta, eps, C_L, leapfrog, rng):
+    """
+    One HMC transition for the target log prior + beta*log likelihood, with mass
+    matrix inv(C_L*C_L'). Returns the new position and state and the acceptance
+    probability.
+    """
+    def gradient(state):
+        return state[2] + beta*state[3]
+
+    p = solve_triangular(C_L.T, rng.standard_normal(len(x)), lower=False)
+    H0 = -(state[0] + beta*state[1]) + 0.5*np.sum((C_L.T@p)**2)
+
+    xnew, new = x, state
+    p = p + 0.5*eps*gradient(new)
+    for i in range(leapfrog):
+        xnew = xnew + eps*(C_L@(C_L.T@p))
+        new = _evaluate(xnew)
+        if not np.isfinite(new[0]):
+            return x, state, 0.0
+        p = p + (eps if i < leapfrog-1 else 0.5*eps)*gradient(new)
+
+    H = -(new[0] + beta*new[1]) + 0.5*np.sum((C_L.T@p)**2)
+    accept = min(1.0, np.exp(H0 - H)) if np.isfinite(H) else 0.0
+    if rng.uniform() < accept:
+        return xnew, new, accept
+    return x, state, accept
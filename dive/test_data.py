@@ -1,27 +1,26 @@
-import deerlab as dl
 import numpy as np
 
+from .deer import dd_gauss, bg_exp
+from .utils import dipolarkernel
+
+def _whitegaussnoise(t,sigma,seed):
+    return np.random.default_rng(seed).normal(0,sigma,np.size(t))
+
 def generateSingleGauss(sigma = 0.01, r0 = 4, w = 0.4, nt = 150,  nr = 800, lamb = 0.5, k = 0.1, V0 = 1, seed = 0, r_edges = [1,10], t_edges = [-0.1,2.5]):
     t = np.linspace(t_edges[0],t_edges[1],nt)        # time axis, µs
     r = np.linspace(r_edges[0],r_edges[1],nr)      # distance axis, nm
 
-    P = dl.dd_gauss(r,[r0,w])          # model distance distribution
+    P = dd_gauss(r,r0,w)          # model distance distribution
 
-    B = dl.bg_exp(t,k)         # background decay
+    B = bg_exp(t,k)         # background decay
 
-    K = dl.dipolarkernel(t,r,integralop=True)    # kernel matrix
-    K[:,0] = 2*K[:,0]
-    K[:,-1] = 2*K[:,-1]
+    K = dipolarkernel(t,r)    # kernel matrix
 
     Sm = K@P
-    S = Sm + dl.whitegaussnoise(t,sigma,seed = seed)
-
-    KB = dl.dipolarkernel(t,r,mod=lamb,bg=B,integralop=True)
-    KB[:,0] = 2*KB[:,0]
-    KB[:,-1] = 2*KB[:,-1]
+    S = Sm + _whitegaussnoise(t,sigma,seed)
 
-    Vm = V0*KB@P
-    V = Vm + dl.whitegaussnoise(t,sigma,seed = seed)
+    Vm = V0*((1-lamb) + lamb*Sm)*B
+    V = Vm + _whitegaussnoise(t,sigma,seed)
 
     pars = {'gaussian': [r0,w], 'lamb': lamb, 'k': k, 'V0': V0, 'sigma': sigma, 'seed': seed}
     data = {'t': t, 'V': V, 'S': S, 'r': r, 'P': P, 'V0': Vm, 'S0': Sm}
@@ -32,23 +31,17 @@ def generateMultiGauss(sigma = 0.01, gausspars = [4, 0.3,0.6, 4.8, 0.5, 0.4], nt
     t = np.linspace(t_edges[0],t_edges[1],nt)        # time axis, µs
     r = np.linspace(r_edges[0],r_edges[1],nr)      # distance axis, nm
 
-    P = dl.dd_gauss2(r,gausspars)          # model distance distribution
+    P = dd_gauss(r,gausspars[0::3],gausspars[1::3],gausspars[2::3])          # model distance distribution
 
-    B = dl.bg_exp(t,k)         # background decay
+    B = bg_exp(t,k)         # background decay
 
-    K = dl.dipolarkernel(t,r,integralop=True)    # kernel matrix
-    K[:,0] = 2*K[:,0]
-    K[:,-1] = 2*K[:,-1]
+    K = dipolarkernel(t,r)    # kernel matrix
 
     Sm = K@P
-    S = Sm + dl.whitegaussnoise(t,sigma,seed = seed)
+    S = Sm + _whitegaussnoise(t,sigma,seed)
 
-    KB = dl.dipolarkernel(t,r,mod=lamb,bg=B,integralop=True)
-    KB[:,0] = 2*KB[:,0]
-    KB[:,-1] = 2*KB[:,-1]
-
-    Vm = V0*KB@P
-    V = Vm + + dl.whitegaussnoise(t,sigma,seed = seed)
+    Vm = V0*((1-lamb) + lamb*Sm)*B
+    V = Vm + + _whitegaussnoise(t,sigma,seed)
 
     pars = {'gaussians': gausspars, 'lamb': lamb, 'k': k, 'V0': V0, 'sigma': sigma, 'seed': seed}
     data = {'t': t, 'V': V, 'S': S, 'r': r, 'P': P, 'V0': Vm, 'S0': Sm}
@@ -59,23 +52,17 @@ def generateBiModalGauss(sigma = 0.01, gausspars = [4, 0.3,0.6, 6, 0.5, 0.4], nt
     r = np.linspace(r_edges[0],r_edges[1],nr)      # distance axis, nm
 
 
-    P = dl.dd_gauss2(r,gausspars)          # model distance distribution
+    P = dd_gauss(r,gausspars[0::3],gausspars[1::3],gausspars[2::3])          # model distance distribution
 
-    B = dl.bg_exp(t,k)         # background decay
+    B = bg_exp(t,k)         # background decay
 
-    K = dl.dipolarkernel(t,r,integralop=True)    # kernel matrix
-    K[:,0] = 2*K[:,0]
-    K[:,-1] = 2*K[:,-1]
+    K = dipolarkernel(t,r)    # kernel matrix
 
     Sm = K@P
-    S = Sm + dl.whitegaussnoise(t,sigma,seed = seed)
-
-    KB = dl.dipolarkernel(t,r,mod=lamb,bg=B,integralop=True)
-    KB[:,0] = 2*KB[:,0]
-    KB[:,-1] = 2*KB[:,-1]
+    S = Sm + _whitegaussnoise(t,sigma,seed)
 
-    Vm = V0*KB@P
-    V = Vm + + dl.whitegaussnoise(t,sigma,seed = seed)
+    Vm = V0*((1-lamb) + lamb*Sm)*B
+    V = Vm + + _whitegaussnoise(t,sigma,seed)
 
     pars = {'gaussians': gausspars, 'lamb': lamb, 'k': k, 'V0': V0, 'sigma': sigma, 'seed': seed}
     data = {'t': t, 'V': V, 'S': S, 'r': r, 'P': P, 'V0': Vm, 'S0': Sm}
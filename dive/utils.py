@@ -1,14 +1,14 @@
-from dataclasses import replace
 import numpy as np
 import math as m
-from pandas.core import indexers
 from scipy.special import fresnel
+import scipy.sparse as sp
 
 from .constants import *
-from .deerload import *
 
 import arviz as az
 from .plotting import *
+from .plotting import _thinnedtrace, _ensembleplot, _ensemble
+from .encoding import *
 
 def addnoise(V,sig):
 
@@ -39,7 +39,7 @@ def sigma2FWHM(sigma):
     return FWHM
 
 
-def dipolarkernel(t,r):
+def dipolarkernel(t,r,dtype=float):
     """
     K = dipolarkernel(t,r)
     Calculate dipolar kernel matrix.
@@ -50,7 +50,7 @@ def dipolarkernel(t,r):
     # Calculation using Fresnel integrals
     nr = np.size(r)
     nt = np.size(t)
-    K = np.zeros((nt, nr))
+    K = np.zeros((nt, nr), dtype=dtype)
     for ir in range(nr):
         ph = omega[ir]*np.abs(t)
         z = np.sqrt(6*ph/m.pi)
@@ -66,10 +66,26 @@ def dipolarkernel(t,r):
     
     return K
 
+def regoperator(n, dtype=float):
+    """
+    L = regoperator(n)
+    Second-order difference operator (without edges) for a vector with n elements,
+    as a sparse (n-2) x n matrix with the three diagonals [1, -2, 1].
+    """
+    return sp.diags([1, -2, 1], [0, 1, 2], shape=(n-2, n), dtype=dtype, format="csr")
+
 def interpret(trace,model_dic):
     
     class FitResult:
         def __init__(self,trace, model):
+            self.summary_P = trace.P_summary if "P_summary" in trace.groups() else None
+            # the trace as passed in, where posteriorPredictive caches its results
+            self._source = trace
+            trace = restoreDeterministics(decodeP(trace))
+            self.trace = trace
+            self.model = model
+            trace = _thinnedtrace(trace)
+
             # as of PyMC v5, parameters are now given as a (# of chains) * (# of draws) array
             d = {key: [draw.values for chain in trace.posterior[key] for draw in chain] for key in trace.posterior}
             self.__dict__.update(d)
@@ -78,7 +94,7 @@ def interpret(trace,model_dic):
             self.t = model['t']
             self.Vexp = model['Vexp']
             self.varnames = trace.posterior
-            self.trace = trace
+            self.posterior = trace.posterior
             self.K = dl.dipolarkernel(self.t, self.r)
             self.dr = self.r[1] - self.r[0]
             self.chain = trace.posterior.dims["chain"]
@@ -88,48 +104,32 @@ def interpret(trace,model_dic):
 
         def subsample_fits(self, n=100, seed=1):
             np.random.seed(seed)
-            idxs = np.random.choice(self.chain*self.draw, n, replace=False)
-            Ps = [self.P[idx].copy() for idx in idxs]
-            Bs, Vs = [], []
+            idxs = np.random.choice(self.chain*self.draw, min(n, self.chain*self.draw), replace=False)
 
-            for idx in idxs:
-                V_ = self.K@self.P[idx]
+            # all selected draws at once
+            posterior = self.posterior.stack(sample=("chain", "draw")).transpose("sample", ...).isel(sample=idxs)
+            Ps, Vs, Bs = _ensemble(posterior, self.r, self.t, self.K/self.dr)
 
-                if 'lamb' in self.varnames:
-                    V_ = (1-self.lamb[idx]) + self.lamb[idx]*V_
+            return list(Vs), list(Bs), list(Ps)
 
-                if 'k' in self.varnames:
-                    B = dl.bg_exp(self.t, self.k[idx])
-                    V_ *= B
-                    
-                    Blamb = (1-self.lamb[idx])*B
-                
-                if 'V0' in self.varnames:
-                    Blamb *= self.V0[idx]
-                    Bs.append(Blamb)
-                    V_ *= self.V0[idx]
-                Vs.append(V_)
-
-            return Vs, Bs, Ps
-
-        def plot(self,style = 'noodle',j =0.95):
+        def plot(self,style = 'noodle',j =0.95,n=100):
             plt.style.use('seaborn-darkgrid')
             
             plt.rcParams.update({'font.family':'serif'})
             if style == 'noodle':
                 fig, (ax1, ax2) = plt.subplots(2, figsize=(8, 8))
-                Vs, Bs, Ps = self.subsample_fits()
+                Vs, Bs, Ps = self.subsample_fits(n)
                 
-                ax1.plot(self.t, self.Vexp,'g.',linewidth=0.5,alpha = 0.3)
+                l0, = ax1.plot(self.t, self.Vexp,'g.',linewidth=0.5,alpha = 0.3)
 
-                for V, B, P in zip(Vs, Bs, Ps):
-                    ax2.plot(self.r, P, 'cornflowerblue', linewidth=0.3)
-                    ax1.plot(self.t, V,'#0000EE',linewidth=0.3)
-                    ax1.plot(self.t, B,'#FAD02C',linewidth=0.3)
-                    ax1.plot(self.t, V-self.Vexp,'#FF0080',linewidth=0.3)
+                # one collection (or density image) per ensemble
+                lP = _ensembleplot(ax2, self.r, Ps, 'cornflowerblue', linewidth=0.3)
+                lV = _ensembleplot(ax1, self.t, Vs, '#0000EE', linewidth=0.3)
+                lB = _ensembleplot(ax1, self.t, Bs, '#FAD02C', linewidth=0.3)
+                lR = _ensembleplot(ax1, self.t, np.asarray(Vs)-self.Vexp, '#FF0080', linewidth=0.3)
 
-                leg1= ax1.legend(['Data','Vexp','Background','Residuals'])
-                leg2 = ax2.legend(['Distance Distribution'])
+                leg1= ax1.legend([l0,lV,lB,lR],['Data','Vexp','Background','Residuals'])
+                leg2 = ax2.legend([lP],['Distance Distribution'])
 
                 for lh1,lh2 in zip(leg1.legendHandles,leg2.legendHandles): 
                     lh1.set_alpha(1)
@@ -140,19 +140,28 @@ def interpret(trace,model_dic):
 
             if style == 'mean-ci':
                 fig, (ax1, ax2) = plt.subplots(2, figsize=(8, 8))
-                Vs, Bs, Ps = self.subsample_fits()
+                # means and HDIs over all draws
+                bands = posteriorPredictive(self._source, self.model, hdi_prob=j)
                 
                 l0, = ax1.plot(self.t, self.Vexp,'#808080',marker='.',linewidth=0.5,alpha = 0.3,label = 'Data',linestyle='None')
 
-                Pmean = np.mean(Ps,0)
-                Phd = az.hdi(np.array(Ps),j) 
-
-                Vmean = np.mean(Vs,0)
-                Vhd = az.hdi(np.array(Vs),j) 
-                
-
-                Bmean = np.mean(Bs,0)
-                Bhd = az.hdi(np.array(Bs),j) 
+                if self.summary_P is not None:
+                    # running summaries over all draws, with an equal-tailed band
+                    quantiles = self.summary_P["quantile"].values
+                    Pmean = self.summary_P["mean"].values
+                    idx = [np.argmin(abs(quantiles-level)) for level in [(1-j)/2, (1+j)/2]]
+                    if not np.allclose(quantiles[idx], [(1-j)/2, (1+j)/2]):
+                        raise ValueError(f"The {(1-j)/2:g} and {(1+j)/2:g} quantiles of P needed for j = {j:g} were not tracked during sampling (P_summary quantiles: {list(quantiles)}).")
+                    Phd = self.summary_P["quantiles"].values[idx].T
+                else:
+                    Pmean = bands["P_mean"].values
+                    Phd = bands["P_hdi"].values.T
+
+                Vmean = bands["V_mean"].values
+                Vhd = bands["V_hdi"].values.T
+
+                Bmean = bands["B_mean"].values
+                Bhd = bands["B_hdi"].values.T
 
             
                 ax2.plot(self.r, Pmean, '#8E05D4', linewidth=1)
@@ -0,0 +1,4 @@
+import matplotlib
+
+# render figures without a display
+matplotlib.use("Agg")
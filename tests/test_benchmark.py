@@ -0,0 +1,27 @@
+import numpy as np
+import arviz as az
+
+from dive import test_data
+from dive.benchmark import _accuracy, _ess, _maxrhat
+
+def test_generators():
+    for generate in [test_data.generateSingleGauss, test_data.generateMultiGauss, test_data.generateBiModalGauss]:
+        data, pars = generate()
+        r = data["r"]
+        assert np.isclose(np.sum(data["P"])*(r[1]-r[0]), 1)
+        assert data["V"].shape == data["t"].shape
+        assert np.all(np.isfinite(data["V"]))
+
+def test_missing_variables():
+    # a trace without the key parameters and without lamb, V0 and sigma
+    rng = np.random.default_rng(0)
+    r = np.linspace(2, 8, 50)
+    P = np.exp(-(r - 4)**2/0.5)
+    trace = az.from_dict(posterior={"P": P + 0.01*rng.random((2, 20, len(r))), "tau": rng.random((2, 20))})
+    truth = {"r": r, "P": P, "lamb": 0.5, "k": 0.1, "V0": 1, "sigma": 0.01}
+
+    assert _maxrhat(trace) is None
+    assert set(_ess(trace, r)) == {"P_q10", "P_q50", "P_q90"}
+    accuracy = _accuracy(trace, {"pars": {"r": r, "Vscale": 1}}, truth)
+    assert set(accuracy) == {"P_rmse", "P_coverage"}
+    assert accuracy["P_rmse"] < 0.05
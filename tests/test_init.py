@@ -0,0 +1,30 @@
+import sys
+import subprocess
+
+import dive
+
+# Names reachable as dive.<name> before the package was made lazy
+_former = """BlockedStep D FWHM2sigma NA addnoise az bg_exp bg_exp_time bg_hom3d constants date dd_gauss deer
+deerload dipolarkernel display dl drawPosteriorSamples fnnls fresnel gauss ge generateBiModalGauss
+generateMultiGauss generateSingleGauss get_rhats h hbar indexers interpret key_press_handler loadTrace
+loadmat m model models mu0 muB multigaussmodel np os pairplot_chain pairplot_condition pairplot_divergence
+pi plotMCMC plot_hist plotcorrelations plotmarginals plotresult plotting plt pm printsummary prune_chains
+pt randDelta_posterior randPnorm_posterior randTau_posterior random re read_description_file
+regularizationmodel replace sample samplers saveTrace saving sigma2FWHM sqrtm summary test_data utils warn""".split()
+
+def test_import_is_lightweight():
+    # importing dive and using deerload and the DEER functions must not load the heavy dependencies
+    code = "import sys, dive; dive.deerload; dive.dd_gauss; print(','.join(sorted(sys.modules)))"
+    modules = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout.strip().split(",")
+    for heavy in ["pymc", "pytensor", "arviz", "deerlab", "matplotlib", "dive.models"]:
+        assert heavy not in modules
+
+def test_former_names_are_reachable():
+    missing = [name for name in _former if not hasattr(dive, name)]
+    assert not missing
+
+def test_public_functions_are_listed():
+    for module, names in dive._lazy.items():
+        public = [name for name, value in vars(getattr(dive, module)).items()
+                  if callable(value) and not name.startswith("_") and getattr(value, "__module__", None) == f"dive.{module}"]
+        assert set(public) <= set(names), module
@@ -0,0 +1,129 @@
+import pytest
+import numpy as np
+
+import dive
+from dive import models
+from dive import test_data
+
+def test_cache_is_bounded(monkeypatch):
+    monkeypatch.setattr(models, "_cachesize", 2)
+    dive.clearcache()
+    data, _ = test_data.generateSingleGauss(nt=60)
+    r = np.linspace(2, 8, 40)
+    for nt in [60, 50, 40]:
+        dive.model(data["t"][:nt], data["V"][:nt], {"method": "regularization", "r": r})
+    assert [key[1] for key in models._modelcache] == [50, 40]
+
+    # reusing a model makes it the most recently used one
+    dive.model(data["t"][:50], data["V"][:50], {"method": "regularization", "r": r})
+    assert [key[1] for key in models._modelcache] == [40, 50]
+
+    dive.clearcache()
+    assert not models._modelcache and not models._stepcache
+
+def test_gausstable_error():
+    data, _ = test_data.generateSingleGauss()
+    r = np.linspace(2, 7, 100)
+    K0 = dive.dipolarkernel(data["t"], r)
+    table = dive.gausstable(K0, r)
+    assert table.dtype == np.float32
+    assert dive.gausstable_error(K0, r, table) < 1e-3
+
+def test_float32_agrees_with_float64():
+    data, _ = test_data.generateSingleGauss(nt=100)
+    r = np.linspace(2, 7, 60)
+    MCMCparameters = {"draws": 300, "tune": 300, "chains": 2, "cores": 1, "progressbar": False}
+    traces = {}
+    for dtype in ["float64", "float32"]:
+        model_dic = dive.model(data["t"], data["V"], {"method": "regularization", "r": r, "dtype": dtype, "amp_sampler": "gibbs", "bkgd_sampler": "slice"})
+        traces[dtype] = dive.sample(model_dic, MCMCparameters, seed=1)
+    assert traces["float32"].posterior["P"].dtype == np.float32
+
+    for var in ["V0", "lamb", "Bend"]:
+        values = {dtype: trace.posterior[var].values for dtype, trace in traces.items()}
+        assert abs(values["float32"].mean() - values["float64"].mean()) < 0.5*values["float64"].std()
+    P32, P64 = (trace.posterior["P"].mean(dim=["chain", "draw"]).values for trace in traces.values())
+    assert np.max(np.abs(P32 - P64)) < 0.1*np.max(P64)
+
+def _regularizationfit(**kwargs):
+    data, _ = test_data.generateSingleGauss(nt=100)
+    model_dic = dive.model(data["t"], data["V"], {"method": "regularization", "r": np.linspace(2, 7, 40), "amp_sampler": "gibbs", "bkgd_sampler": "slice"})
+    MCMCparameters = {"draws": 50, "tune": 50, "chains": 2, "cores": 1, "progressbar": False}
+    return dive.sample(model_dic, MCMCparameters, seed=1, **kwargs), model_dic
+
+def test_P_summary_chains_are_independent(monkeypatch):
+    # the seaborn-darkgrid style of FitResult.plot is not available in newer matplotlib
+    monkeypatch.setattr(dive.utils.plt.style, "use", lambda style: None)
+    trace, model_dic = _regularizationfit(P_summary={"thin": 5, "quantiles": [0.025, 0.5, 0.975]})
+    lamb = trace.posterior["lamb"].values
+    assert not np.allclose(lamb[0], lamb[1])
+
+    fit = dive.interpret(trace, model_dic)
+    fit.plot(style="mean-ci", j=0.95)
+    with pytest.raises(ValueError):
+        fit.plot(style="mean-ci", j=0.9)
+
+def test_warmstart_shortens_burn_in():
+    data, _ = test_data.generateSingleGauss(nt=100)
+    model_dic = dive.model(data["t"], data["V"], {"method": "regularization", "r": np.linspace(2, 7, 60), "amp_sampler": "gibbs", "bkgd_sampler": "slice"})
+    reference = dive.sample(model_dic, {"draws": 1000, "tune": 500, "chains": 2, "cores": 1, "progressbar": False}, seed=0).posterior
+
+    # burn-in: number of draws (without tuning) until sigma enters the central 99%
+    # of the reference posterior
+    lower, upper = np.quantile(reference["sigma"].values, [0.005, 0.995])
+    burnin = {}
+    for warmstart in [False, True]:
+        trace = dive.sample(model_dic, {"draws": 100, "tune": 0, "chains": 4, "cores": 1, "progressbar": False}, seed=1, warmstart=warmstart)
+        inside = (trace.posterior["sigma"].values >= lower) & (trace.posterior["sigma"].values <= upper)
+        burnin[warmstart] = [np.argmax(chain) if chain.any() else len(chain) for chain in inside]
+    assert np.median(burnin[True]) < np.median(burnin[False])/3
+
+def test_stopping_time_budget_spent_in_tuning():
+    data, _ = test_data.generateSingleGauss(nt=100)
+    model_dic = dive.model(data["t"], data["V"], {"method": "regularization", "r": np.linspace(2, 7, 40), "amp_sampler": "gibbs", "bkgd_sampler": "slice"})
+    MCMCparameters = {"draws": 50, "tune": 100000, "chains": 2, "cores": 1, "progressbar": False}
+    with pytest.warns(UserWarning, match="cores"), pytest.raises(RuntimeError, match="tuning"):
+        dive.sample(model_dic, MCMCparameters, seed=1, stopping={"max_time": 1})
+
+def test_stopping_at_convergence_targets():
+    data, _ = test_data.generateSingleGauss(nt=100)
+    model_dic = dive.model(data["t"], data["V"], {"method": "gaussian", "nGauss": 1, "r": np.linspace(2, 7, 60)})
+    MCMCparameters = {"draws": 2000, "tune": 200, "chains": 2, "cores": 2, "progressbar": False}
+    trace = dive.sample(model_dic, MCMCparameters, seed=1, stopping={"block": 100, "rhat": 1.1, "ess_bulk": 50, "ess_tail": 50})
+    assert trace.sample_stats.attrs["stopping_reason"] == "convergence targets met"
+    assert trace.posterior.dims["draw"] < MCMCparameters["draws"]
+    assert trace.sample_stats.attrs["stopping_ess_bulk"] >= 50
+
+def test_dropped_deterministics_are_restored():
+    data, _ = test_data.generateSingleGauss(nt=100)
+    model_dic = dive.model(data["t"], data["V"], {"method": "gaussian", "nGauss": 1, "r": np.linspace(2, 7, 60)})
+    MCMCparameters = {"draws": 30, "tune": 30, "chains": 2, "cores": 1, "progressbar": False}
+    full = dive.sample(model_dic, MCMCparameters, seed=1)
+    trace = dive.sample(model_dic, MCMCparameters, seed=1, store_deterministics=False)
+    assert "r0" not in trace.posterior and "P" not in trace.posterior
+
+    # restored over the r and t of the model, whatever the caller uses
+    restored = dive.restoreDeterministics(trace)
+    for name in ["r0", "P", "k"]:
+        np.testing.assert_allclose(restored.posterior[name].values, full.posterior[name].values, rtol=1e-6)
+    dive.drawPosteriorSamples(trace, nDraws=10, r=np.linspace(1, 10, 100), t=model_dic["t"])
+
+    dive.printsummary(trace, model_dic)
+    dive.plotmarginals(trace)
+    dive.plotcorrelations(trace, model_dic)
+
+def test_tempering_stores_untransformed_variables():
+    data, _ = test_data.generateSingleGauss(nt=100)
+    model_dic = dive.model(data["t"], data["V"], {"method": "gaussian", "nGauss": 1, "r": np.linspace(2, 7, 60)})
+    MCMCparameters = {"draws": 10, "tune": 10, "chains": 1, "cores": 1, "progressbar": False}
+    trace = dive.sample(model_dic, MCMCparameters, seed=1, warmstart=True, tempering={"nbetas": 2, "leapfrog": 3})
+    assert not [name for name in trace.posterior.data_vars if name.endswith("__")]
+    assert {"r0", "w", "sigma", "P"} <= set(trace.posterior.data_vars)
+
+def test_tempering_rejects_unsupported_options():
+    data, _ = test_data.generateSingleGauss(nt=100)
+    model_dic = dive.model(data["t"], data["V"], {"method": "gaussian", "nGauss": 1, "r": np.linspace(2, 7, 60)})
+    MCMCparameters = {"draws": 10, "tune": 10, "chains": 1, "cores": 1, "progressbar": False}
+    for option in [{"stopping": {"max_time": 10}}, {"P_summary": {"thin": 10}}, {"store_deterministics": False}]:
+        with pytest.raises(ValueError):
+            dive.sample(model_dic, MCMCparameters, tempering={"nbetas": 2}, **option)
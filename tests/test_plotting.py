@@ -0,0 +1,43 @@
+import numpy as np
+import arviz as az
+
+import dive
+from dive import plotting
+from dive import test_data
+
+def test_histogram_quantiles_and_hdi():
+    rng = np.random.default_rng(0)
+    x = np.column_stack([rng.normal(size=20000), rng.exponential(size=20000), np.full(20000, 0.5)])
+    low, high, bins = x.min(axis=0), x.max(axis=0), 1000
+    edges = plotting._edges(low, high, bins)
+    counts = sum(plotting._histogram(chunk, low, high, bins) for chunk in np.array_split(x, 7))
+    tol = 2*(high - low)/bins + 1e-12
+
+    quantiles = [0.025, 0.5, 0.975]
+    assert np.all(np.abs(plotting._histquantiles(counts, edges, quantiles) - np.quantile(x, quantiles, axis=0)) <= tol)
+    hdi = np.array([az.hdi(column, hdi_prob=0.9) for column in x.T]).T
+    assert np.all(np.abs(plotting._histhdi(counts, edges, 0.9) - hdi) <= 2*tol)
+
+def test_posterior_predictive_is_chunked_and_cached(monkeypatch):
+    # the seaborn-darkgrid style of FitResult.plot is not available in newer matplotlib
+    monkeypatch.setattr(dive.utils.plt.style, "use", lambda style: None)
+    data, _ = test_data.generateSingleGauss(nt=100)
+    model_dic = dive.model(data["t"], data["V"], {"method": "regularization", "r": np.linspace(2, 7, 40), "amp_sampler": "gibbs", "bkgd_sampler": "slice"})
+    trace = dive.sample(model_dic, {"draws": 50, "tune": 50, "chains": 2, "cores": 1, "progressbar": False}, seed=1)
+
+    small = dive.posteriorPredictive(trace.copy(), model_dic, chunksize=7)
+    large = dive.posteriorPredictive(trace.copy(), model_dic, chunksize=1000)
+    for name in small.data_vars:
+        np.testing.assert_allclose(small[name].values, large[name].values, rtol=1e-10, atol=1e-12)
+
+    fit = dive.interpret(trace, model_dic)
+    fit.plot(style="mean-ci", j=0.9)
+    assert "predictive" in trace.groups() and trace.predictive.attrs["hdi_prob"] == 0.9
+
+    # the cache is only reused for the same data
+    cached = dive.posteriorPredictive(trace, model_dic, hdi_prob=0.9)
+    assert cached is trace.predictive
+    shifted = dict(model_dic, Vexp=model_dic["Vexp"] + 0.1)
+    recomputed = dive.posteriorPredictive(trace, shifted, hdi_prob=0.9)
+    assert recomputed.attrs["data_hash"] != cached.attrs["data_hash"]
+    np.testing.assert_allclose(recomputed["residuals_mean"].values, cached["residuals_mean"].values - 0.1, atol=1e-10)
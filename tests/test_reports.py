@@ -0,0 +1,49 @@
+import os
+import json
+import numpy as np
+
+import dive
+from dive import test_data
+
+def _savetrace(path, seed):
+    data, _ = test_data.generateSingleGauss(nt=60)
+    model_dic = dive.model(data["t"], data["V"], {"method": "regularization", "r": np.linspace(2, 7, 20), "amp_sampler": "gibbs", "bkgd_sampler": "slice"})
+    trace = dive.sample(model_dic, {"draws": 20, "tune": 20, "chains": 2, "cores": 1, "progressbar": False}, seed=seed)
+    dive.saveTrace(trace, model_dic, str(path))
+
+def _mtimes(outdir):
+    return {name: os.stat(outdir/name).st_mtime_ns for name in os.listdir(outdir) if name.endswith(".png")}
+
+def test_reports_are_rendered_only_for_changed_traces(tmp_path, capsys):
+    _savetrace(tmp_path/"a", seed=1)
+    _savetrace(tmp_path/"b", seed=2)
+    paths = [str(tmp_path/"a.nc"), str(tmp_path/"b.nc")]
+    outdir = tmp_path/"reports"
+
+    table = dive.makeReports(paths, outdir=str(outdir), cores=1)
+    assert set(table.index.get_level_values("trace")) == {"a", "b"}
+    rendered = _mtimes(outdir)
+    assert len(rendered) == 6
+
+    # nothing is rendered again for unchanged inputs
+    capsys.readouterr()
+    dive.makeReports(paths, outdir=str(outdir), cores=1)
+    assert "All 2 reports are up to date" in capsys.readouterr().out
+    assert _mtimes(outdir) == rendered
+
+    # only the trace whose input file changed is rendered again
+    _savetrace(tmp_path/"a", seed=3)
+    dive.makeReports(paths, outdir=str(outdir), cores=1)
+    assert "Rendering 1 of 2 reports" in capsys.readouterr().out
+    mtimes = _mtimes(outdir)
+    for name, mtime in mtimes.items():
+        assert (mtime != rendered[name]) == name.startswith("a_")
+
+    # a trace that fails is recorded in the manifest and left out of the summary
+    (tmp_path/"c.nc").write_bytes(b"not a trace")
+    table = dive.makeReports(paths + [str(tmp_path/"c.nc")], outdir=str(outdir), cores=1)
+    assert set(table.index.get_level_values("trace")) == {"a", "b"}
+    with open(outdir/"manifest.json") as f:
+        manifest = json.load(f)
+    assert "error" in manifest["c"] and "summary" not in manifest["c"]
+    assert "error" not in manifest["a"] and _mtimes(outdir) == mtimes
@@ -0,0 +1,193 @@
+import pytest
+import numpy as np
+from scipy.optimize import nnls
+
+import dive
+from dive import test_data
+from dive.samplers import _pnnls, _randPtmvn
+
+def _model(nr=40):
+    data, _ = test_data.generateSingleGauss(nt=100)
+    model_dic = dive.model(data["t"], data["V"], {"method": "regularization", "r": np.linspace(2, 7, nr)})
+    point = model_dic["model"].initial_point()
+    point.update({"tau_log__": np.log(1e4), "delta_log__": np.log(10.0), "lamb_logodds__": 0.0})
+    return model_dic, point
+
+def _conditional():
+    # tau, delta and the full kernel of the regularization model for the test data
+    model_dic, point = _model()
+    with model_dic["model"]:
+        steps = {"dense": dive.randPnorm_posterior(model_dic["pars"]), "iterative": dive.randPiterative_posterior(model_dic["pars"])}
+    return steps, steps["dense"]._conditional(point)
+
+def test_pnnls():
+    rng = np.random.default_rng(0)
+    A = rng.standard_normal((80, 40))
+    b = rng.standard_normal(80)
+    x, converged = _pnnls(lambda x: A.T@(A@x), A.T@b, np.zeros(40), tol=1e-10)
+    assert converged
+    assert np.allclose(x, nnls(A, b)[0], atol=1e-6)
+
+    _, converged = _pnnls(lambda x: A.T@(A@x), A.T@b, np.zeros(40), tol=1e-10, maxiter=3)
+    assert not converged
+
+def test_iterative_agrees_with_dense():
+    steps, (tau, delta, K) = _conditional()
+    np.random.seed(0)
+    draws = {name: np.array([step._drawP(tau, delta, K) for _ in range(1000)]) for name, step in steps.items()}
+    # the means agree within five Monte Carlo standard errors of their difference
+    mean, std = draws["dense"].mean(axis=0), draws["dense"].std(axis=0)
+    assert np.all(np.abs(draws["iterative"].mean(axis=0) - mean) < 5*np.sqrt(2/1000)*std + 1e-6)
+    assert np.allclose(draws["iterative"].std(axis=0), std, rtol=0.2, atol=1e-6)
+
+def test_tmvn_transition_is_invariant():
+    # a chain of transitions reproduces a 2D truncated Gaussian sampled by rejection
+    invSigma = np.array([[2.0, 1.2], [1.2, 1.0]])
+    mu = np.array([0.3, -0.2])
+    rng = np.random.default_rng(0)
+    z = rng.multivariate_normal(mu, np.linalg.inv(invSigma), size=200000)
+    z = z[np.all(z >= 0, axis=1)]
+
+    np.random.seed(0)
+    x, chain = np.array([0.5, 0.5]), []
+    for _ in range(5000):
+        x = _randPtmvn(invSigma@mu, invSigma, x)
+        chain.append(x)
+    assert np.allclose(np.mean(chain, axis=0), z.mean(axis=0), atol=0.03)
+    assert np.allclose(np.cov(np.transpose(chain)), np.cov(z.T), atol=0.03)
+
+def test_tmvn_step_is_invariant():
+    # with a fixed conditional, the steps continue one chain of transitions, whose
+    # normalized draws agree with those of a reference chain of _randPtmvn
+    model_dic, point = _model(nr=12)
+    with model_dic["model"]:
+        step = dive.randPtmvn_posterior(model_dic["pars"])
+    tau, delta, K = step._conditional(point)
+    tauKtV, invSigma = step._precision(tau, delta, K)
+    dr = model_dic["pars"]["dr"]
+
+    np.random.seed(0)
+    steps, unnormalized = [], []
+    for _ in range(4000):
+        steps.append(step.step(point)[0]["P"])
+        unnormalized.append(step.Plast)
+    x, reference = _randPtmvn(tauKtV, invSigma, np.full(12, 1.0)), []
+    for _ in range(4000):
+        x = _randPtmvn(tauKtV, invSigma, x)
+        reference.append(x)
+    reference = np.array(reference)
+
+    for draws, ref in [(np.array(unnormalized), reference), (np.array(steps), reference/reference.sum(axis=1, keepdims=True)/dr)]:
+        std = ref.std(axis=0)
+        assert np.all(np.abs(draws.mean(axis=0) - ref.mean(axis=0)) < 0.1*std.max())
+        assert np.allclose(draws.std(axis=0), std, rtol=0.15, atol=0.05*std.max())
+
+    # the chain continues from its previous draw until it is reset
+    assert step.Plast is not None
+    step.reset_tuning()
+    assert step.Plast is None
+
+def test_adaptive_support_needs_fnnls():
+    data, _ = test_data.generateSingleGauss(nt=100)
+    for P_sampler in ["iterative", "hmc"]:
+        with pytest.raises(ValueError):
+            dive.model(data["t"], data["V"], {"method": "regularization", "r": np.linspace(2, 7, 40), "P_sampler": P_sampler, "P_support": "adaptive"})
+
+def test_adaptive_support_agrees_with_full_grid():
+    # a single Gaussian with little noise on a wide grid, so that P has an empty tail
+    data, _ = test_data.generateSingleGauss(nt=100, sigma=0.002)
+    model_dic = dive.model(data["t"], data["V"], {"method": "regularization", "r": np.linspace(1.5, 15, 60), "P_support": "adaptive"})
+    point = model_dic["model"].initial_point()
+    Bend = np.exp(-0.1*data["t"][-1])
+    point.update({"tau": 1/0.002**2, "delta": 1.0, "lamb_logodds__": 0.0, "Bend_logodds__": np.log(Bend/(1 - Bend)), "V0_interval__": 0.0})
+    with model_dic["model"]:
+        adaptive = dive.randPnorm_posterior(model_dic["pars"])
+        full = dive.randPnorm_posterior({**model_dic["pars"], "P_support": "full"})
+
+    # the support adapts during tuning only
+    np.random.seed(0)
+    adaptive.reset_tuning()
+    for _ in range(300):
+        adaptive.step(point)
+    adaptive.stop_tuning()
+    support = adaptive.support.copy()
+    assert len(support) < 60
+    draws = {"adaptive": np.array([adaptive.step(point)[0]["P"] for _ in range(2000)]),
+             "full": np.array([full.step(point)[0]["P"] for _ in range(2000)])}
+    np.testing.assert_array_equal(adaptive.support, support)
+
+    # the full-grid draws have (almost) no mass outside the support, and the draws agree
+    outside = np.setdiff1d(np.arange(60), support)
+    assert draws["full"][:, outside].sum() < 1e-3*draws["full"].sum()
+    Pmax = draws["full"].mean(axis=0).max()
+    assert np.allclose(draws["adaptive"].mean(axis=0), draws["full"].mean(axis=0), atol=0.03*Pmax)
+    for q in [0.05, 0.5, 0.95]:
+        assert np.allclose(np.quantile(draws["adaptive"], q, axis=0), np.quantile(draws["full"], q, axis=0), atol=0.05*Pmax)
+
+def _fixedconditional(bkgd_var="Bend"):
+    # regularization model on noisy data, at a point with the true P, noise level and background
+    data, _ = test_data.generateSingleGauss(nt=100, sigma=0.3)
+    r = np.linspace(2, 7, 40)
+    model_dic = dive.model(data["t"], data["V"], {"method": "regularization", "r": r, "bkgd_var": bkgd_var, "amp_sampler": "gibbs", "bkgd_sampler": "slice"})
+    point = model_dic["model"].initial_point()
+    point.update({"P": dive.dd_gauss(r, 4, 0.4), "tau": 1/0.3**2, "lamb_logodds__": 0.0, "V0_interval__": 0.0})
+    if bkgd_var == "Bend":
+        Bend = np.exp(-0.1*data["t"][-1])
+        point["Bend_logodds__"] = np.log(Bend/(1 - Bend))
+    else:
+        point["k_log__"] = np.log(0.1)
+    return model_dic, point
+
+def _chain(step, point, names, n):
+    draws = []
+    for _ in range(n):
+        point, _ = step.step(point)
+        draws.append([point[name] for name in names])
+    return np.array(draws, dtype=float)
+
+def test_amplitude_step_agrees_with_model():
+    model_dic, point = _fixedconditional()
+    model = model_dic["model"]
+    with model:
+        step = dive.randAmp_posterior(model_dic["pars"])
+    np.random.seed(0)
+    chain = _chain(step, point, ["V0_interval__", "lamb_logodds__"], 20000)
+
+    # full conditional of (V0, lamb) from the model's log density on a grid of the
+    # transformed values
+    logp = model.compile_logp()
+    x, y = np.linspace(-1.5, 1, 250), np.linspace(-6, 4, 250)
+    logw = np.array([[logp({**point, "V0_interval__": a, "lamb_logodds__": b}) for b in y] for a in x])
+    w = np.exp(logw - logw.max())
+    w /= w.sum()
+    grids = {"V0": np.exp(x)[:, np.newaxis] + 0*w, "lamb": 1/(1 + np.exp(-y))[np.newaxis, :] + 0*w}
+    draws = {"V0": np.exp(chain[:, 0]), "lamb": 1/(1 + np.exp(-chain[:, 1]))}
+    for name, grid in grids.items():
+        mean = np.sum(w*grid)
+        std = np.sqrt(np.sum(w*(grid - mean)**2))
+        assert abs(draws[name].mean() - mean) < 0.05*std
+        assert np.isclose(draws[name].std(), std, rtol=0.05)
+
+def test_background_step_agrees_with_model():
+    for bkgd_var, name in [("Bend", "Bend_logodds__"), ("k", "k_log__")]:
+        model_dic, point = _fixedconditional(bkgd_var)
+        model = model_dic["model"]
+        with model:
+            step = dive.randBkgd_posterior(model_dic["pars"])
+        np.random.seed(0)
+        _chain(step, point, [name], 500)
+        step.stop_tuning()
+        chain = _chain(step, point, [name], 20000)[:, 0]
+
+        # full conditional of the transformed background variable from the model's
+        # log density on a grid
+        logp = model.compile_logp()
+        x = point[name] + np.linspace(-8, 8, 4000)
+        logw = np.array([logp({**point, name: a}) for a in x])
+        w = np.exp(logw - logw.max())
+        w /= w.sum()
+        assert w[0] < 1e-6 and w[-1] < 1e-6
+        mean = np.sum(w*x)
+        std = np.sqrt(np.sum(w*(x - mean)**2))
+        assert abs(chain.mean() - mean) < 0.05*std
+        assert np.isclose(chain.std(), std, rtol=0.05)
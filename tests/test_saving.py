@@ -0,0 +1,22 @@
+import pytest
+import numpy as np
+
+import dive
+from dive import test_data
+
+@pytest.mark.parametrize("encoding", [None, "sparse", "float16"])
+def test_trace_round_trip(tmp_path, encoding):
+    data, _ = test_data.generateSingleGauss(nt=100)
+    r = np.linspace(2, 7, 40)
+    model_dic = dive.model(data["t"], data["V"], {"method": "regularization", "r": r, "amp_sampler": "gibbs", "bkgd_sampler": "slice"})
+    trace = dive.sample(model_dic, {"draws": 20, "tune": 20, "chains": 2, "cores": 1, "progressbar": False}, seed=1)
+    P = trace.posterior["P"].values.copy()
+
+    dive.saveTrace(trace, model_dic, str(tmp_path/"trace"), P_encoding=encoding)
+    loaded, loaded_dic = dive.loadTrace(str(tmp_path/"trace.nc"))
+
+    np.testing.assert_allclose(loaded.posterior["P_dim_0"].values, r)
+    np.testing.assert_allclose(loaded_dic["pars"]["r"], r)
+    Ploaded = loaded.posterior["P"].values
+    assert not np.isnan(Ploaded).any()
+    np.testing.assert_allclose(Ploaded, P, rtol=0, atol=1e-3*P.max() if encoding == "float16" else 0)
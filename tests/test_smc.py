@@ -0,0 +1,65 @@
+import numpy as np
+from scipy.special import logsumexp
+
+import dive
+from dive import smc
+from dive import test_data
+from dive.models import _wmin, _wmax
+
+def _point(model, values):
+    """
+    Returns the point of the value variables of model for the untransformed values.
+    """
+    point = {}
+    for rv in model.free_RVs:
+        transform = model.rvs_to_transforms[rv]
+        value = np.asarray(values[rv.name], dtype=float)
+        point[model.rvs_to_values[rv].name] = value if transform is None else transform.forward(value, *rv.owner.inputs).eval()
+    return point
+
+def _evaluate(fn, point):
+    names = [input.variable.name for input in fn.f.maker.inputs]
+    return fn({name: value for name, value in point.items() if name in names})
+
+def test_logdensity_agrees_with_model():
+    data, _ = test_data.generateMultiGauss(nt=100)
+    model_dic = dive.model(data["t"], data["V"], {"method": "gaussian", "nGauss": 2, "r": np.linspace(2, 7, 60)})
+    pars, model = model_dic["pars"], model_dic["model"]
+    smc._shared.update({"t": np.asarray(pars["t"], dtype=float), "Vexp": np.asarray(pars["Vexp"], dtype=float),
+                        "K0": np.asarray(pars["K0"], dtype=float), "r": np.asarray(pars["r"], dtype=float),
+                        "nGauss": 2, "background": pars["background"], "wprior": smc._wprior()})
+
+    # prior draws, with the widths moved away from _wmax, where the marginal prior of w
+    # can be integrated over w_mu on a finite grid
+    rng = np.random.default_rng(0)
+    z = smc._drawprior(rng, 5)
+    W = _wmax - _wmin
+    delta = rng.uniform(0.3, W - 0.1, (5, 2))
+    z[:, 2:4] = -np.log(np.expm1(-np.log(delta/W)/10))
+    params, logjac = smc._backward(z)
+    lp, ll = smc._logdensity(z)
+
+    bkgd = pars["background"]
+    others = [model[name] for name in ["r0_rel", "a", "lamb", bkgd, "V0", "sigma"]]
+    loglike = model.compile_logp(vars=model.observed_RVs)
+    logprior = model.compile_logp(vars=others, jacobian=False)
+    logw = model.compile_logp(vars=[model["w"]], jacobian=False, sum=False)
+    logw_mu = model.compile_logp(vars=[model["w_mu"]], jacobian=False, sum=False)
+    v = np.linspace(-25, np.log(40), 3001)
+
+    for i in range(len(z)):
+        values = {name: params[name][i] for name in ["r0_rel", "a", "lamb", bkgd, "V0", "sigma", "w"]}
+        point = _point(model, {**values, "w_mu": np.ones(2)})
+        assert np.isclose(_evaluate(loglike, point), ll[i], rtol=1e-10)
+
+        # marginal prior density of the widths (w_mu over log(w_mu)), transformed to
+        # the coordinates u of smc
+        # (w_mu is log-transformed, so its value variable is x = log(w_mu))
+        terms = []
+        for x in v:
+            point[model.rvs_to_values[model["w_mu"]].name] = np.full(2, x)
+            terms.append(_evaluate(logw, point)[0] + _evaluate(logw_mu, point)[0] + x)
+        logpw = logsumexp(terms, axis=0) + np.log(v[1] - v[0])
+        logpu = logpw + np.log(10*delta[i]) - np.logaddexp(0, z[i, 2:4])
+
+        assert np.isclose(lp[i], logjac[i] + _evaluate(logprior, point) + logpu.sum(), atol=2e-3)